@@ -0,0 +1,92 @@
+"""
+GuildState 記憶體基準：比較舊版「九個全域 dict + list 佇列 + dict 歌曲」與 GuildState 的記憶體用量。
+
+    python bench/bench_guild_state.py --guilds 10000 --queue 10 --history 50
+"""
+import argparse
+import os
+import sys
+import tracemalloc
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import musicbot  # noqa: E402
+
+
+def fake_info(g: int, i: int) -> dict:
+    return {
+        "webpage_url": f"https://www.youtube.com/watch?v={g:06d}{i:05d}",
+        "title": f"Song {g}-{i}",
+        "duration": 180 + i,
+        "thumbnail": f"https://i.ytimg.com/vi/{g:06d}{i:05d}/hqdefault.jpg",
+        "uploader": f"Channel {i % 20}",
+    }
+
+
+def build_legacy(guilds: int, queue: int, hist: int):
+    queues, now_playing, loop_flags, start_times = {}, {}, {}, {}
+    volume_settings, last_active, history, play_counts = {}, {}, {}, {}
+    now = datetime.now(timezone.utc)
+    for g in range(guilds):
+        tracks = []
+        for i in range(queue + hist):
+            info = fake_info(g, i)
+            tracks.append({
+                "webpage_url": info["webpage_url"],
+                "title": info["title"],
+                "duration": str(info["duration"]),
+                "thumbnail": info["thumbnail"],
+                "uploader": info["uploader"],
+            })
+        queues[g] = tracks[:queue]
+        history[g] = tracks[queue:][-50:]
+        now_playing[g] = None
+        loop_flags[g] = False
+        start_times[g] = None
+        volume_settings[g] = 1.0
+        last_active[g] = now
+        play_counts[g] = {t["title"]: 1 for t in history[g]}
+    return queues, now_playing, loop_flags, start_times, volume_settings, last_active, history, play_counts
+
+
+def build_state(guilds: int, queue: int, hist: int):
+    states = {}
+    now = datetime.now(timezone.utc)
+    for g in range(guilds):
+        st = musicbot.GuildState()
+        tracks = [musicbot.Track.from_info(fake_info(g, i)) for i in range(queue + hist)]
+        st.queue.extend(tracks[:queue])
+        for t in tracks[queue:]:
+            st.history.append(t)
+            st.play_stats.record(t)
+        st.last_active = now
+        states[g] = st
+    return states
+
+
+def measure(fn, *args) -> int:
+    tracemalloc.start()
+    obj = fn(*args)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del obj
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--guilds", type=int, default=10000)
+    parser.add_argument("--queue", type=int, default=10, help="每個 guild 佇列長度")
+    parser.add_argument("--history", type=int, default=50, help="每個 guild 歷史筆數")
+    args = parser.parse_args()
+
+    legacy = measure(build_legacy, args.guilds, args.queue, args.history)
+    state = measure(build_state, args.guilds, args.queue, args.history)
+    print(f"{args.guilds} guilds（佇列 {args.queue} 首、歷史 {args.history} 首）")
+    print(f"  舊版 dict：   {legacy / 1024 / 1024:8.1f} MiB")
+    print(f"  GuildState：  {state / 1024 / 1024:8.1f} MiB  ({state / legacy * 100:.0f}%)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+混音引擎微基準：量 MixSource 每個 CPU 核心每秒能處理幾個 20 ms frame（不含 ffmpeg 解碼和 opus 編碼）。
+
+    python bench/bench_mixer.py --frames 50000
+
+分別量「一般播放」「交叉淡化中（兩首同時混）」「第一次播放、正在量響度」三種情況，
+並和 pcm 模式的 PCMVolumeTransformer 對照。除以 50 就是單核可以同時撐住的串流數。
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["PLAYBACK_MODE"] = "mix"  # numpy 只在 mix 模式載入
+
+import discord  # noqa: E402
+
+import musicbot  # noqa: E402
+
+
+class SyntheticPCM(discord.AudioSource):
+    # 重複送同一段隨機 PCM，不會結束
+    def __init__(self, seed: int):
+        rng = musicbot.np.random.default_rng(seed)
+        self.frame = rng.integers(-8000, 8000, musicbot.FRAME_SAMPLES, dtype=musicbot.np.int16).tobytes()
+
+    def read(self) -> bytes:
+        return self.frame
+
+
+def per_core(source: discord.AudioSource, frames: int) -> float:
+    t0 = time.process_time()
+    for _ in range(frames):
+        source.read()
+    return frames / (time.process_time() - t0)
+
+
+def mix_source(gain, fade: bool, frames: int) -> musicbot.MixSource:
+    # 量響度的長度也拉長到整段
+    musicbot.LOUDNESS_FRAMES = frames + 1
+    source = musicbot.MixSource(
+        SyntheticPCM(1), 0.0, 0.8, "bench", gain, None, lambda s: None, lambda s: None, lambda u, g: None,
+    )
+    if fade:
+        # 淡化長度設得比測試長，整段都在混兩首
+        musicbot.CROSSFADE_SECONDS = 10 ** 6
+        source.prepare(SyntheticPCM(2), "bench-next", gain, 0.0, None)
+    return source
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=50000)
+    args = parser.parse_args()
+    if musicbot.np is None:
+        sys.exit("需要 numpy：pip install numpy")
+
+    volume = discord.PCMVolumeTransformer(SyntheticPCM(1), volume=0.8)
+    rows = [
+        ("PCMVolumeTransformer", per_core(volume, args.frames)),
+        ("MixSource 一般播放", per_core(mix_source(1.2, fade=False, frames=args.frames), args.frames)),
+        ("MixSource 量響度中", per_core(mix_source(None, fade=False, frames=args.frames), args.frames)),
+        ("MixSource 交叉淡化", per_core(mix_source(1.2, fade=True, frames=args.frames), args.frames)),
+    ]
+    for label, fps in rows:
+        print(f"{label:<22} {fps:10.0f} frames/s/core  ≈ {fps / 50:7.0f} 條串流")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+播放路徑 CPU 基準：比較 PCM（解碼 → PCMVolumeTransformer → libopus 編碼）與 Opus 直通的每條串流 CPU 用量。
+
+    python bench/bench_playback_cpu.py song.webm --seconds 60
+    python bench/bench_playback_cpu.py song.webm --volume 0.8   # 音量不是 100% 時的 opus 路徑
+
+輸入最好是 webm/opus 或 ogg/opus 檔案（和 YouTube bestaudio 相同），才量得到直通的效果。
+結果是「每秒音訊花掉的 CPU 秒數」，乘上 100 大約就是一條串流佔用的單核百分比。
+"""
+import argparse
+import asyncio
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord  # noqa: E402
+
+import musicbot  # noqa: E402
+
+FRAMES_PER_SECOND = 50  # 每個 frame 20 ms
+
+
+def children_cpu() -> float:
+    ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return ru.ru_utime + ru.ru_stime
+
+
+def drain(source: discord.AudioSource, frames: int) -> int:
+    # 不照即時速度，盡快把 frame 讀完（CPU 用量和速度無關）
+    encoder = None if source.is_opus() else discord.opus.Encoder()
+    n = 0
+    for _ in range(frames):
+        data = source.read()
+        if not data:
+            break
+        if encoder is not None:
+            encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+        n += 1
+    source.cleanup()  # 會等 ffmpeg 結束，子程序的 CPU 時間才會算進 RUSAGE_CHILDREN
+    return n
+
+
+def measure(label: str, mode: str, path: str, seconds: int, volume: float):
+    musicbot.PLAYBACK_MODE = mode
+    source = asyncio.run(musicbot.create_source(path, volume, local=True))
+
+    py0, ch0, wall0 = time.process_time(), children_cpu(), time.perf_counter()
+    frames = drain(source, seconds * FRAMES_PER_SECOND)
+    py = time.process_time() - py0
+    ch = children_cpu() - ch0
+    wall = time.perf_counter() - wall0
+
+    audio = frames / FRAMES_PER_SECOND
+    if not audio:
+        print(f"{label}: 沒有讀到任何音訊")
+        return
+    print(
+        f"{label:<22} 音訊 {audio:6.1f}s  ffmpeg {ch / audio:.4f}  python+opus {py / audio:.4f}"
+        f"  合計 {(ch + py) / audio:.4f} CPU-s/音訊秒  (耗時 {wall:.1f}s)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", help="本機音訊檔")
+    parser.add_argument("--seconds", type=int, default=60, help="最多量幾秒音訊")
+    parser.add_argument("--volume", type=float, default=1.0)
+    args = parser.parse_args()
+
+    measure("pcm (decode+encode)", "pcm", args.path, args.seconds, args.volume)
+    measure("opus (passthrough)", "opus", args.path, args.seconds, args.volume)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+冷啟動基準：每次開新的子程序，分階段量啟動時間，多跑幾次取中位數。
+
+    python bench/bench_startup.py --runs 5
+
+階段（前三個在開機的關鍵路徑上，後兩個在登入期間於背景執行）：
+  interpreter   Python 本身啟動（空程式）
+  discord       import discord
+  musicbot      import musicbot 的模組本體（設定、指令樹；不含 yt-dlp，資料庫在 setup_hook 才開）
+  command_hash  算指令樹 hash，決定要不要 tree.sync()
+  yt_dlp        import yt-dlp（背景）
+  extractors    建第一批 YoutubeDL 實例、載入 extractor 清單（背景）
+
+登入、連 gateway 和指令同步要實際連 Discord，bot 啟動時會自己印出（⏱️ 啟動耗時 ...）。
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import json, sys, time
+t = time.perf_counter()
+phases = {}
+
+def mark(name):
+    global t
+    now = time.perf_counter()
+    phases[name] = now - t
+    t = now
+
+sys.path.insert(0, %r)
+import discord; mark("discord")
+import musicbot; mark("musicbot")
+musicbot.command_tree_hash(); mark("command_hash")
+musicbot.load_yt_dlp(); mark("yt_dlp")
+musicbot.ydl_pool.warm(); mark("extractors")
+print(json.dumps(phases))
+""" % ROOT
+
+
+def run_child(env: dict) -> dict:
+    t0 = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], check=True, env=env)
+    interpreter = time.perf_counter() - t0
+    out = subprocess.run(
+        [sys.executable, "-c", CHILD], check=True, env=env, capture_output=True, text=True,
+    ).stdout
+    phases = json.loads(out.strip().splitlines()[-1])
+    return dict(interpreter=interpreter, **phases)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    env = dict(
+        os.environ,
+        STATE_DB_PATH=os.path.join(tmp.name, "state.db"),
+        METRICS_PORT="0",
+        AUDIO_CACHE_DIR="",
+        COMMAND_HASH_PATH="",
+    )
+    env.pop("TRACK_CACHE_PATH", None)
+
+    runs = [run_child(env) for _ in range(args.runs)]
+    critical = ("interpreter", "discord", "musicbot", "command_hash")
+    print(f"{'階段':<14}{'中位數':>10}{'最大':>10}")
+    for name in runs[0]:
+        values = [r[name] for r in runs]
+        tag = "" if name in critical else "  (背景)"
+        print(f"{name:<14}{statistics.median(values) * 1000:>8.1f}ms{max(values) * 1000:>8.1f}ms{tag}")
+    total = statistics.median(sum(r[n] for n in critical) for r in runs)
+    print(f"關鍵路徑合計（不含登入 / gateway）：{total * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+YoutubeDL 實例池微基準：比較「每次新建 YoutubeDL」與「從池子借用」的每次查詢額外開銷。
+
+    python bench/bench_ydl_pool.py                 # 只量建構 / 借還的開銷（不連網）
+    python bench/bench_ydl_pool.py --url <網址>     # 另外實際查詢，量端到端時間
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yt_dlp  # noqa: E402
+
+import musicbot  # noqa: E402
+
+
+def per_call_fresh(n: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(n):
+        with yt_dlp.YoutubeDL(dict(musicbot.YDL_OPTS_BASE)):
+            pass
+    return (time.perf_counter() - t0) / n
+
+
+def per_call_pooled(n: int) -> float:
+    pool = musicbot.YDLPool({"base": musicbot.YDL_OPTS_BASE}, max_uses=n + 1)
+    with pool.borrow():  # 預熱：第一次一定要建
+        pass
+    t0 = time.perf_counter()
+    for _ in range(n):
+        with pool.borrow():
+            pass
+    return (time.perf_counter() - t0) / n
+
+
+def lookup_fresh(url: str, n: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(n):
+        with yt_dlp.YoutubeDL(dict(musicbot.YDL_OPTS_BASE)) as ydl:
+            ydl.extract_info(url, download=False)
+    return (time.perf_counter() - t0) / n
+
+
+def lookup_pooled(url: str, n: int) -> float:
+    pool = musicbot.YDLPool({"base": musicbot.YDL_OPTS_BASE}, max_uses=n + 1)
+    with pool.borrow() as ydl:
+        ydl.extract_info(url, download=False)
+    t0 = time.perf_counter()
+    for _ in range(n):
+        with pool.borrow() as ydl:
+            ydl.extract_info(url, download=False)
+    return (time.perf_counter() - t0) / n
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=200, help="重複次數")
+    parser.add_argument("--url", help="實際查詢的網址（會連網）")
+    parser.add_argument("--lookups", type=int, default=5, help="實際查詢次數")
+    args = parser.parse_args()
+
+    fresh = per_call_fresh(args.n)
+    pooled = per_call_pooled(args.n)
+    print(f"建構開銷   每次新建: {fresh * 1000:8.3f} ms   池子借用: {pooled * 1000:8.3f} ms")
+
+    if args.url:
+        fresh = lookup_fresh(args.url, args.lookups)
+        pooled = lookup_pooled(args.url, args.lookups)
+        print(f"端到端查詢 每次新建: {fresh * 1000:8.1f} ms   池子借用: {pooled * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,560 @@
+"""
+離線壓力測試：用假的 yt-dlp、假的 VoiceClient 和假的 interaction，跑真正的
+/play、/playlist、/skip 指令和播放器換歌流程，不需要 Discord 也不需要 YouTube。
+
+    python bench/loadtest.py --guilds 200 --commands 20
+    python bench/loadtest.py --guilds 50 --ydl-latency 0.8 --fail-rate 0.05
+    python bench/loadtest.py --scenario smoke --check            # 和 bench/baselines.json 的 smoke 基準比較
+    python bench/loadtest.py --scenario big --guilds 500 --save-baseline   # 把這次結果存成新基準
+
+--check 時沒有基準、或負載參數和基準不同，也會回傳 1。
+
+報告的數字：
+    指令吞吐量（每秒完成幾個指令）、/play 回覆延遲與開始出聲延遲的百分位數、
+    換歌空檔、event loop 延遲、最高 RSS。
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+
+# 基準檢查的方向：True 表示越大越好
+BASELINE_METRICS = {
+    "commands_per_sec": True,
+    "play_p50_ms": False,
+    "play_p95_ms": False,
+    "first_audio_p95_ms": False,
+    "gap_p95_ms": False,
+    "loop_lag_p99_ms": False,
+    "peak_rss_mb": False,
+}
+ABS_SLACK_MS = 2.0  # 太小的延遲數字不算退步（計時誤差）
+DEFAULT_TOLERANCE = 0.2
+# 內建情境：--scenario 給這些名字時先套用這組參數（命令列指定的還是優先）
+SCENARIOS = {
+    # 幾十秒跑完、resolver 不會塞滿，適合每次改完順手 --check
+    "smoke": {"guilds": 10, "commands": 10, "tail": 3.0},
+}
+# 基準連同這些負載參數一起存；比較時參數要一樣才有意義
+WORKLOAD_ARGS = (
+    "guilds", "commands", "think", "catalog", "skip_ratio", "playlist_ratio", "playlist_size",
+    "playlist_limit", "ydl_latency", "fail_rate", "api_latency", "track_seconds", "tail", "seed",
+)
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+class Stats:
+    def __init__(self):
+        self.latency: Dict[str, List[float]] = defaultdict(list)
+        self.first_audio: List[float] = []
+        self.gaps: List[float] = []
+        self.loop_lag: List[float] = []
+        self.failed: Dict[str, int] = defaultdict(int)
+        self.tracks_started = 0
+
+
+# ============================================================
+# 假的 yt-dlp：可設定延遲和失敗率，在 resolver thread 裡 time.sleep
+# ============================================================
+class FakeYoutubeDL:
+    latency = 0.3
+    jitter = 0.5       # 延遲 = latency * (1 ± jitter)
+    fail_rate = 0.0
+    page_size = 100    # 播放清單每頁幾首（和 YouTube 一樣）
+    playlist_size = 200
+    error_cls: type = Exception
+
+    def __init__(self, opts: dict):
+        self.opts = opts
+        self.rng = random.Random()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        pass
+
+    def _wait(self):
+        time.sleep(max(self.latency * (1 + self.rng.uniform(-self.jitter, self.jitter)), 0.0))
+        if self.rng.random() < self.fail_rate:
+            raise self.error_cls("fake extractor failure")
+
+    @staticmethod
+    def video(vid: str, flat: bool = False) -> dict:
+        info = {
+            "id": vid,
+            "webpage_url": f"https://www.youtube.com/watch?v={vid}",
+            "title": f"Fake song {vid}",
+            "duration": 120 + int(vid[-3:]) % 180,
+            "uploader": f"Channel {vid[-2:]}",
+        }
+        if flat:
+            info["url"] = info.pop("webpage_url")
+            return info
+        info["thumbnail"] = f"https://i.ytimg.com/vi/{vid}/hqdefault.jpg"
+        expire = int(time.time()) + 6 * 3600
+        info["url"] = (
+            f"https://rr1---sn-fake.googlevideo.com/videoplayback?expire={expire}"
+            f"&mime=audio%2Fwebm&id={vid}"
+        )
+        return info
+
+    def _playlist_entries(self, list_id: str):
+        for i in range(self.playlist_size):
+            if i % self.page_size == 0:
+                self._wait()
+            yield self.video(f"{list_id}{i:05d}"[-11:], flat=True)
+
+    def extract_info(self, query: str, download: bool = False, process: bool = True) -> dict:
+        self._wait()
+        if query.startswith("ytsearch"):
+            n_str, _, keyword = query[len("ytsearch"):].partition(":")
+            n = int(n_str or 1)
+            digits = "".join(c for c in keyword if c.isdigit()) or "0"
+            base = int(digits)
+            return {"entries": [self.video(f"s{base + i:010d}") for i in range(n)]}
+        if "list=" in query:
+            list_id = query.split("list=", 1)[1]
+            entries = self._playlist_entries(list_id)
+            if process:
+                entries = list(entries)
+            return {"title": f"Fake playlist {list_id}", "entries": entries}
+        vid = query.split("v=", 1)[-1]
+        return self.video(vid)
+
+
+# ============================================================
+# 假的 Discord 物件
+# ============================================================
+class FakeSource:
+    def __init__(self, url: str):
+        self.url = url
+
+    def cleanup(self):
+        pass
+
+
+class FakeVoiceClient:
+    def __init__(self, guild: "FakeGuild", channel: "FakeVoiceChannel", h: "Harness"):
+        self.guild = guild
+        self.channel = channel
+        self.h = h
+        self.connected = True
+        self.source: Optional[FakeSource] = None
+        self.after = None
+        self.handle: Optional[asyncio.TimerHandle] = None
+        self.paused = False
+        self.finished_at: Optional[float] = None
+        self.requested_at: Optional[float] = None
+
+    def is_connected(self) -> bool:
+        return self.connected
+
+    def is_playing(self) -> bool:
+        return self.source is not None and not self.paused
+
+    def is_paused(self) -> bool:
+        return self.source is not None and self.paused
+
+    def play(self, source, after=None):
+        if self.source is not None:
+            raise self.h.discord.ClientException("Already playing audio.")
+        now = time.perf_counter()
+        if self.requested_at is not None:
+            self.h.stats.first_audio.append(now - self.requested_at)
+            self.requested_at = None
+        elif self.finished_at is not None:
+            self.h.stats.gaps.append(now - self.finished_at)
+        self.finished_at = None
+        self.h.stats.tracks_started += 1
+        self.source, self.after = source, after
+        length = self.h.track_seconds * random.uniform(0.8, 1.2)
+        self.handle = asyncio.get_running_loop().call_later(length, self._finish)
+
+    def _finish(self):
+        # 真正的 discord.py 會在語音執行緒上呼叫 after
+        after, self.after = self.after, None
+        self.source, self.handle, self.paused = None, None, False
+        self.finished_at = time.perf_counter()
+        if after is not None:
+            threading.Thread(target=after, args=(None,), daemon=True).start()
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+        if self.source is not None:
+            self._finish()
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    async def move_to(self, channel):
+        await asyncio.sleep(self.h.api_latency)
+        self.channel = channel
+
+    async def disconnect(self, force: bool = False):
+        self.stop()
+        self.connected = False
+        self.guild.voice_client = None
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild: "FakeGuild", h: "Harness"):
+        self.guild = guild
+        self.h = h
+        self.members: list = []
+
+    async def connect(self, **kwargs) -> FakeVoiceClient:
+        await asyncio.sleep(self.h.api_latency * 4)  # 語音握手比一般 API 慢
+        vc = self.guild.voice_client = FakeVoiceClient(self.guild, self, self.h)
+        return vc
+
+
+class FakeMember:
+    def __init__(self, uid: int, channel: FakeVoiceChannel):
+        self.id = uid
+        self.bot = False
+        self.voice = type("VoiceState", (), {"channel": channel})()
+        self.display_name = f"user{uid}"
+        self.mention = f"<@{uid}>"
+
+
+class FakeGuild:
+    def __init__(self, gid: int, h: "Harness"):
+        self.id = gid
+        self.name = f"guild {gid}"
+        self.voice_client: Optional[FakeVoiceClient] = None
+        self.channel = FakeVoiceChannel(self, h)
+        self.member = FakeMember(gid * 10 + 1, self.channel)
+        self.channel.members.append(self.member)
+
+
+class FakeMessage:
+    def __init__(self, h: "Harness"):
+        self.h = h
+
+    async def edit(self, **kwargs):
+        await asyncio.sleep(self.h.api_latency)
+
+
+class FakeResponse:
+    def __init__(self, h: "Harness"):
+        self.h = h
+        self.done = False
+
+    def is_done(self) -> bool:
+        return self.done
+
+    async def _respond(self):
+        if self.done:
+            raise self.h.discord.InteractionResponded(None)
+        self.done = True
+        await asyncio.sleep(self.h.api_latency)
+
+    async def defer(self, **kwargs):
+        await self._respond()
+
+    async def send_message(self, *args, **kwargs):
+        await self._respond()
+
+    async def edit_message(self, **kwargs):
+        await self._respond()
+
+
+class FakeFollowup:
+    def __init__(self, h: "Harness"):
+        self.h = h
+
+    async def send(self, *args, wait: bool = False, **kwargs):
+        await asyncio.sleep(self.h.api_latency)
+        return FakeMessage(self.h) if wait else None
+
+
+class FakeInteraction:
+    def __init__(self, guild: FakeGuild, h: "Harness"):
+        self.guild = guild
+        self.guild_id = guild.id
+        self.user = guild.member
+        self.channel = None
+        self.created_at = datetime.now(timezone.utc)
+        self.response = FakeResponse(h)
+        self.followup = FakeFollowup(h)
+
+
+# ============================================================
+# 壓力測試本體
+# ============================================================
+class Harness:
+    def __init__(self, args, musicbot, discord):
+        self.args = args
+        self.mb = musicbot
+        self.discord = discord
+        self.api_latency = args.api_latency
+        self.track_seconds = args.track_seconds
+        self.guilds: Dict[int, FakeGuild] = {}
+        self.stats = Stats()
+
+    def install(self):
+        mb = self.mb
+        FakeYoutubeDL.latency = self.args.ydl_latency
+        FakeYoutubeDL.fail_rate = self.args.fail_rate
+        FakeYoutubeDL.playlist_size = self.args.playlist_size
+        yt_dlp = mb.load_yt_dlp()
+        FakeYoutubeDL.error_cls = yt_dlp.utils.DownloadError
+        yt_dlp.YoutubeDL = FakeYoutubeDL
+
+        async def create_source(url: str, volume: float, local: bool = False, start: float = 0.0):
+            return FakeSource(url)
+
+        mb.create_source = create_source
+        # 假播放把整首壓成幾秒，位置追蹤會以為每首都提早中斷；不量斷點接續
+        mb.RECOVER_MAX_ATTEMPTS = 0
+        mb.bot.get_guild = self.guilds.get
+
+    async def command(self, name: str, guild: FakeGuild, *args):
+        cmd = {"play": self.mb.play_cmd, "playlist": self.mb.playlist_cmd, "skip": self.mb.skip_cmd}[name]
+        inter = FakeInteraction(guild, self)
+        await self.mb.load_state(guild.id)  # 正式流程由 MusicTree.interaction_check 載入
+        vc = guild.voice_client
+        t0 = time.perf_counter()
+        if name != "skip" and (vc is None or vc.source is None) and not self.mb.get_state(guild.id).queue:
+            # 閒置中下 /play：量到真正開始出聲（播放器在 vc.play 時記錄）
+            pending = t0
+        else:
+            pending = None
+        try:
+            await cmd.callback(inter, *args)
+        except Exception as e:
+            self.stats.failed[name] += 1
+            print(f"/{name} 例外：{e!r}")
+            return
+        self.stats.latency[name].append(time.perf_counter() - t0)
+        vc = guild.voice_client
+        if pending is not None and vc is not None and vc.source is None and vc.requested_at is None:
+            vc.requested_at = pending
+
+    async def session(self, guild: FakeGuild, rng: random.Random):
+        a = self.args
+        for i in range(a.commands):
+            await asyncio.sleep(rng.expovariate(1 / a.think) if a.think > 0 else 0)
+            r = rng.random()
+            if i == 0:
+                r = 1.0  # 第一個指令一定是 /play
+            if r < a.skip_ratio:
+                await self.command("skip", guild)
+            elif r < a.skip_ratio + a.playlist_ratio:
+                await self.command("playlist", guild, f"https://www.youtube.com/playlist?list=PL{guild.id}x{i}", a.playlist_limit)
+            elif rng.random() < 0.5:
+                await self.command("play", guild, f"song {rng.randrange(a.catalog)}")
+            else:
+                vid = f"s{rng.randrange(a.catalog):010d}"
+                await self.command("play", guild, f"https://www.youtube.com/watch?v={vid}")
+
+    async def monitor_lag(self, interval: float = 0.05):
+        while True:
+            t0 = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.stats.loop_lag.append(max(time.perf_counter() - t0 - interval, 0.0))
+
+    async def run(self) -> dict:
+        a = self.args
+        self.install()
+        await self.mb.open_stores()
+        for i in range(1, a.guilds + 1):
+            guild = FakeGuild(i * 1000, self)
+            self.guilds[guild.id] = guild
+        lag_task = asyncio.get_running_loop().create_task(self.monitor_lag())
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(
+            self.session(g, random.Random(a.seed * 100003 + g.id)) for g in self.guilds.values()
+        ))
+        command_wall = time.perf_counter() - t0
+        # 指令下完後再讓播放器跑一段時間，量換歌空檔
+        await asyncio.sleep(a.tail)
+
+        lag_task.cancel()
+        for g in self.guilds.values():
+            if g.voice_client is not None:
+                await g.voice_client.disconnect()
+        # 播放器和背景工作都停掉；resolver thread 的完成回呼要回到這個 loop，所以在 asyncio.run 結束前就收掉
+        await self.mb.stop_background()
+        return self.report(command_wall)
+
+    def report(self, command_wall: float) -> dict:
+        st = self.stats
+        done = sum(len(v) for v in st.latency.values())
+        play = st.latency["play"]
+        ms = 1000
+        return {
+            "guilds": self.args.guilds,
+            "commands": done,
+            "failed_commands": sum(st.failed.values()),
+            "commands_per_sec": done / command_wall if command_wall else 0.0,
+            "play_p50_ms": percentile(play, 50) * ms,
+            "play_p95_ms": percentile(play, 95) * ms,
+            "play_p99_ms": percentile(play, 99) * ms,
+            "first_audio_p50_ms": percentile(st.first_audio, 50) * ms,
+            "first_audio_p95_ms": percentile(st.first_audio, 95) * ms,
+            "tracks_started": st.tracks_started,
+            "gap_p50_ms": percentile(st.gaps, 50) * ms,
+            "gap_p95_ms": percentile(st.gaps, 95) * ms,
+            "gap_max_ms": max(st.gaps, default=0.0) * ms,
+            "loop_lag_p99_ms": percentile(st.loop_lag, 99) * ms,
+            "loop_lag_max_ms": max(st.loop_lag, default=0.0) * ms,
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+
+
+def print_report(r: dict):
+    print(f"{r['guilds']} guilds，完成 {r['commands']} 個指令（失敗 {r['failed_commands']}）")
+    print(f"  吞吐量       {r['commands_per_sec']:10.1f} 指令/秒")
+    print(f"  /play 回覆   p50 {r['play_p50_ms']:8.1f} ms   p95 {r['play_p95_ms']:8.1f} ms   p99 {r['play_p99_ms']:8.1f} ms")
+    print(f"  開始出聲     p50 {r['first_audio_p50_ms']:8.1f} ms   p95 {r['first_audio_p95_ms']:8.1f} ms")
+    print(f"  換歌空檔     p50 {r['gap_p50_ms']:8.1f} ms   p95 {r['gap_p95_ms']:8.1f} ms   max {r['gap_max_ms']:8.1f} ms"
+          f"（{r['tracks_started']} 首）")
+    print(f"  loop 延遲    p99 {r['loop_lag_p99_ms']:8.1f} ms   max {r['loop_lag_max_ms']:8.1f} ms")
+    print(f"  最高 RSS     {r['peak_rss_mb']:10.1f} MiB")
+
+
+def load_baselines() -> dict:
+    try:
+        with open(BASELINE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def workload(args: argparse.Namespace) -> dict:
+    return {k: getattr(args, k) for k in WORKLOAD_ARGS}
+
+
+def check_baseline(scenario: str, result: dict, args: argparse.Namespace) -> bool:
+    base = load_baselines().get(scenario)
+    if base is None:
+        print(f"❌ 沒有「{scenario}」的基準，先用 --save-baseline 存一份")
+        return False
+    diff = {k: (v, getattr(args, k)) for k, v in base["args"].items() if getattr(args, k) != v}
+    if diff:
+        print(f"❌ 負載參數和基準「{scenario}」不同，無法比較：")
+        for k, (old, new) in diff.items():
+            print(f"  {k:<16} 基準 {old}   本次 {new}")
+        return False
+    tolerance = base["tolerance"] if args.tolerance is None else args.tolerance
+    ok = True
+    for key, higher_better in BASELINE_METRICS.items():
+        if key not in base["metrics"]:
+            continue
+        old, new = base["metrics"][key], result[key]
+        if higher_better:
+            worse = new < old * (1 - tolerance)
+        else:
+            slack = 0.0 if key == "peak_rss_mb" else ABS_SLACK_MS
+            worse = new > old * (1 + tolerance) + slack
+        mark = "❌" if worse else "✅"
+        print(f"  {mark} {key:<20} 基準 {old:10.1f}   本次 {new:10.1f}")
+        ok = ok and not worse
+    return ok
+
+
+def save_baseline(scenario: str, result: dict, args: argparse.Namespace):
+    baselines = load_baselines()
+    baselines[scenario] = {
+        "args": workload(args),
+        "tolerance": DEFAULT_TOLERANCE if args.tolerance is None else args.tolerance,
+        "metrics": {k: round(result[k], 2) for k in BASELINE_METRICS},
+    }
+    with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+        json.dump(baselines, f, ensure_ascii=False, indent=2, sort_keys=True)
+        f.write("\n")
+    print(f"💾 已存基準「{scenario}」到 {os.path.relpath(BASELINE_PATH, ROOT)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--guilds", type=int, default=100)
+    parser.add_argument("--commands", type=int, default=20, help="每個 guild 下幾個指令")
+    parser.add_argument("--think", type=float, default=0.2, help="指令之間的平均間隔（秒）")
+    parser.add_argument("--catalog", type=int, default=500, help="不同歌曲數（越小快取命中越多）")
+    parser.add_argument("--skip-ratio", type=float, default=0.15)
+    parser.add_argument("--playlist-ratio", type=float, default=0.05)
+    parser.add_argument("--playlist-size", type=int, default=200)
+    parser.add_argument("--playlist-limit", type=int, default=50)
+    parser.add_argument("--ydl-latency", type=float, default=0.3, help="假 yt-dlp 每次查詢的平均延遲（秒）")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="假 yt-dlp 查詢失敗機率")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="假 Discord API 每次呼叫的延遲（秒）")
+    parser.add_argument("--track-seconds", type=float, default=2.0, help="每首歌實際「播」幾秒")
+    parser.add_argument("--tail", type=float, default=5.0, help="指令下完後繼續播放幾秒")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--state-db", help="狀態資料庫路徑（預設用暫存檔）")
+    parser.add_argument("--scenario", default="default", help="基準的名稱")
+    parser.add_argument("--check", action="store_true", help="和基準比較，退步時回傳 1")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, help=f"容許的退步比例（預設用基準裡存的，存基準時預設 {DEFAULT_TOLERANCE}）")
+    parser.add_argument("--json", action="store_true", help="輸出 JSON")
+    known, _ = parser.parse_known_args()
+    parser.set_defaults(**SCENARIOS.get(known.scenario, {}))
+    args = parser.parse_args()
+
+    # musicbot 在 import 時讀設定，所以要先設好環境變數再 import
+    tmp = tempfile.TemporaryDirectory()
+    os.environ["STATE_DB_PATH"] = args.state_db or os.path.join(tmp.name, "state.db")
+    os.environ["METRICS_PORT"] = "0"
+    os.environ["AUDIO_CACHE_DIR"] = ""
+    os.environ.pop("TRACK_CACHE_PATH", None)
+
+    import discord
+    import musicbot
+
+    random.seed(args.seed)
+    harness = Harness(args, musicbot, discord)
+    try:
+        result = asyncio.run(harness.run())
+    finally:
+        musicbot.state_store.close()
+        tmp.cleanup()
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
+
+    ok = True
+    if args.check:
+        ok = check_baseline(args.scenario, result, args)
+    if args.save_baseline:
+        save_baseline(args.scenario, result, args)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
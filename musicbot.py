@@ -1,13 +1,65 @@
 import os
+import sys
+import re
+import json
+import math
+import heapq
+import hashlib
+import time
+import random
+import signal
+import sqlite3
 import asyncio
+import tempfile
+import base64
+import bisect
+from array import array
+import cProfile
+import weakref
+import functools
+import threading
+import unicodedata
+import urllib.error
+import urllib.parse
+import urllib.request
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from contextvars import Context, ContextVar
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
-from typing import Dict, List, Optional
+from itertools import islice
+from queue import SimpleQueue
+from types import ModuleType
+from typing import TYPE_CHECKING, Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import discord
 from discord import app_commands
 from discord.ext import commands
 from dotenv import load_dotenv
-import yt_dlp
+
+if TYPE_CHECKING:
+    import yt_dlp  # 實際用到時才由 load_yt_dlp() 載入
+
+# ============================================================
+# 啟動計時：各階段耗時，第一次 on_ready 時印出來（也會出現在監控指標）
+# ============================================================
+class StartupTimer:
+    def __init__(self):
+        self.t0 = self.last = time.perf_counter()
+        self.phases: List[Tuple[str, float]] = []
+
+    def mark(self, name: str):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def summary(self) -> str:
+        steps = " → ".join(f"{name} {sec:.2f}s" for name, sec in self.phases)
+        return f"⏱️ 啟動耗時 {self.last - self.t0:.2f}s（{steps}）"
+
+
+startup = StartupTimer()
+
 
 # ============================================================
 # 讀取環境變數
@@ -26,7 +78,28 @@ intents.message_content = True
 intents.voice_states = True
 intents.guilds = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+# 叢集模式：launcher（CLUSTER_WORKERS > 1）啟動多個 worker 程序，
+# 每個 worker 用 AutoShardedBot 只連自己那段 shard（SHARD_IDS），guild 狀態自然依 shard 分開
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0"))  # 0 = 不分 shard
+SHARD_IDS = [int(x) for x in os.getenv("SHARD_IDS", "").split(",") if x.strip()]
+CLUSTER_WORKER = int(os.getenv("CLUSTER_WORKER", "-1"))  # launcher 指定的 worker 編號；-1 = 不在叢集裡
+
+
+class MusicTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        # 指令和自動完成執行前先把這個 guild 的狀態載好，之後 get_state 都不會在 event loop 上讀資料庫
+        if interaction.guild_id is not None:
+            await load_state(interaction.guild_id)
+        return True
+
+
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(
+        command_prefix="!", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS or None,
+        tree_cls=MusicTree,
+    )
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents, tree_cls=MusicTree)
 tree = bot.tree
 
 # ============================================================
@@ -38,183 +111,3075 @@ YDL_OPTS_BASE = {
     "nocheckcertificate": True,
 }
 
+# 播放清單只抓清單本身，不逐首解析
+YDL_OPTS_FLAT = dict(YDL_OPTS_BASE, extract_flat="in_playlist")
+
+# 每個 YoutubeDL 實例用幾次就換新的
+YDL_MAX_USES = int(os.getenv("YDL_MAX_USES", "200"))
+
 FFMPEG_OPTS = {
     "before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
     "options": "-vn",
     "executable": FFMPEG_PATH,
 }
 
+# 播放模式：
+#   pcm  ffmpeg 解碼成 PCM → Python 調音量 → libopus 重新編碼（音量可即時調整）
+#   opus 用 FFmpegOpusAudio，來源本來就是 opus 時直接 copy，不解碼也不重新編碼；
+#        音量不是 100% 時才用 ffmpeg volume filter 轉碼（音量從下一首開始生效）
+#   mix  和 pcm 一樣解碼成 PCM，但交給 NumPy 混音引擎：響度平衡、換歌時交叉淡化（需要 numpy）
+PLAYBACK_MODE = os.getenv("PLAYBACK_MODE", "pcm").lower()
+np = None
+if PLAYBACK_MODE == "mix":
+    try:
+        import numpy as np  # 選用：其他模式不載入，省開機時間
+    except ImportError:
+        print("PLAYBACK_MODE=mix 需要 numpy，改用 pcm 模式")
+        PLAYBACK_MODE = "pcm"
+
+# 解析器（yt-dlp 查詢）執行緒數量與單次逾時秒數
+RESOLVER_WORKERS = int(os.getenv("RESOLVER_WORKERS", "4"))
+RESOLVE_TIMEOUT = float(os.getenv("RESOLVE_TIMEOUT", "30"))
+
+# Interaction token 15 分鐘後失效，之後 followup 也送不出去
+INTERACTION_TTL = 15 * 60
+
+# ============================================================
+# 監控指標（Prometheus 文字格式，設定 METRICS_PORT 才開 HTTP）
+# ============================================================
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _fmt_labels(names: Tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{v}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self.values: Dict[tuple, float] = {}
+        self.lock = threading.Lock()  # resolver / 寫入執行緒也會呼叫
+
+    def inc(self, *labels, n: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + n
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, v in list(self.values.items()):
+            lines.append(f"{self.name}{_fmt_labels(self.labels, labels)} {v}")
+        return lines
+
+
+class Gauge:
+    # 值在抓取時才由 fn 算出：回傳 {labels tuple: 值}
+    def __init__(self, name: str, help: str, fn: Callable[[], Dict[tuple, float]], labels: Tuple[str, ...] = ()):
+        self.name, self.help, self.fn, self.labels = name, help, fn, labels
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for labels, v in self.fn().items():
+            lines.append(f"{self.name}{_fmt_labels(self.labels, labels)} {v}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self.data: Dict[tuple, List[float]] = {}  # labels -> [各 bucket 次數..., 總和, 次數]
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            d = self.data.get(labels)
+            if d is None:
+                d = self.data[labels] = [0] * (len(self.buckets) + 2)
+            if i < len(self.buckets):
+                d[i] += 1
+            d[-2] += value
+            d[-1] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, *labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ("le",)
+        for labels, d in list(self.data.items()):
+            cum = 0
+            for b, n in zip(self.buckets, d):
+                cum += n
+                lines.append(f"{self.name}_bucket{_fmt_labels(names, labels + (b,))} {cum}")
+            lines.append(f"{self.name}_bucket{_fmt_labels(names, labels + ('+Inf',))} {d[-1]}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.labels, labels)} {d[-2]}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.labels, labels)} {d[-1]}")
+        return lines
+
+
+metrics: List[Any] = []
+
+
+def register(metric):
+    metrics.append(metric)
+    return metric
+
+
+RESOLVE_SECONDS = register(Histogram(
+    "musicbot_resolve_seconds", "yt-dlp 查詢耗時", ("op",)
+))
+FIRST_AUDIO_SECONDS = register(Histogram(
+    "musicbot_play_to_first_audio_seconds", "從 /play 到開始出聲的時間"
+))
+TRACK_GAP_SECONDS = register(Histogram(
+    "musicbot_track_gap_seconds", "上一首結束到下一首開始的空檔", buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10)
+))
+LOOP_LAG_SECONDS = register(Histogram(
+    "musicbot_event_loop_lag_seconds", "event loop 延遲", buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+))
+ERRORS = register(Counter("musicbot_errors_total", "錯誤次數", ("source",)))
+BROADCAST_ATTACH = register(Counter(
+    "musicbot_broadcast_attach_total", "共用解碼：新開 / 共用 / 落後改用獨立音源", ("result",)
+))
+COMMAND_SPAN_SECONDS = register(Histogram(
+    "musicbot_command_span_seconds", "指令各階段耗時", ("command", "span")
+))
+
+
+# ============================================================
+# 指令追蹤：每個指令 / UI callback 記錄 defer、ensure_voice、解析、followup 各花多久
+# ============================================================
+SLOW_COMMAND_SECONDS = float(os.getenv("SLOW_COMMAND_SECONDS", "3"))  # 超過就印出各階段
+
+
+class Trace:
+    __slots__ = ("name", "t0", "spans", "task")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.t0 = time.perf_counter()
+        self.spans: List[Tuple[str, float]] = []
+        self.task = asyncio.current_task()
+
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+
+
+@contextmanager
+def span(name: str):
+    # 不在追蹤中的呼叫什麼都不記；指令裡建立的背景工作（播放器、預取…）會繼承 context，
+    # 所以只認建立追蹤的那個 task
+    trace = current_trace.get()
+    if trace is None or trace.task is not asyncio.current_task():
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        trace.spans.append((name, elapsed))
+        COMMAND_SPAN_SECONDS.observe(elapsed, trace.name, name)
+
+
+def traced(name: Optional[str] = None):
+    def decorator(fn):
+        label = name or fn.__name__.replace("_cmd", "")
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            trace = Trace(label)
+            token = current_trace.set(trace)
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                current_trace.reset(token)
+                total = time.perf_counter() - trace.t0
+                COMMAND_SPAN_SECONDS.observe(total, label, "total")
+                if total >= SLOW_COMMAND_SECONDS:
+                    parts = ", ".join(f"{n}={t * 1000:.0f}ms" for n, t in trace.spans)
+                    print(f"🐢 慢指令 /{label}：{total * 1000:.0f}ms（{parts}）")
+
+        return wrapper
+
+    return decorator
+
 # ============================================================
 # 狀態儲存（依 guild 分開）
 # ============================================================
-Track = Dict[str, Optional[str]]
+HISTORY_SIZE = 50  # 每個 guild 保留最近幾首播放紀錄
+
+
+class Track:
+    # 用 __slots__ 的精簡紀錄取代 dict，duration 直接存秒數
+    # flat=True 表示只有播放清單給的網址 / 標題，還沒補齊完整資訊
+    __slots__ = ("webpage_url", "title", "duration", "thumbnail", "uploader", "flat")
+
+    def __init__(
+        self,
+        webpage_url: Optional[str],
+        title: str = "未知標題",
+        duration: int = 0,
+        thumbnail: Optional[str] = None,
+        uploader: Optional[str] = None,
+        flat: bool = False,
+    ):
+        self.webpage_url = webpage_url
+        self.title = title
+        self.duration = duration
+        self.thumbnail = thumbnail
+        self.uploader = uploader
+        self.flat = flat
+
+    @classmethod
+    def from_info(cls, info: dict, flat: bool = False) -> "Track":
+        # flat=True：extract_flat 的播放清單項目，網址放在 "url"
+        if flat:
+            url = info.get("url") or info.get("webpage_url")
+        else:
+            url = info.get("webpage_url") or info.get("url")
+        return cls(
+            url,
+            info.get("title") or "未知標題",
+            int(info.get("duration") or 0),
+            info.get("thumbnail"),
+            info.get("uploader"),
+            flat,
+        )
+
+    def update_from(self, other: "Track"):
+        # 原地更新（佇列裡的同一個物件），不換成快取裡共用的那份
+        self.webpage_url = other.webpage_url or self.webpage_url
+        self.title = other.title
+        self.duration = other.duration
+        self.thumbnail = other.thumbnail
+        self.uploader = other.uploader
+        self.flat = False
+
+    def to_dict(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "Track":
+        return cls(**{k: d.get(k) for k in cls.__slots__ if d.get(k) is not None})
+
+
+class TrackQueue:
+    # deque：popleft O(1)；另外支援插入、移動、移除、隨機排序。
+    # 總長度和「長度未知」的首數跟著每次增減一起維護，/queue 的標題不用掃整個佇列
+    __slots__ = ("_items", "_duration", "_unknown")
+
+    def __init__(self, tracks: Iterable[Track] = ()):
+        self._items: Deque[Track] = deque()
+        self._duration = 0
+        self._unknown = 0
+        self.extend(tracks)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __bool__(self) -> bool:
+        return bool(self._items)
+
+    def __iter__(self) -> Iterator[Track]:
+        return iter(self._items)
+
+    @property
+    def duration(self) -> int:
+        return self._duration
+
+    @property
+    def unknown(self) -> int:
+        return self._unknown
+
+    def _count(self, track: Track, sign: int):
+        self._duration += sign * track.duration
+        if not track.duration:
+            self._unknown += sign
+
+    def append(self, track: Track):
+        self._items.append(track)
+        self._count(track, 1)
+
+    def extend(self, tracks: Iterable[Track]):
+        for track in tracks:
+            self.append(track)
+
+    def popleft(self) -> Track:
+        track = self._items.popleft()
+        self._count(track, -1)
+        return track
+
+    def peek(self, n: int) -> List[Track]:
+        return list(islice(self._items, n))
+
+    def page(self, start: int, n: int) -> List[Track]:
+        return list(islice(self._items, start, start + n))
+
+    def insert(self, index: int, track: Track):
+        self._items.insert(index, track)
+        self._count(track, 1)
+
+    def remove(self, index: int) -> Track:
+        track = self._items[index]
+        del self._items[index]
+        self._count(track, -1)
+        return track
+
+    def retime(self, track: Track, old_duration: int):
+        # 佇列裡的 Track 被原地改了長度（背景補資訊）時呼叫；不在佇列裡就不用管
+        n = self._items.count(track)
+        self._duration += n * (track.duration - old_duration)
+        self._unknown += n * ((not track.duration) - (not old_duration))
+
+    def move(self, src: int, dst: int):
+        self.insert(dst, self.remove(src))
+
+    def shuffle(self):
+        items = list(self._items)
+        random.shuffle(items)
+        self._items = deque(items)
+
+    def clear(self):
+        self._items.clear()
+        self._duration = 0
+        self._unknown = 0
+
+
+class HistoryRing:
+    # 固定大小的環狀緩衝區；第一次寫入時才配置
+    __slots__ = ("_buf", "_size", "_next", "_count")
+
+    def __init__(self, size: int):
+        self._buf: Optional[List[Optional[Track]]] = None
+        self._size = size
+        self._next = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, track: Track):
+        if self._buf is None:
+            self._buf = [None] * self._size
+        self._buf[self._next] = track
+        self._next = (self._next + 1) % self._size
+        self._count = min(self._count + 1, self._size)
+
+    def recent(self, n: int) -> List[Track]:
+        # 由舊到新回傳最後 n 首
+        n = min(n, self._count)
+        if not n or self._buf is None:
+            return []
+        return [self._buf[(self._next - n + i) % self._size] for i in range(n)]  # type: ignore
+
+    def __iter__(self) -> Iterator[Track]:
+        return iter(self.recent(self._count))
+
+
+PLAY_DECAY_HALF_LIFE = float(os.getenv("PLAY_DECAY_HALF_LIFE_DAYS", "30")) * 86400
+PLAY_DECAY_RATE = math.log(2) / PLAY_DECAY_HALF_LIFE
+TOP_K = 10
+FENWICK_MAX_EXP = 600.0  # 權重 exp(x) 的 x 超過這個就重設基準，避免 float 溢位
+
+
+# 還沒播過歌的 guild 共用的空欄位（第一次播放時才換成自己的 array）
+EMPTY_COUNTS = array("I")
+EMPTY_FLOATS = array("d")
+
+
+def logaddexp(a: float, b: float) -> float:
+    if a < b:
+        a, b = b, a
+    return a + math.log1p(math.exp(b - a))
+
+
+class PlayEntry:
+    # 單首歌統計的唯讀快照；PlayStats 本身用欄位陣列存，不替每首歌保留物件
+    __slots__ = ("url", "title", "count", "log_score", "last_played")
+
+    def __init__(self, url: str, title: str, count: int, log_score: float, last_played: float):
+        self.url = url
+        self.title = title
+        self.count = count
+        self.log_score = log_score
+        self.last_played = last_played
+
+
+class PlayStats:
+    # 以 webpage_url 為 key 的播放統計，分數隨時間衰減（半衰期 PLAY_DECAY_HALF_LIFE）。
+    # 在時間 t 的一次播放，到 now 的貢獻是 exp(-λ(now - t))；所有歌衰減的比例都一樣，
+    # 所以只存 log_score = log Σ exp(λ·t_i)，排名和抽樣比例只有在「播放」時才會變：
+    #   - top：只維護前 TOP_K 名，播放時只調整那一首（其他歌分數沒變，不會擠進來）
+    #   - 推薦：Fenwick tree 存權重 exp(log_score - base)，更新和加權抽樣都是 O(log n)
+    # 記憶體：每首歌只佔 index 的一格加上各欄位 array 的幾個 byte；第一次播放時才配置
+    __slots__ = ("index", "urls", "titles", "counts", "log_scores", "last_played", "tree", "base", "ranked")
+
+    def __init__(self):
+        self.index: Optional[Dict[str, int]] = None  # url -> 位置（Fenwick tree 的第 i + 1 格）
+        self.urls: List[str] = []
+        self.titles: List[str] = []
+        self.counts = EMPTY_COUNTS
+        self.log_scores = EMPTY_FLOATS
+        self.last_played = EMPTY_FLOATS
+        self.tree = EMPTY_FLOATS  # 1-indexed
+        self.base: Optional[float] = None
+        self.ranked: List[int] = []  # 前 TOP_K 名的位置，分數由高到低
+
+    def __len__(self) -> int:
+        return len(self.index) if self.index is not None else 0
+
+    def __bool__(self) -> bool:
+        return bool(self.index)
+
+    def __iter__(self) -> Iterator[PlayEntry]:
+        return (self._at(i) for i in range(len(self)))
+
+    @property
+    def top(self) -> List[PlayEntry]:
+        return [self._at(i) for i in self.ranked]
+
+    def get(self, url: Optional[str]) -> Optional[PlayEntry]:
+        i = self.index.get(url) if self.index is not None and url else None  # type: ignore
+        return None if i is None else self._at(i)
+
+    def record(self, track: Track, t: Optional[float] = None) -> PlayEntry:
+        t = time.time() if t is None else t
+        i = self._slot(track.webpage_url, track.title)  # type: ignore
+        self.titles[i] = track.title  # 影片改名就用最新的標題
+        self.counts[i] += 1
+        self.log_scores[i] = logaddexp(self.log_scores[i], PLAY_DECAY_RATE * t)
+        self.last_played[i] = t
+        self._update(i)
+        return self._at(i)
+
+    def load(self, url: str, title: str, count: int, log_score: float, last_played: float):
+        i = self._slot(url, title)
+        self.counts[i], self.log_scores[i], self.last_played[i] = count, log_score, last_played
+        self._update(i)
+
+    def score(self, entry: PlayEntry, now: Optional[float] = None) -> float:
+        # 衰減後的「等效播放次數」
+        now = time.time() if now is None else now
+        return math.exp(entry.log_score - PLAY_DECAY_RATE * now)
+
+    def sample(self) -> Optional[PlayEntry]:
+        n = len(self)
+        total = self._prefix(n)
+        if not n or total <= 0:
+            return None
+        r = random.random() * total
+        pos, step = 0, 1 << n.bit_length()
+        while step:
+            nxt = pos + step
+            if nxt <= n and self.tree[nxt] <= r:
+                pos = nxt
+                r -= self.tree[nxt]
+            step >>= 1
+        return self._at(min(pos, n - 1))
+
+    # ---------- 內部 ----------
+    def _at(self, i: int) -> PlayEntry:
+        return PlayEntry(self.urls[i], self.titles[i], self.counts[i], self.log_scores[i], self.last_played[i])
+
+    def _slot(self, url: str, title: str) -> int:
+        if self.index is None:
+            self.index = {}
+            self.counts = array("I")
+            self.log_scores = array("d")
+            self.last_played = array("d")
+            self.tree = array("d", (0.0,))
+        i = self.index.get(url)
+        if i is None:
+            i = self.index[url] = len(self.urls)
+            self.urls.append(url)
+            self.titles.append(title)
+            self.counts.append(0)
+            self.log_scores.append(-math.inf)
+            self.last_played.append(0.0)
+            # Fenwick tree 末端加一格：tree[n] = 區間 (n - lowbit(n), n] 的和，新格權重先是 0
+            n = i + 1
+            self.tree.append(self._prefix(n - 1) - self._prefix(n - (n & -n)))
+        return i
+
+    def _weight(self, i: int) -> float:
+        log_score = self.log_scores[i]
+        if log_score == -math.inf:
+            return 0.0
+        return math.exp(log_score - self.base)  # type: ignore
+
+    def _update(self, i: int):
+        log_score = self.log_scores[i]
+        if self.base is None or log_score - self.base > FENWICK_MAX_EXP:
+            self.base = log_score
+            self._rebuild()
+        else:
+            j = i + 1
+            delta = self._weight(i) - (self._prefix(j) - self._prefix(j - 1))
+            while j < len(self.tree):
+                self.tree[j] += delta
+                j += j & -j
+        self._update_top(i)
+
+    def _rebuild(self):
+        n = len(self.urls)
+        tree = self.tree = array("d", bytes(8 * (n + 1)))
+        for i in range(1, n + 1):
+            tree[i] += self._weight(i - 1)
+            j = i + (i & -i)
+            if j <= n:
+                tree[j] += tree[i]
+
+    def _prefix(self, i: int) -> float:
+        total = 0.0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def _update_top(self, i: int):
+        ranked = self.ranked
+        if i in ranked:
+            ranked.remove(i)
+        elif len(ranked) >= TOP_K and self.log_scores[i] <= self.log_scores[ranked[-1]]:
+            return
+        bisect.insort(ranked, i, key=lambda j: -self.log_scores[j])
+        del ranked[TOP_K:]
+
+
+class GuildState:
+    __slots__ = (
+        "queue", "now_playing", "loop", "started_at", "volume",
+        "last_active", "history", "play_stats",
+    )
+
+    def __init__(self):
+        self.queue = TrackQueue()
+        self.now_playing: Optional[Track] = None
+        self.loop = False                          # 是否單曲循環
+        self.started_at: Optional[datetime] = None
+        self.volume = 1.0                          # 0.0 ~ 2.0
+        self.last_active: Optional[datetime] = None
+        self.history = HistoryRing(HISTORY_SIZE)   # 最近播放
+        self.play_stats = PlayStats()              # webpage_url -> 播放次數 / 衰減分數
+
+    def reset_playback(self):
+        self.queue.clear()
+        self.now_playing = None
+        self.loop = False
+        self.started_at = None
+
+
+guild_states: Dict[int, GuildState] = {}
 
-queues: Dict[int, List[Track]] = {}          # guild_id -> [track, ...]
-now_playing: Dict[int, Optional[Track]] = {} # guild_id -> track
-loop_flags: Dict[int, bool] = {}             # guild_id -> 是否單曲循環
-start_times: Dict[int, Optional[datetime]] = {}
-volume_settings: Dict[int, float] = {}       # 0.0 ~ 2.0，預設 1.0
-last_active: Dict[int, datetime] = {}        # 最後活躍時間
 
-# 播放歷史 & 次數統計
-history: Dict[int, List[Track]] = {}         # guild_id -> 最近播放列表
-play_counts: Dict[int, Dict[str, int]] = {}  # guild_id -> title -> count
+state_loads: Dict[int, asyncio.Task] = {}  # 載入中的 guild（同時多個指令只讀一次）
+
+
+async def load_state(guild_id: int) -> GuildState:
+    # 第一次用到某個 guild 時才從資料庫載入，開機時間不會隨 guild 數量增加；
+    # 查詢和 JSON 解析在讀取執行緒上做，指令執行前由 MusicTree.interaction_check 呼叫
+    state = guild_states.get(guild_id)
+    if state is not None:
+        return state
+    task = state_loads.get(guild_id)
+    if task is None:
+        task = state_loads[guild_id] = asyncio.get_running_loop().create_task(state_store.load(guild_id))
+        task.add_done_callback(lambda t: state_loads.pop(guild_id, None))
+    loaded = await asyncio.shield(task)
+    return guild_states.setdefault(guild_id, loaded)
+
+
+def get_state(guild_id: int) -> GuildState:
+    state = guild_states.get(guild_id)
+    if state is None:
+        # 正常流程都已經 await load_state 過；沒有的話（例如直接呼叫指令的測試）才同步讀
+        state = guild_states[guild_id] = state_store.read(guild_id)
+    return state
+
+
+# ============================================================
+# 狀態持久化：SQLite（WAL）+ 背景批次寫入
+# ============================================================
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "musicbot_state.db")  # 設成空字串就不存
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "0.3"))
+
+# (guild_id, volume, loop, now_playing, queue, history)
+StateSnapshot = Tuple[int, float, bool, Optional[Track], Tuple[Track, ...], Tuple[Track, ...]]
+# (title, 新增次數, log_score, last_played)
+PlayDelta = Tuple[str, int, float, float]
+
+
+class StateStore:
+    # event loop 上只記錄「哪些 guild 變了」；每 STATE_FLUSH_INTERVAL 秒把變動合併成一批，
+    # 交給寫入執行緒做 JSON 序列化和 SQLite 寫入。讀取（還原 guild）在另一個讀取執行緒上做。
+    # import 時不碰檔案，啟動時（setup_hook）才 open()
+    def __init__(self, path: Optional[str], interval: float):
+        self.path = path
+        self.interval = interval
+        self.dirty: set = set()
+        self.play_deltas: Dict[int, Dict[str, PlayDelta]] = {}
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        self.batches: SimpleQueue = SimpleQueue()
+        self.reader: Optional[sqlite3.Connection] = None
+        self.reads: Optional[ThreadPoolExecutor] = None
+        self.writer: Optional[threading.Thread] = None
+
+    def open(self):
+        if not self.path or self.writer is not None:
+            return
+        conn = self._connect()
+        conn.executescript(
+            "CREATE TABLE IF NOT EXISTS guilds ("
+            " guild_id INTEGER PRIMARY KEY, volume REAL NOT NULL, loop INTEGER NOT NULL,"
+            " now_playing TEXT, queue TEXT NOT NULL, history TEXT NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS play_stats ("
+            " guild_id INTEGER NOT NULL, url TEXT NOT NULL, title TEXT NOT NULL, count INTEGER NOT NULL,"
+            " log_score REAL NOT NULL, last_played REAL NOT NULL, PRIMARY KEY (guild_id, url));"
+        )
+        conn.commit()
+        self.reader = conn
+        self.reads = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-reader")
+        self.writer = threading.Thread(target=self._write_loop, name="state-writer", daemon=True)
+        self.writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)  # type: ignore
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # ---------- 讀取（第一次用到 guild 時） ----------
+    async def load(self, guild_id: int) -> GuildState:
+        if self.reads is None:
+            return GuildState()
+        return await asyncio.get_running_loop().run_in_executor(self.reads, self.read, guild_id)
+
+    def read(self, guild_id: int) -> GuildState:
+        state = GuildState()
+        if self.reader is None:
+            return state
+        row = self.reader.execute(
+            "SELECT volume, loop, now_playing, queue, history FROM guilds WHERE guild_id = ?",
+            (guild_id,),
+        ).fetchone()
+        if row is not None:
+            volume, loop, now_playing, q, h = row
+            state.volume = volume
+            state.loop = bool(loop)
+            # 重啟前正在播的那首放回佇列最前面
+            if now_playing:
+                state.queue.append(Track.from_dict(json.loads(now_playing)))
+            state.queue.extend(Track.from_dict(d) for d in json.loads(q))
+            for d in json.loads(h):
+                state.history.append(Track.from_dict(d))
+        stats = state.play_stats
+        for url, title, count, log_score, last_played in self.reader.execute(
+            "SELECT url, title, count, log_score, last_played FROM play_stats WHERE guild_id = ?",
+            (guild_id,),
+        ):
+            stats.load(url, title, count, log_score, last_played)
+        return state
+
+    # ---------- 記錄變動（event loop 上呼叫，很便宜） ----------
+    def mark(self, guild_id: int):
+        if self.writer is None:
+            return
+        self.dirty.add(guild_id)
+        self._schedule()
+
+    def count_play(self, guild_id: int, entry: PlayEntry):
+        if self.writer is None:
+            return
+        deltas = self.play_deltas.setdefault(guild_id, {})
+        prev = deltas.get(entry.url)
+        n = prev[1] + 1 if prev else 1
+        deltas[entry.url] = (entry.title, n, entry.log_score, entry.last_played)
+        self._schedule()
+
+    def _schedule(self):
+        if self.flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self.flush_handle = loop.call_later(self.interval, self.flush)
+
+    def _snapshot(self) -> Tuple[List[StateSnapshot], Dict[int, Dict[str, PlayDelta]]]:
+        rows = []
+        for guild_id in self.dirty:
+            state = guild_states.get(guild_id)
+            if state is None:
+                continue
+            rows.append((
+                guild_id, state.volume, state.loop, state.now_playing,
+                tuple(state.queue), tuple(state.history),
+            ))
+        deltas = self.play_deltas
+        self.dirty = set()
+        self.play_deltas = {}
+        return rows, deltas
+
+    def flush(self):
+        self.flush_handle = None
+        rows, deltas = self._snapshot()
+        if rows or deltas:
+            self.batches.put((rows, deltas))
+
+    def close(self):
+        # 關機時把剩下的變動寫完
+        if self.writer is None:
+            return
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+        self.flush()
+        self.batches.put(None)
+        self.writer.join(timeout=10)
+        self.reads.shutdown()  # type: ignore
+        self.reader.close()  # type: ignore
+
+    # ---------- 寫入執行緒 ----------
+    def _write_loop(self):
+        conn = self._connect()
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                break
+            try:
+                self._write(conn, *batch)
+            except Exception as e:
+                print("狀態寫入失敗:", e)
+                ERRORS.inc("state_store")
+        conn.close()
+
+    def _write(
+        self,
+        conn: sqlite3.Connection,
+        rows: List[StateSnapshot],
+        deltas: Dict[int, Dict[str, PlayDelta]],
+    ):
+        def dump(tracks) -> str:
+            return json.dumps([t.to_dict() for t in tracks], ensure_ascii=False)
+
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO guilds VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        gid, volume, int(loop),
+                        json.dumps(playing.to_dict(), ensure_ascii=False) if playing else None,
+                        dump(q), dump(h),
+                    )
+                    for gid, volume, loop, playing, q, h in rows
+                ],
+            )
+            # count 是這一批新增的次數；log_score 已經含全部歷史，直接覆蓋
+            conn.executemany(
+                "INSERT INTO play_stats VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (guild_id, url) DO UPDATE SET title = excluded.title,"
+                " count = count + excluded.count, log_score = excluded.log_score,"
+                " last_played = excluded.last_played",
+                [
+                    (gid, url, title, n, log_score, last_played)
+                    for gid, d in deltas.items()
+                    for url, (title, n, log_score, last_played) in d.items()
+                ],
+            )
+
+
+state_store = StateStore(STATE_DB_PATH, STATE_FLUSH_INTERVAL)
 
 
 # ============================================================
 # 小工具：更新最後活躍時間
 # ============================================================
 def touch_active(guild_id: int):
-    last_active[guild_id] = datetime.now(timezone.utc)
+    get_state(guild_id).last_active = datetime.now(timezone.utc)
+    idle_scheduler.reschedule(guild_id)
+
+
+# ============================================================
+# Spotify 連結轉換：單曲 / 專輯 / 歌單 → YouTube 歌曲
+# ============================================================
+# metadata 來源依序：SPOTIFY_FIXTURE（本機 JSON，測試用）→ Web API（client credentials）→ oEmbed（只支援單曲、只有歌名）
+SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
+SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
+SPOTIFY_FIXTURE = os.getenv("SPOTIFY_FIXTURE")
+SPOTIFY_CONCURRENCY = int(os.getenv("SPOTIFY_CONCURRENCY", "4"))  # 每次轉換同時搜尋幾首
+SPOTIFY_INDEX_PATH = os.getenv("SPOTIFY_INDEX_PATH", STATE_DB_PATH)  # 對照表，預設和狀態放同一個檔
+SPOTIFY_INDEX_MEM_MAX = 10000  # 沒有檔案時只記在記憶體
+SPOTIFY_HTTP_TIMEOUT = 10
+SPOTIFY_API = "https://api.spotify.com/v1"
+
+SPOTIFY_LINK_RE = re.compile(
+    r"(?:open\.spotify\.com/(?:intl-[\w-]+/)?|spotify:)(track|album|playlist)[/:]([A-Za-z0-9]{22})"
+)
+
+
+def parse_spotify(query: str) -> Optional[Tuple[str, str]]:
+    # 回傳 (種類, ID)；不是 Spotify 連結就回傳 None
+    m = SPOTIFY_LINK_RE.search(query)
+    return (m.group(1), m.group(2)) if m else None
+
+
+class SpotifyTrack:
+    __slots__ = ("id", "name", "artists", "duration")
+
+    def __init__(self, id: str, name: str, artists: List[str], duration: int = 0):
+        self.id = id
+        self.name = name
+        self.artists = artists
+        self.duration = duration
+
+    @property
+    def query(self) -> str:
+        # 拿來在 YouTube 搜尋的關鍵字
+        if not self.artists:
+            return self.name
+        return f"{' '.join(self.artists)} - {self.name}"
+
+
+def _spotify_http(req: urllib.request.Request) -> dict:
+    with urllib.request.urlopen(req, timeout=SPOTIFY_HTTP_TIMEOUT) as resp:
+        return json.load(resp)
+
+
+# 每個來源都提供 open(種類, ID) -> (標題, SpotifyTrack 的 iterator)；iterator 讀到哪才抓到哪一頁。
+# 都在 resolver thread 裡呼叫（阻塞）。
+class SpotifyWebAPI:
+    def __init__(self, client_id: str, client_secret: str):
+        self.auth = base64.b64encode(f"{client_id}:{client_secret}".encode("utf-8")).decode("ascii")
+        self.token: Optional[str] = None
+        self.expires = 0.0
+        self.lock = threading.Lock()
+
+    def _token(self) -> str:
+        with self.lock:
+            if self.token is None or time.time() >= self.expires:
+                req = urllib.request.Request(
+                    "https://accounts.spotify.com/api/token",
+                    data=b"grant_type=client_credentials",
+                    headers={"Authorization": f"Basic {self.auth}"},
+                )
+                data = _spotify_http(req)
+                self.token = data["access_token"]
+                self.expires = time.time() + data.get("expires_in", 3600) - 60
+            return self.token
+
+    def _get(self, url: str) -> dict:
+        for attempt in range(3):
+            req = urllib.request.Request(url, headers={"Authorization": f"Bearer {self._token()}"})
+            try:
+                return _spotify_http(req)
+            except urllib.error.HTTPError as e:
+                if attempt == 2:
+                    raise
+                if e.code == 429:
+                    time.sleep(min(float(e.headers.get("Retry-After") or 1), 10))
+                elif e.code == 401:
+                    self.token = None  # token 提早失效
+                else:
+                    raise
+        raise RuntimeError("unreachable")
+
+    @staticmethod
+    def _track(item: Optional[dict]) -> Optional[SpotifyTrack]:
+        # 歌單裡的本機檔案、Podcast 單集沒有可用的 ID，略過
+        if not item or not item.get("id") or item.get("type", "track") != "track":
+            return None
+        return SpotifyTrack(
+            item["id"], item.get("name") or "",
+            [a["name"] for a in item.get("artists") or () if a.get("name")],
+            int(item.get("duration_ms") or 0) // 1000,
+        )
+
+    def _pages(self, page: dict, wrapped: bool) -> Iterator[SpotifyTrack]:
+        while True:
+            for item in page.get("items") or ():
+                track = self._track(item.get("track") if wrapped else item)
+                if track is not None:
+                    yield track
+            if not page.get("next"):
+                return
+            page = self._get(page["next"])
+
+    def open(self, kind: str, sid: str) -> Tuple[Optional[str], Iterator[SpotifyTrack]]:
+        if kind == "track":
+            track = self._track(self._get(f"{SPOTIFY_API}/tracks/{sid}"))
+            return None, iter([track] if track else [])
+        if kind == "album":
+            album = self._get(f"{SPOTIFY_API}/albums/{sid}")
+            return album.get("name"), self._pages(album["tracks"], wrapped=False)
+        playlist = self._get(f"{SPOTIFY_API}/playlists/{sid}?fields=name,tracks(next,items(track(id,type,name,duration_ms,artists(name))))")
+        return playlist.get("name"), self._pages(playlist["tracks"], wrapped=True)
+
+
+class SpotifyFixture:
+    # 本機 JSON 取代 Web API：
+    #   {"tracks": {ID: {"name", "artists": [...], "duration"}},
+    #    "albums": {ID: {"name", "tracks": [ID, ...]}}, "playlists": {ID: {"name", "tracks": [ID, ...]}}}
+    def __init__(self, path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            self.data = json.load(f)
+
+    def _track(self, sid: str) -> Optional[SpotifyTrack]:
+        t = self.data.get("tracks", {}).get(sid)
+        if t is None:
+            return None
+        return SpotifyTrack(sid, t["name"], list(t.get("artists", ())), int(t.get("duration", 0)))
+
+    def open(self, kind: str, sid: str) -> Tuple[Optional[str], Iterator[SpotifyTrack]]:
+        if kind == "track":
+            track = self._track(sid)
+            return None, iter([track] if track else [])
+        entry = self.data.get(f"{kind}s", {}).get(sid)
+        if entry is None:
+            raise LookupError(f"找不到 Spotify {kind} {sid}")
+        tracks = (self._track(t) for t in entry.get("tracks", ()))
+        return entry.get("name"), (t for t in tracks if t is not None)
+
+
+class SpotifyOEmbed:
+    # 沒設定 API 金鑰時的退路：公開的 oEmbed 只給標題，專輯 / 歌單讀不到曲目
+    def open(self, kind: str, sid: str) -> Tuple[Optional[str], Iterator[SpotifyTrack]]:
+        if kind != "track":
+            raise RuntimeError("讀取 Spotify 專輯 / 歌單需要設定 SPOTIFY_CLIENT_ID 和 SPOTIFY_CLIENT_SECRET")
+        url = urllib.parse.quote(f"https://open.spotify.com/track/{sid}", safe="")
+        data = _spotify_http(urllib.request.Request(f"https://open.spotify.com/oembed?url={url}"))
+        return None, iter([SpotifyTrack(sid, data.get("title") or "", [])])
+
+
+def make_spotify_source() -> Any:
+    if SPOTIFY_FIXTURE:
+        return SpotifyFixture(SPOTIFY_FIXTURE)
+    if SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET:
+        return SpotifyWebAPI(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET)
+    return SpotifyOEmbed()
+
+
+spotify_source = make_spotify_source()
+
+
+class SpotifyIndex:
+    # Spotify 曲目 ID → 配對到的 YouTube 歌曲（存整個 Track），同一首再轉換時完全不用查詢。
+    # resolver thread 讀、executor 寫，用 lock 保護。和 StateStore 一樣啟動時才 open()
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.lock = threading.Lock()
+        self.mem: "OrderedDict[str, Track]" = OrderedDict()
+        self.db: Optional[sqlite3.Connection] = None
+
+    def open(self):
+        if not self.path or self.db is not None:
+            return
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS spotify_map ("
+            " spotify_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+        self.db.commit()
+
+    def get_many(self, ids: List[str]) -> Dict[str, Track]:
+        if not ids:
+            return {}
+        with self.lock:
+            if self.db is None:
+                return {sid: self.mem[sid] for sid in ids if sid in self.mem}
+            rows = self.db.execute(
+                f"SELECT spotify_id, data FROM spotify_map WHERE spotify_id IN ({','.join('?' * len(ids))})",
+                ids,
+            ).fetchall()
+        return {sid: Track.from_dict(json.loads(data)) for sid, data in rows}
+
+    def put_many(self, tracks: Dict[str, Track]):
+        with self.lock:
+            if self.db is None:
+                self.mem.update(tracks)
+                while len(self.mem) > SPOTIFY_INDEX_MEM_MAX:
+                    self.mem.popitem(last=False)
+                return
+            now = time.time()
+            try:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO spotify_map VALUES (?, ?, ?)",
+                    [(sid, json.dumps(t.to_dict(), ensure_ascii=False), now) for sid, t in tracks.items()],
+                )
+                self.db.commit()
+            except sqlite3.Error as e:
+                print("Spotify 對照表寫入失敗:", e)
+                ERRORS.inc("spotify_index")
+
+
+spotify_index = SpotifyIndex(SPOTIFY_INDEX_PATH)
+
+
+class SpotifyReader:
+    # 和 PlaylistReader 一樣一段一段讀，給 ingest_tracks 用：
+    # 每段先查對照表，沒對照過的才丟去 YouTube 搜尋（同時最多 SPOTIFY_CONCURRENCY 首）
+    def __init__(self, guild_id: int, kind: str, sid: str):
+        self.guild_id = guild_id
+        self.kind = kind
+        self.sid = sid
+        self.title: Optional[str] = None
+        self.items: Optional[Iterator[SpotifyTrack]] = None
+        self.sem = asyncio.Semaphore(SPOTIFY_CONCURRENCY)
+
+    def _open(self):
+        self.title, self.items = spotify_source.open(self.kind, self.sid)
+
+    async def open(self, timeout: Optional[float] = None) -> "SpotifyReader":
+        with RESOLVE_SECONDS.time("spotify"):
+            await resolver.run(self.guild_id, self._open, timeout=timeout)
+        return self
+
+    def _next(self, n: int) -> Tuple[List[SpotifyTrack], Dict[str, Track]]:
+        items = list(islice(self.items, n)) if self.items is not None else []
+        return items, spotify_index.get_many([t.id for t in items])
+
+    async def _match(self, item: SpotifyTrack, timeout: Optional[float]) -> Optional[Track]:
+        async with self.sem:
+            try:
+                return await track_cache.get(self.guild_id, item.query, timeout=timeout)
+            except Exception as e:
+                print(f"找不到 Spotify 歌曲 {item.query}:", e)
+                ERRORS.inc("spotify_match")
+                return None
+
+    async def read(self, n: int, timeout: Optional[float] = None) -> List[Track]:
+        # 整段都配對失敗就接著讀下一段，回傳空 list 只代表讀完了
+        while True:
+            items, known = await resolver.run(self.guild_id, self._next, n, timeout=timeout)
+            if not items:
+                return []
+            missing = [t for t in items if t.id not in known]
+            matched = await asyncio.gather(*(self._match(t, timeout) for t in missing))
+            found = {t.id: track for t, track in zip(missing, matched) if track is not None}
+            if found:
+                try:
+                    await asyncio.get_running_loop().run_in_executor(None, spotify_index.put_many, found)
+                except Exception as e:
+                    print("Spotify 對照表寫入失敗:", e)
+                    ERRORS.inc("spotify_index")
+            tracks = [known.get(t.id) or found.get(t.id) for t in items]
+            tracks = [t for t in tracks if t is not None]
+            if tracks:
+                return tracks  # type: ignore
+
+
+async def resolve_spotify_track(guild_id: int, sid: str, timeout: Optional[float] = None) -> Track:
+    reader = await SpotifyReader(guild_id, "track", sid).open(timeout=timeout)
+    tracks = await reader.read(1, timeout=timeout)
+    if not tracks:
+        raise LookupError("在 YouTube 上找不到這首 Spotify 歌曲")
+    return tracks[0]
+
+
+# ============================================================
+# 小工具：判斷是不是網址
+# ============================================================
+def is_url(q: str) -> bool:
+    return q.startswith("http://") or q.startswith("https://")
 
 
 # ============================================================
-# 小工具：Spotify 連結轉 YouTube 搜尋
+# YoutubeDL 實例池：依選項分組重複使用，省去每次重建 extractor / cookie / HTTP session
 # ============================================================
-def maybe_convert_spotify_to_search(query: str) -> str:
-    if "open.spotify.com/track" not in query:
-        return query
-    # 簡化：直接用關鍵字搜尋，不實際連 Spotify API
-    # 讓使用者自行輸入歌名 / 複製歌名也可以
-    return query  # 這裡先不做實作，未來你要可以加 API
+# yt-dlp 的 import 和 extractor 清單很重，不在開機的關鍵路徑上載入：
+# 登入期間由背景 thread 預熱（YDLPool.warm），還沒熱好就被用到時在呼叫端的 thread 裡同步載入
+_yt_dlp: Optional[ModuleType] = None
+_yt_dlp_lock = threading.Lock()
+
+
+def load_yt_dlp() -> ModuleType:
+    global _yt_dlp
+    if _yt_dlp is None:
+        with _yt_dlp_lock:
+            if _yt_dlp is None:
+                import yt_dlp
+                _yt_dlp = yt_dlp
+    return _yt_dlp
+
+
+class YDLPool:
+    def __init__(self, opts: Dict[str, dict], max_uses: int):
+        self.opts = opts
+        self.max_uses = max_uses
+        self.lock = threading.Lock()
+        self.idle: Dict[str, List[Tuple["yt_dlp.YoutubeDL", int]]] = {k: [] for k in opts}
+        self.created = 0
+
+    def acquire(self, kind: str) -> Tuple["yt_dlp.YoutubeDL", int]:
+        # 同一個實例同時只會借給一個 worker
+        with self.lock:
+            if self.idle[kind]:
+                return self.idle[kind].pop()
+            self.created += 1
+        return load_yt_dlp().YoutubeDL(dict(self.opts[kind])), 0
+
+    def warm(self):
+        # 每種選項先建好一個實例放進池子（第一次建構時才會載入 extractor 清單）
+        for kind in self.opts:
+            entry = self.acquire(kind)
+            with self.lock:
+                self.idle[kind].append(entry)
+
+    def release(self, kind: str, entry: Tuple["yt_dlp.YoutubeDL", int], failed: bool = False):
+        ydl, uses = entry
+        uses += 1
+        if failed or uses >= self.max_uses:
+            # 出錯或用滿次數就丟掉，下次再建新的
+            ydl.close()
+            return
+        with self.lock:
+            self.idle[kind].append((ydl, uses))
+
+    @contextmanager
+    def borrow(self, kind: str = "base"):
+        entry = self.acquire(kind)
+        try:
+            yield entry[0]
+        except BaseException:
+            self.release(kind, entry, failed=True)
+            raise
+        self.release(kind, entry)
+
+
+ydl_pool = YDLPool({"base": YDL_OPTS_BASE, "flat": YDL_OPTS_FLAT}, YDL_MAX_USES)
 
 
 # ============================================================
 # 小工具：取得單首歌曲資訊（不下載）
 # ============================================================
 def get_track_info(query: str) -> Track:
-    q = maybe_convert_spotify_to_search(query)
-
     # 如果不是網址，就當成關鍵字搜尋
-    if not (q.startswith("http://") or q.startswith("https://")):
-        q = f"ytsearch1:{q}"
+    q = query if is_url(query) else f"ytsearch1:{query}"
 
-    ydl_opts = dict(YDL_OPTS_BASE)
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+    with RESOLVE_SECONDS.time("track_info"), ydl_pool.borrow() as ydl:
         info = ydl.extract_info(q, download=False)
 
     if "entries" in info:
         info = info["entries"][0]
 
-    return {
-        "webpage_url": info.get("webpage_url") or info.get("url"),
-        "title": info.get("title", "未知標題"),
-        "duration": str(info.get("duration") or 0),
-        "thumbnail": info.get("thumbnail"),
-        "uploader": info.get("uploader"),
-    }
+    return Track.from_info(info)
 
 
 # ============================================================
 # 小工具：從 URL 取得實際音訊串流 URL
 # ============================================================
 def get_audio_url(webpage_url: str) -> str:
-    with yt_dlp.YoutubeDL(YDL_OPTS_BASE) as ydl:
+    with RESOLVE_SECONDS.time("audio_url"), ydl_pool.borrow() as ydl:
         info = ydl.extract_info(webpage_url, download=False)
     return info["url"]
 
 
 # ============================================================
-# 核心：播放下一首
+# 小工具：搜尋多筆結果 / 讀取播放清單（阻塞，請透過 resolver 呼叫）
+# ============================================================
+def search_entries(keyword: str, n: int = 5) -> List[dict]:
+    with RESOLVE_SECONDS.time("search"), ydl_pool.borrow() as ydl:
+        info = ydl.extract_info(f"ytsearch{n}:{keyword}", download=False)
+    return (info.get("entries") or [])[:n]
+
+
+_END = object()
+
+
+class PlaylistReader:
+    # 在 resolver thread 裡一段一段讀播放清單：process=False 時 yt-dlp 的 entries 是 generator，
+    # 讀到哪裡才抓到哪一頁，不會一次把整份清單的 dict 都放在記憶體裡。
+    # 讀取期間獨佔一個 flat 的 YoutubeDL 實例，close() 時才還回池子。
+    def __init__(self, url: str):
+        self.url = url
+        self.lock = threading.Lock()
+        self.ydl: Optional[Tuple["yt_dlp.YoutubeDL", int]] = None
+        self.entries: Optional[Iterator[dict]] = None
+        self.title: Optional[str] = None
+
+    def open(self) -> "PlaylistReader":
+        with self.lock:
+            self.ydl = ydl_pool.acquire("flat")
+            try:
+                with RESOLVE_SECONDS.time("playlist"):
+                    info = self.ydl[0].extract_info(self.url, download=False, process=False)
+            except BaseException:
+                self._release(failed=True)
+                raise
+            self.title = info.get("title")
+            entries = info.get("entries")
+            # 不是播放清單（單一影片）就當成只有一首
+            self.entries = iter(entries) if entries is not None else iter([info])
+        return self
+
+    def read(self, n: int) -> List[Track]:
+        # 讀到 n 首或清單結束為止；清單讀完就提早歸還實例
+        tracks: List[Track] = []
+        with self.lock, RESOLVE_SECONDS.time("playlist_page"):
+            try:
+                while self.entries is not None and len(tracks) < n:
+                    e = next(self.entries, _END)
+                    if e is _END:
+                        self._release()
+                        break
+                    if not e:
+                        continue
+                    track = Track.from_info(e, flat=True)
+                    if track.webpage_url:
+                        tracks.append(track)
+            except BaseException:
+                self._release(failed=True)
+                raise
+        return tracks
+
+    def close(self):
+        with self.lock:
+            self._release()
+
+    def _release(self, failed: bool = False):
+        self.entries = None
+        if self.ydl is not None:
+            ydl_pool.release("flat", self.ydl, failed=failed)
+            self.ydl = None
+
+
+# ============================================================
+# 解析器：把 yt-dlp 的阻塞呼叫移到有上限的 thread pool
+# ============================================================
+class ResolveTimeout(Exception):
+    pass
+
+
+# (future, 函式, 參數)
+Job = Tuple[asyncio.Future, Callable[..., Any], tuple]
+
+
+class Resolver:
+    # 每個 guild 有自己的等待佇列，空出 worker 時依 guild 輪流（round-robin）取工作，
+    # 單一 guild 一次排 100 個查詢也不會讓其他 guild 餓死
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="resolver")
+        self.pending: "OrderedDict[int, Deque[Job]]" = OrderedDict()
+        self.running = 0
+        self.closed = False
+
+    async def run(self, guild_id: int, fn: Callable[..., Any], *args, timeout: Optional[float] = None):
+        if self.closed:
+            raise RuntimeError("resolver 已關閉")
+        loop = asyncio.get_running_loop()
+        fut: asyncio.Future = loop.create_future()
+        self.pending.setdefault(guild_id, deque()).append((fut, fn, args))
+        self._pump(loop)
+
+        if timeout is None:
+            timeout = RESOLVE_TIMEOUT
+        try:
+            # 逾時或呼叫端被取消時 fut 會一併取消：還在排隊的直接丟掉，
+            # 已在執行的結果會被忽略
+            with span("resolve"):
+                return await asyncio.wait_for(fut, timeout=max(timeout, 0.0))
+        except asyncio.TimeoutError:
+            raise ResolveTimeout(f"查詢逾時（{timeout:.0f} 秒）") from None
+
+    def _pump(self, loop: asyncio.AbstractEventLoop):
+        while not self.closed and self.running < self.workers and self.pending:
+            guild_id, jobs = next(iter(self.pending.items()))
+            fut, fn, args = jobs.popleft()
+            if jobs:
+                self.pending.move_to_end(guild_id)
+            else:
+                del self.pending[guild_id]
+
+            if fut.done():  # 已逾時或已取消
+                continue
+
+            self.running += 1
+            cf = self.executor.submit(fn, *args)
+            cf.add_done_callback(lambda cf, fut=fut: self._done(loop, fut, cf))
+
+    def _done(self, loop: asyncio.AbstractEventLoop, fut: asyncio.Future, cf):
+        # 在 resolver thread 裡執行；event loop 已經關了（程式結束中）就不用回報結果
+        if loop.is_closed():
+            return
+        try:
+            loop.call_soon_threadsafe(self._finish, loop, fut, cf)
+        except RuntimeError:  # 檢查完之後 loop 剛好關掉
+            pass
+
+    def _finish(self, loop: asyncio.AbstractEventLoop, fut: asyncio.Future, cf):
+        self.running -= 1
+        if not fut.done():
+            exc = cf.exception()
+            if exc is not None:
+                fut.set_exception(exc)
+            else:
+                fut.set_result(cf.result())
+        self._pump(loop)
+
+    async def close(self):
+        # 不再接新的查詢、丟掉還在排隊的，等執行中的做完再關 thread pool；要在 event loop 關掉前呼叫
+        self.closed = True
+        for jobs in self.pending.values():
+            for fut, _, _ in jobs:
+                fut.cancel()
+        self.pending.clear()
+        await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+
+
+resolver = Resolver(RESOLVER_WORKERS)
+
+
+def interaction_timeout(interaction: discord.Interaction) -> float:
+    # 查詢不能超過 interaction token 剩下的有效時間
+    age = (datetime.now(timezone.utc) - interaction.created_at).total_seconds()
+    return min(RESOLVE_TIMEOUT, INTERACTION_TTL - age)
+
+
+def normalize_query(query: str) -> str:
+    # 快取 key：網址原樣保留，關鍵字統一成 ytsearch1: + 小寫 + 合併空白
+    q = query.strip()
+    if is_url(q):
+        return q
+    if q.startswith("ytsearch1:"):
+        q = q[len("ytsearch1:"):]
+    return "ytsearch1:" + " ".join(q.split()).lower()
+
+
+# ============================================================
+# 歌曲資訊快取：記憶體 LRU + 選用的 SQLite 磁碟層 + 同查詢合併（single-flight）
 # ============================================================
-async def play_next(guild_id: int, vc: discord.VoiceClient):
-    if guild_id not in queues:
-        queues[guild_id] = []
-    if guild_id not in loop_flags:
-        loop_flags[guild_id] = False
+TRACK_CACHE_SIZE = int(os.getenv("TRACK_CACHE_SIZE", "2048"))
+TRACK_CACHE_TTL = float(os.getenv("TRACK_CACHE_TTL", str(6 * 3600)))
+TRACK_CACHE_PATH = os.getenv("TRACK_CACHE_PATH")  # 未設定就只用記憶體
+TRACK_CACHE_DISK_MAX = int(os.getenv("TRACK_CACHE_DISK_MAX", "50000"))
+TRACK_CACHE_TOUCH_BATCH = 256  # 磁碟命中的使用時間累積幾筆才寫回（平常跟著下一次寫入一起寫）
+
+
+class TrackCache:
+    def __init__(self, size: int, ttl: float, path: Optional[str], disk_max: int):
+        self.size = size
+        self.ttl = ttl
+        self.disk_max = disk_max
+        self.mem: "OrderedDict[str, Tuple[float, Track]]" = OrderedDict()  # key -> (到期時間, track)
+        self.inflight: Dict[str, asyncio.Task] = {}
+        self.waiters: Dict[str, int] = {}
+
+        # 統計
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.joined = 0  # 併入進行中查詢的次數
+
+        self.db: Optional[sqlite3.Connection] = None
+        self.db_lock = threading.Lock()
+        # 磁碟筆數的上限估計（INSERT OR REPLACE 蓋掉舊的也算一筆），超過 disk_max 才實際 COUNT
+        self.disk_rows = 0
+        self.touched: Dict[str, float] = {}  # 磁碟命中、還沒寫回的使用時間
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS track_cache ("
+                " key TEXT PRIMARY KEY, data TEXT NOT NULL,"
+                " expires REAL NOT NULL, used REAL NOT NULL)"
+            )
+            self.db.commit()
+            (self.disk_rows,) = self.db.execute("SELECT COUNT(*) FROM track_cache").fetchone()
+
+    # ---------- 記憶體層（只在 event loop 上呼叫） ----------
+    def get_mem(self, key: str) -> Optional[Track]:
+        entry = self.mem.get(key)
+        if entry is None:
+            return None
+        expires, track = entry
+        if expires < time.time():
+            del self.mem[key]
+            return None
+        self.mem.move_to_end(key)
+        return track
+
+    def put(self, track: Track, *keys: str):
+        expires = time.time() + self.ttl
+        for key in (*keys, track.webpage_url):
+            if not key:
+                continue
+            self.mem[key] = (expires, track)
+            self.mem.move_to_end(key)
+        while len(self.mem) > self.size:
+            self.mem.popitem(last=False)
+
+    # ---------- 磁碟層（只在 resolver thread 裡呼叫） ----------
+    def disk_get(self, key: str) -> Optional[Track]:
+        if self.db is None:
+            return None
+        now = time.time()
+        with self.db_lock:
+            row = self.db.execute(
+                "SELECT data FROM track_cache WHERE key = ? AND expires > ?", (key, now)
+            ).fetchone()
+            if row is None:
+                return None
+            self.touched[key] = now
+            if len(self.touched) >= TRACK_CACHE_TOUCH_BATCH:
+                self._write_touched()
+                self.db.commit()
+        return Track.from_dict(json.loads(row[0]))
+
+    def close(self):
+        # 結束前把還沒寫回的使用時間寫進去
+        if self.db is None:
+            return
+        with self.db_lock:
+            self._write_touched()
+            self.db.commit()
+
+    def _write_touched(self):
+        # 呼叫端要持有 db_lock
+        if self.touched:
+            self.db.executemany(  # type: ignore
+                "UPDATE track_cache SET used = ? WHERE key = ?", [(t, k) for k, t in self.touched.items()]
+            )
+            self.touched = {}
+
+    def disk_put(self, track: Track, *keys: str):
+        if self.db is None:
+            return
+        now = time.time()
+        data = json.dumps(track.to_dict(), ensure_ascii=False)
+        rows = [(k, data, now + self.ttl, now) for k in (*keys, track.webpage_url) if k]
+        with self.db_lock:
+            self._write_touched()
+            self.db.executemany("INSERT OR REPLACE INTO track_cache VALUES (?, ?, ?, ?)", rows)
+            self.disk_rows += len(rows)
+            if self.disk_rows > self.disk_max:
+                (count,) = self.db.execute("SELECT COUNT(*) FROM track_cache").fetchone()
+                if count > self.disk_max:
+                    # 先清過期的，再依最久沒用到的淘汰
+                    self.db.execute("DELETE FROM track_cache WHERE expires <= ?", (now,))
+                    self.db.execute(
+                        "DELETE FROM track_cache WHERE key IN ("
+                        " SELECT key FROM track_cache ORDER BY used LIMIT ?)",
+                        (max(0, count - self.disk_max),),
+                    )
+                    (count,) = self.db.execute("SELECT COUNT(*) FROM track_cache").fetchone()
+                self.disk_rows = count
+            self.db.commit()
+
+    def _load(self, key: str, query: str) -> Tuple[Track, bool]:
+        track = self.disk_get(key)
+        if track is not None:
+            return track, True
+        track = get_track_info(query)
+        self.disk_put(track, key)
+        return track, False
+
+    async def _fetch(self, guild_id: int, key: str, query: str) -> Track:
+        try:
+            track, from_disk = await resolver.run(guild_id, self._load, key, query)
+            if from_disk:
+                self.disk_hits += 1
+            else:
+                self.misses += 1
+            self.put(track, key)
+            return track
+        finally:
+            # 被取消時 get() 已經先移除了，這時 key 可能已經換成新的查詢
+            if self.inflight.get(key) is asyncio.current_task():
+                del self.inflight[key]
+
+    async def get(self, guild_id: int, query: str, timeout: Optional[float] = None) -> Track:
+        key = normalize_query(query)
+        track = self.get_mem(key)
+        if track is not None:
+            self.hits += 1
+            return track
+
+        task = self.inflight.get(key)
+        if task is None:
+            # 共用的查詢不屬於任何一個指令的追蹤
+            task = asyncio.get_running_loop().create_task(
+                self._fetch(guild_id, key, query), context=Context()
+            )
+            self.inflight[key] = task
+        else:
+            self.joined += 1
+
+        # 多個呼叫端共用同一個查詢；全部放棄（逾時/取消）時才取消它
+        if timeout is None:
+            timeout = RESOLVE_TIMEOUT
+        self.waiters[key] = self.waiters.get(key, 0) + 1
+        try:
+            with span("resolve"):
+                track = await asyncio.wait_for(asyncio.shield(task), timeout=max(timeout, 0.0))
+        except asyncio.TimeoutError:
+            raise ResolveTimeout(f"查詢逾時（{timeout:.0f} 秒）") from None
+        finally:
+            self.waiters[key] -= 1
+            if not self.waiters[key]:
+                del self.waiters[key]
+                if not task.done():
+                    # 馬上從 inflight 拿掉，之後來的呼叫端才不會併入已經取消的查詢
+                    if self.inflight.get(key) is task:
+                        del self.inflight[key]
+                    task.cancel()
+        return track
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "joined": self.joined,
+            "size": len(self.mem),
+        }
+
+
+track_cache = TrackCache(TRACK_CACHE_SIZE, TRACK_CACHE_TTL, TRACK_CACHE_PATH, TRACK_CACHE_DISK_MAX)
 
-    track: Optional[Track] = None
 
-    if loop_flags[guild_id] and now_playing.get(guild_id):
-        # 單曲循環：再播一次現在這首
-        track = now_playing[guild_id]
+async def resolve_track(guild_id: int, query: str, timeout: Optional[float] = None) -> Track:
+    # 自動完成選到的網址：索引裡已經有完整的歌曲資訊就不用再查，flat 的照樣走 track_cache
+    track = suggestions.known(guild_id, query)
+    if track is not None:
+        return track
+    link = parse_spotify(query)
+    if link is not None and link[0] == "track":
+        track = await resolve_spotify_track(guild_id, link[1], timeout=timeout)
     else:
-        if not queues[guild_id]:
-            now_playing[guild_id] = None
-            start_times[guild_id] = None
+        track = await track_cache.get(guild_id, query, timeout=timeout)
+    suggestions.note_resolved(track)
+    return track
+
+
+async def resolve_audio_url(guild_id: int, webpage_url: str, timeout: Optional[float] = None) -> str:
+    return await resolver.run(guild_id, get_audio_url, webpage_url, timeout=timeout)
+
+
+# ============================================================
+# 自動完成：/play、/search 的本機建議（不連網，一定在 3 秒期限內回應）
+# ============================================================
+SUGGEST_GLOBAL_MAX = int(os.getenv("SUGGEST_GLOBAL_MAX", "5000"))  # 最近查過 / 搜尋過的歌
+SUGGEST_LIMIT = 25         # Discord 一次最多 25 個選項
+SUGGEST_CANDIDATES = 500   # 每個索引最多驗證幾筆候選
+
+
+def title_words(text: str) -> List[str]:
+    return re.findall(r"\w+", unicodedata.normalize("NFKC", text).casefold())
+
+
+def bigrams(words: Iterable[str]) -> set:
+    return {w[i:i + 2] for w in words for i in range(len(w) - 1)}
+
+
+class SuggestIndex:
+    # 標題的 bigram 倒排索引：中日文標題沒有空白，用 bigram 才查得到詞的中間
+    def __init__(self, max_docs: int = 0):
+        self.max_docs = max_docs  # 0 = 不限
+        self.docs: "OrderedDict[str, Tuple[str, Track]]" = OrderedDict()  # url -> (正規化標題, track)
+        self.grams: Dict[str, set] = {}
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def get(self, url: str) -> Optional[Track]:
+        doc = self.docs.get(url)
+        return doc[1] if doc else None
+
+    def add(self, track: Track):
+        url = track.webpage_url
+        if not url:
+            return
+        old = self.docs.get(url)
+        if old is not None:
+            if old[1].title == track.title:
+                self.docs[url] = (old[0], track)
+                self.docs.move_to_end(url)
+                return
+            self.remove(url)
+        text = " ".join(title_words(track.title or ""))
+        self.docs[url] = (text, track)
+        for g in bigrams(text.split()):
+            self.grams.setdefault(g, set()).add(url)
+        if self.max_docs and len(self.docs) > self.max_docs:
+            self.remove(next(iter(self.docs)))
+
+    def remove(self, url: str):
+        doc = self.docs.pop(url, None)
+        if doc is None:
+            return
+        for g in bigrams(doc[0].split()):
+            urls = self.grams.get(g)
+            if urls is not None:
+                urls.discard(url)
+                if not urls:
+                    del self.grams[g]
+
+    def search(self, words: List[str]) -> Iterator[Tuple[str, Track]]:
+        grams = bigrams(words)
+        if grams:
+            postings = sorted((self.grams.get(g, set()) for g in grams), key=len)
+            candidates: Iterable[str] = postings[0].intersection(*postings[1:])
+        elif len(self.docs) <= SUGGEST_CANDIDATES:
+            candidates = list(self.docs)  # 只打了一個字：小索引直接掃
+        else:
+            return
+        n = 0
+        for url in candidates:
+            text, track = self.docs[url]
+            if all(w in text for w in words):
+                yield text, track
+                n += 1
+                if n >= SUGGEST_CANDIDATES:
+                    return
+
+
+class Suggester:
+    # 每個 guild 一份索引（播放統計 + 歷史，第一次自動完成時才建），
+    # 加上全 bot 共用一份「最近解析過 / 搜尋過的歌」
+    def __init__(self, global_max: int):
+        self.global_index = SuggestIndex(global_max)
+        self.guilds: Dict[int, SuggestIndex] = {}
+
+    def guild_index(self, guild_id: int) -> SuggestIndex:
+        index = self.guilds.get(guild_id)
+        if index is None:
+            index = self.guilds[guild_id] = SuggestIndex()
+            state = get_state(guild_id)
+            for entry in state.play_stats:
+                # 快取裡沒有的只知道網址和標題：標成 flat，選到時再照 /play 的流程查
+                key = normalize_query(entry.url)
+                index.add(track_cache.get_mem(key) or Track(key, entry.title, flat=True))
+            for track in state.history:
+                index.add(track)
+        return index
+
+    def note_play(self, guild_id: int, track: Track):
+        index = self.guilds.get(guild_id)
+        if index is not None:
+            index.add(track)
+
+    def note_resolved(self, track: Track):
+        self.global_index.add(track)
+
+    def known(self, guild_id: int, query: str) -> Optional[Track]:
+        q = query.strip()
+        if not is_url(q):
+            return None
+        for index in (self.guilds.get(guild_id), self.global_index):
+            track = index.get(q) if index is not None else None
+            if track is not None and not track.flat:
+                return track
+        return None
+
+    def suggest(self, guild_id: int, current: str) -> List[Track]:
+        state = get_state(guild_id)
+        stats = state.play_stats
+        index = self.guild_index(guild_id)
+        words = title_words(current)
+
+        if not words:
+            # 還沒打字：本伺服器常播的 + 最近播的
+            picks: Dict[str, Track] = {}
+            for entry in stats.top:
+                picks.setdefault(entry.url, index.get(entry.url) or Track(entry.url, entry.title, flat=True))
+            for track in reversed(state.history.recent(SUGGEST_LIMIT)):
+                if track.webpage_url:
+                    picks.setdefault(track.webpage_url, track)
+            return list(picks.values())[:SUGGEST_LIMIT]
+
+        found: Dict[str, Tuple[str, Track]] = {}
+        for text, track in index.search(words):
+            found.setdefault(track.webpage_url, (text, track))  # type: ignore
+        if len(found) < SUGGEST_LIMIT:
+            for text, track in self.global_index.search(words):
+                found.setdefault(track.webpage_url, (text, track))  # type: ignore
+
+        # 排序：本伺服器近期播放分數 → 開頭就符合 → 標題短的
+        prefix = " ".join(words)
+
+        def rank(item: Tuple[str, Track]):
+            text, track = item
+            entry = stats.get(track.webpage_url)  # type: ignore
+            return (-entry.log_score if entry else math.inf, not text.startswith(prefix), len(text))
+
+        return [t for _, t in sorted(found.values(), key=rank)[:SUGGEST_LIMIT]]
+
+
+suggestions = Suggester(SUGGEST_GLOBAL_MAX)
+
+
+def suggestion_label(track: Track) -> str:
+    label = track.title or "未知標題"
+    if track.duration:
+        label += f"（{fmt_time(track.duration)}）"
+    return label[:100]
+
+
+@traced("play_autocomplete")
+async def play_autocomplete(interaction: discord.Interaction, current: str) -> List[app_commands.Choice[str]]:
+    # 值直接給網址：選了建議的話 /play 不用再搜尋
+    if interaction.guild_id is None:
+        return []
+    return [
+        app_commands.Choice(name=suggestion_label(t), value=t.webpage_url)  # type: ignore
+        for t in suggestions.suggest(interaction.guild_id, current)
+        if len(t.webpage_url or "") <= 100
+    ]
+
+
+@traced("search_autocomplete")
+async def search_autocomplete(interaction: discord.Interaction, current: str) -> List[app_commands.Choice[str]]:
+    if interaction.guild_id is None:
+        return []
+    choices: Dict[str, app_commands.Choice[str]] = {}
+    for t in suggestions.suggest(interaction.guild_id, current):
+        keyword = (t.title or "")[:100]
+        if keyword:
+            choices.setdefault(keyword, app_commands.Choice(name=suggestion_label(t), value=keyword))
+    return list(choices.values())
+
+
+# ============================================================
+# 預先解析：播放時就把佇列前幾首的串流 URL 準備好
+# ============================================================
+PREFETCH_DEPTH = int(os.getenv("PREFETCH_DEPTH", "1"))
+# googlevideo 串流網址離過期不到這麼多秒就重新解析
+STREAM_URL_REFRESH_MARGIN = float(os.getenv("STREAM_URL_REFRESH_MARGIN", "600"))
+
+_EXPIRE_RE = re.compile(r"[?&/]expire[=/](\d+)")
+
+
+def stream_url_expiry(audio_url: str) -> Optional[float]:
+    # googlevideo 的網址帶有 expire=<unix 秒>（有些格式放在路徑 /expire/<秒>/）
+    m = _EXPIRE_RE.search(audio_url)
+    return float(m.group(1)) if m else None
+
+
+def stream_url_fresh(expires: Optional[float]) -> bool:
+    return expires is None or expires - time.time() > STREAM_URL_REFRESH_MARGIN
+
+
+class Prefetcher:
+    def __init__(self, depth: int):
+        self.depth = depth
+        self.urls: Dict[int, Dict[str, Tuple[str, Optional[float]]]] = {}  # guild -> webpage_url -> (串流, 到期)
+        self.tasks: Dict[int, asyncio.Task] = {}
+
+    def targets(self, guild_id: int) -> List[str]:
+        state = guild_states.get(guild_id)
+        if state is None:
+            return []
+        urls = []
+        if state.loop and state.now_playing:
+            urls.append(state.now_playing.webpage_url)
+        for t in state.queue.peek(self.depth):
+            urls.append(t.webpage_url)
+        return [u for u in urls if u]
+
+    def schedule(self, guild_id: int):
+        if self.depth <= 0:
             return
-        track = queues[guild_id].pop(0)
-        now_playing[guild_id] = track
+        task = self.tasks.get(guild_id)
+        if task and not task.done():
+            task.cancel()
+        self.tasks[guild_id] = asyncio.get_running_loop().create_task(self._run(guild_id))
+
+    def invalidate(self, guild_id: int):
+        # 佇列被清空 / 重新排序時呼叫，丟掉所有預解析結果
+        task = self.tasks.pop(guild_id, None)
+        if task and not task.done():
+            task.cancel()
+        self.urls.pop(guild_id, None)
+
+    def take(self, guild_id: int, webpage_url: str) -> Optional[str]:
+        entry = self.urls.get(guild_id, {}).get(webpage_url)
+        if entry is None or not stream_url_fresh(entry[1]):
+            return None
+        return entry[0]
+
+    async def _run(self, guild_id: int):
+        failed: set = set()  # 這次排程裡解析失敗的
+        while True:
+            targets = self.targets(guild_id)
+            cached = self.urls.setdefault(guild_id, {})
+            for url in list(cached):
+                if url not in targets:
+                    del cached[url]
+
+            for url in targets:
+                entry = cached.get(url)
+                if entry is not None and stream_url_fresh(entry[1]):
+                    continue
+                if url in failed or audio_cache.has(url):
+                    continue  # 失敗過的留給播放時再解析；本機有檔案的不需要串流網址
+                try:
+                    audio_url = await resolve_audio_url(guild_id, url)
+                except Exception as e:
+                    # 一首無法播放的影片不影響後面幾首的預先解析
+                    print(f"預先解析失敗 {url}:", e)
+                    ERRORS.inc("prefetch")
+                    failed.add(url)
+                    continue
+                cached[url] = (audio_url, stream_url_expiry(audio_url))
 
-        # 更新播放歷史
-        if guild_id not in history:
-            history[guild_id] = []
-        history[guild_id].append(track)
-        history[guild_id] = history[guild_id][-50:]  # 只留最近 50 首
+            # 等到最早過期的那個快到期時再重新整理
+            expiries = [e for _, e in cached.values() if e is not None]
+            if not expiries:
+                return
+            wait = min(expiries) - STREAM_URL_REFRESH_MARGIN - time.time()
+            await asyncio.sleep(max(wait, 1.0))
 
-        if guild_id not in play_counts:
-            play_counts[guild_id] = {}
-        title = track.get("title") or "未知標題"
-        play_counts[guild_id][title] = play_counts[guild_id].get(title, 0) + 1
 
-    if track is None:
-        return
+prefetcher = Prefetcher(PREFETCH_DEPTH)
 
-    audio_url = get_audio_url(track["webpage_url"])  # type: ignore
-    source = discord.FFmpegPCMAudio(audio_url, **FFMPEG_OPTS)
 
-    vol = volume_settings.get(guild_id, 1.0)
-    source = discord.PCMVolumeTransformer(source, volume=vol)
+# ============================================================
+# 背景補齊播放清單項目的資訊（長度、縮圖、上傳者）
+# ============================================================
+ENRICH_AHEAD = int(os.getenv("ENRICH_AHEAD", "100"))            # 只補佇列前面幾首
+ENRICH_CONCURRENCY = int(os.getenv("ENRICH_CONCURRENCY", "2"))  # 全 bot 同時補幾首
+
+
+class Enricher:
+    # 扁平播放清單的項目沒有長度 / 縮圖，依佇列順序在背景逐首解析，原地更新佇列裡的 Track，
+    # 結果也會進歌曲資訊快取。全 bot 共用一個並行上限，留 resolver 名額給互動指令。
+    def __init__(self, ahead: int, concurrency: int):
+        self.ahead = ahead
+        self.concurrency = max(concurrency, 1)
+        self.sem: Optional[asyncio.Semaphore] = None
+        self.tasks: Dict[int, asyncio.Task] = {}
+
+    def schedule(self, guild_id: int):
+        # 已在跑的會自己讀到佇列的新內容，不用重開
+        if self.ahead <= 0:
+            return
+        task = self.tasks.get(guild_id)
+        if task and not task.done():
+            return
+        self.tasks[guild_id] = asyncio.get_running_loop().create_task(self._run(guild_id))
 
-    start_times[guild_id] = datetime.now(timezone.utc)
-    touch_active(guild_id)
+    def cancel(self, guild_id: int):
+        task = self.tasks.pop(guild_id, None)
+        if task and not task.done():
+            task.cancel()
 
-    def after_play(err: Optional[Exception]):
-        if err:
-            print("播放錯誤:", err)
-        fut = asyncio.run_coroutine_threadsafe(
-            play_next(guild_id, vc), bot.loop
-        )
+    async def _run(self, guild_id: int):
+        if self.sem is None:
+            self.sem = asyncio.Semaphore(self.concurrency)
+        try:
+            while True:
+                state = guild_states.get(guild_id)
+                if state is None:
+                    return
+                batch = [t for t in state.queue.peek(self.ahead) if t.flat][:self.concurrency]
+                if not batch:
+                    return
+                await asyncio.gather(*(self._enrich(guild_id, t) for t in batch))
+                state_store.mark(guild_id)
+        finally:
+            if self.tasks.get(guild_id) is asyncio.current_task():
+                del self.tasks[guild_id]
+
+    async def _enrich(self, guild_id: int, track: Track):
+        async with self.sem:  # type: ignore
+            if not track.flat:
+                return
+            try:
+                info = await resolve_track(guild_id, track.webpage_url)  # type: ignore
+                old_duration = track.duration
+                track.update_from(info)
+                state = guild_states.get(guild_id)
+                if state is not None and track.duration != old_duration:
+                    state.queue.retime(track, old_duration)
+            except Exception as e:
+                # 補不到就算了，播放時還是會再解析一次
+                print(f"補齊歌曲資訊失敗 {track.title}:", e)
+                ERRORS.inc("enrich")
+                track.flat = False
+
+
+enricher = Enricher(ENRICH_AHEAD, ENRICH_CONCURRENCY)
+
+
+# ============================================================
+# 本機音訊快取：常播的歌存成 Ogg/Opus，之後直接播本機檔案
+# ============================================================
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR")  # 未設定就不啟用
+AUDIO_CACHE_MAX_MB = int(os.getenv("AUDIO_CACHE_MAX_MB", "2048"))
+AUDIO_CACHE_MIN_PLAYS = int(os.getenv("AUDIO_CACHE_MIN_PLAYS", "3"))  # 播放次數達到才快取
+AUDIO_CACHE_DOWNLOADS = int(os.getenv("AUDIO_CACHE_DOWNLOADS", "1"))  # 同時下載數
+AUDIO_CACHE_INDEX_DELAY = 5.0  # 索引檔最快幾秒寫一次
+
+
+def _atomic_write(path: str, data: bytes):
+    # 先寫暫存檔、fsync 後再 rename，當機也不會留下寫一半的檔案。
+    # 暫存檔名每次不同（同目錄），多個 thread / 叢集 worker 同時寫也不會寫到同一個暫存檔
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
         try:
-            fut.result()
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class AudioCache:
+    def __init__(self, directory: Optional[str], max_bytes: int, min_plays: int, downloads: int):
+        self.dir = directory
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.downloads = downloads
+        # key -> {"url", "file", "size", "sha256", "hits", "used"}
+        self.index: Dict[str, dict] = {}
+        self.pending: set = set()
+        self.sem: Optional[asyncio.Semaphore] = None
+        self.save_handle: Optional[asyncio.TimerHandle] = None
+        if not directory:
+            return
+
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        # 開機時先用檔案大小做快速檢查，完整的 sha256 檢查在背景做（verify_all）
+        for key, entry in index.items():
+            path = os.path.join(directory, entry["file"])
+            if os.path.isfile(path) and os.path.getsize(path) == entry["size"]:
+                self.index[key] = entry
+        for name in os.listdir(directory):
+            if name.endswith(".tmp") or name.endswith(".part.ogg"):
+                os.remove(os.path.join(directory, name))
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.dir)
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.dir, "index.json")  # type: ignore
+
+    @staticmethod
+    def key(webpage_url: str) -> str:
+        return hashlib.sha1(webpage_url.encode("utf-8")).hexdigest()[:20]
+
+    def has(self, webpage_url: Optional[str]) -> bool:
+        return bool(webpage_url) and self.key(webpage_url) in self.index  # type: ignore
+
+    def lookup(self, webpage_url: Optional[str]) -> Optional[str]:
+        # 命中就回傳本機檔案路徑；完全不碰網路
+        if not self.enabled or not webpage_url:
+            return None
+        key = self.key(webpage_url)
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        path = os.path.join(self.dir, entry["file"])  # type: ignore
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = -1
+        if size != entry["size"]:
+            self._drop(key)
+            return None
+        entry["hits"] += 1
+        entry["used"] = time.time()
+        self._schedule_save()
+        return path
+
+    def maybe_store(self, guild_id: int, track: Track, plays: int):
+        if not self.enabled or plays < self.min_plays or not track.webpage_url:
+            return
+        key = self.key(track.webpage_url)
+        if key in self.index or key in self.pending:
+            return
+        if track.duration and track.duration > 20 * 60:
+            return  # 太長的（直播 / 合輯）不快取
+        self.pending.add(key)
+        asyncio.get_running_loop().create_task(self._download(guild_id, key, track.webpage_url, plays))
+
+    async def _download(self, guild_id: int, key: str, webpage_url: str, plays: int):
+        if self.sem is None:
+            self.sem = asyncio.Semaphore(self.downloads)
+        name = f"{key}.ogg"
+        path = os.path.join(self.dir, name)  # type: ignore
+        part = os.path.join(self.dir, f"{key}.part.ogg")  # type: ignore
+        try:
+            async with self.sem:
+                audio_url = await resolve_audio_url(guild_id, webpage_url)
+                # YouTube 的 webm 本來就是 opus，直接換封裝；其他格式才轉碼
+                codec = ["-c:a", "copy"] if "mime=audio%2Fwebm" in audio_url else ["-c:a", "libopus", "-b:a", "128k"]
+                proc = await asyncio.create_subprocess_exec(
+                    FFMPEG_PATH, "-nostdin", "-loglevel", "error", "-y",
+                    *FFMPEG_OPTS["before_options"].split(), "-i", audio_url,
+                    "-vn", *codec, "-f", "ogg", part,
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+                _, stderr = await proc.communicate()
+                if proc.returncode != 0:
+                    raise RuntimeError(stderr.decode(errors="ignore").strip()[-200:])
+
+                def finalize() -> Tuple[int, str]:
+                    with open(part, "rb") as f:
+                        os.fsync(f.fileno())
+                    digest = _sha256_file(part)
+                    os.replace(part, path)
+                    return os.path.getsize(path), digest
+
+                size, digest = await asyncio.get_running_loop().run_in_executor(None, finalize)
+            # 起始次數用下載前的播放次數，新檔案才不會因為 hits=0 馬上被淘汰
+            self.index[key] = {
+                "url": webpage_url, "file": name, "size": size,
+                "sha256": digest, "hits": plays, "used": time.time(),
+            }
+            self._evict(keep=key)
+            self._schedule_save()
         except Exception as e:
-            print("after_play 發生錯誤:", e)
+            print("音訊快取下載失敗:", e)
+            ERRORS.inc("audio_cache")
+            if os.path.exists(part):
+                os.remove(part)
+        finally:
+            self.pending.discard(key)
+
+    def _evict(self, keep: Optional[str] = None):
+        # 超過容量時先淘汰播放次數最少的，同次數再淘汰最久沒用到的（LFU + LRU）；
+        # keep 是剛下載好的那個，不會被淘汰
+        total = sum(e["size"] for e in self.index.values())
+        if total <= self.max_bytes:
+            return
+        for key, entry in sorted(self.index.items(), key=lambda kv: (kv[1]["hits"], kv[1]["used"])):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= entry["size"]
+            self._drop(key)
+
+    def _drop(self, key: str):
+        entry = self.index.pop(key, None)
+        if entry is None:
+            return
+        try:
+            os.remove(os.path.join(self.dir, entry["file"]))  # type: ignore
+        except OSError:
+            pass
+        self._schedule_save()
+
+    def _schedule_save(self):
+        if self.save_handle is None:
+            loop = asyncio.get_running_loop()
+            self.save_handle = loop.call_later(AUDIO_CACHE_INDEX_DELAY, self._save)
+
+    def _save(self):
+        self.save_handle = None
+        data = json.dumps(self.index).encode("utf-8")
+        asyncio.get_running_loop().run_in_executor(None, _atomic_write, self.index_path, data)
+
+    def find_corrupt(self, entries: List[Tuple[str, dict]]) -> List[str]:
+        # 在 thread 裡逐一比對 sha256
+        bad = []
+        for key, entry in entries:
+            try:
+                if _sha256_file(os.path.join(self.dir, entry["file"])) != entry["sha256"]:  # type: ignore
+                    bad.append(key)
+            except OSError:
+                bad.append(key)
+        return bad
+
+    async def verify_all(self):
+        if not self.enabled:
+            return
+        entries = list(self.index.items())
+        bad = await asyncio.get_running_loop().run_in_executor(None, self.find_corrupt, entries)
+        for key in bad:
+            print("音訊快取檔案損毀，已移除:", key)
+            self._drop(key)
+
 
-    vc.play(source, after=after_play)
+audio_cache = AudioCache(
+    AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_MB * 1024 * 1024, AUDIO_CACHE_MIN_PLAYS, AUDIO_CACHE_DOWNLOADS
+)
 
 
 # ============================================================
-# 自動斷線背景任務
+# 建立音源（PCM / Opus 直通）
 # ============================================================
-async def auto_disconnect_loop():
-    await bot.wait_until_ready()
-    while not bot.is_closed():
-        now = datetime.now(timezone.utc)
-        for guild in bot.guilds:
-            vc: discord.VoiceClient = guild.voice_client  # type: ignore
-            if not vc or not vc.is_connected():
-                continue
+# 目前所有 ffmpeg 音源（給監控指標算 ffmpeg 程序數）
+live_sources: "weakref.WeakSet[discord.FFmpegAudio]" = weakref.WeakSet()
+
+
+def guess_opus(url: str, local: bool) -> Optional[bool]:
+    # 本機快取一律是 Ogg/Opus；googlevideo 的 webm 音訊是 opus；其他不確定就回傳 None 交給 probe
+    if local:
+        return True
+    if "mime=audio%2Fwebm" in url:
+        return True
+    if "mime=audio%2Fmp4" in url:
+        return False
+    return None
+
+
+async def create_source(url: str, volume: float, local: bool = False, start: float = 0.0) -> discord.AudioSource:
+    before = "" if local else FFMPEG_OPTS["before_options"]
+    if start > 0:
+        # 放在 -i 前面：ffmpeg 直接跳到該位置（HTTP 用 range request），不用從頭解碼
+        before = f"-ss {start:.2f} {before}".strip()
+
+    if PLAYBACK_MODE == "opus":
+        if abs(volume - 1.0) >= 0.005:
+            # 音量不是 100%：用 ffmpeg filter 調音量，必須轉碼成 opus
+            opus = discord.FFmpegOpusAudio(
+                url, executable=FFMPEG_PATH, before_options=before,
+                options=f"-vn -filter:a volume={volume:.2f}",
+            )
+        else:
+            is_opus = guess_opus(url, local)
+            if is_opus is None:
+                opus = await discord.FFmpegOpusAudio.from_probe(
+                    url, method="fallback", executable=FFMPEG_PATH, before_options=before, options="-vn",
+                )
+            else:
+                opus = discord.FFmpegOpusAudio(
+                    url, executable=FFMPEG_PATH, before_options=before, options="-vn",
+                    codec="opus" if is_opus else None,
+                )
+        live_sources.add(opus)
+        return opus
+
+    source = discord.FFmpegPCMAudio(url, executable=FFMPEG_PATH, before_options=before, options="-vn")
+    live_sources.add(source)
+    if PLAYBACK_MODE == "mix":
+        return source  # 音量由 MixSource 處理
+    return discord.PCMVolumeTransformer(source, volume=volume)
+
+
+class TrackedSource(discord.AudioSource):
+    # 包住實際音源，數送出去的 frame（每個 20 ms）：暫停時不會讀，位置自然停住，
+    # 網路卡住時也不會像用開始時間推算那樣越跑越前面
+    FRAME_SECONDS = 0.02
+
+    def __init__(self, original: discord.AudioSource, offset: float = 0.0):
+        self.original = original
+        self.offset = offset
+        self.frames = 0
+
+    @property
+    def position(self) -> float:
+        return self.offset + self.frames * self.FRAME_SECONDS
+
+    def read(self) -> bytes:
+        data = self.original.read()
+        if data:
+            self.frames += 1
+        return data
+
+    def is_opus(self) -> bool:
+        return self.original.is_opus()
+
+    def cleanup(self):
+        self.original.cleanup()
+
+
+def playback_position(guild_id: int) -> Optional[float]:
+    player = players.get(guild_id)
+    if player is not None and player.source is not None:
+        return player.source.position
+    state = guild_states.get(guild_id)
+    if state is None or state.started_at is None:
+        return None
+    return (datetime.now(timezone.utc) - state.started_at).total_seconds()
+
+
+# ============================================================
+# 混音引擎（PLAYBACK_MODE=mix）：響度平衡 + 交叉淡化
+# ============================================================
+CROSSFADE_SECONDS = float(os.getenv("CROSSFADE_SECONDS", "4"))  # 換歌時交叉淡化幾秒，0 = 不淡化
+CROSSFADE_PREPARE = 3.0  # 淡化開始前幾秒先準備下一首（查串流網址、開 ffmpeg）
+
+LOUDNESS_CACHE_PATH = os.getenv("LOUDNESS_CACHE_PATH")  # 未設定就只記在記憶體
+LOUDNESS_CACHE_MAX = 20000
+LOUDNESS_SAVE_DELAY = 5.0
+LOUDNESS_TARGET_DB = float(os.getenv("LOUDNESS_TARGET_DB", "-20"))  # 目標 RMS（dBFS）
+LOUDNESS_MAX_GAIN_DB = 12.0  # 增益上下限，避免把幾乎無聲的歌放大成噪音
+LOUDNESS_GATE_DB = -50.0     # 比這個小聲的 frame 不算進平均（前奏、靜音段）
+LOUDNESS_ANALYZE_SECONDS = 20.0
+GAIN_SMOOTHING = 0.02        # 每個 frame 往目標增益靠近的比例（約 1 秒到位，不會突然跳）
+
+FRAME_BYTES = discord.opus.Encoder.FRAME_SIZE  # 20 ms、48 kHz、雙聲道 int16
+FRAME_SAMPLES = FRAME_BYTES // 2
+
+
+def _db_to_amplitude(db: float) -> float:
+    return 32768.0 * 10 ** (db / 20)
+
+
+LOUDNESS_TARGET_RMS = _db_to_amplitude(LOUDNESS_TARGET_DB)
+LOUDNESS_GATE_ENERGY = _db_to_amplitude(LOUDNESS_GATE_DB) ** 2
+LOUDNESS_MIN_GAIN = 10 ** (-LOUDNESS_MAX_GAIN_DB / 20)
+LOUDNESS_MAX_GAIN = 10 ** (LOUDNESS_MAX_GAIN_DB / 20)
+LOUDNESS_FRAMES = int(LOUDNESS_ANALYZE_SECONDS / TrackedSource.FRAME_SECONDS)
 
-            guild_id = guild.id
-            last = last_active.get(guild_id)
-            if not last:
+
+class LoudnessCache:
+    # webpage_url → 響度增益。每首歌只在第一次播放時量一次，之後直接套用
+    def __init__(self, path: Optional[str], max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self.gains: "OrderedDict[str, float]" = OrderedDict()
+        self.save_handle: Optional[asyncio.TimerHandle] = None
+        if not path:
+            return
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self.gains.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    def get(self, url: Optional[str]) -> Optional[float]:
+        gain = self.gains.get(url) if url else None
+        if gain is not None:
+            self.gains.move_to_end(url)  # type: ignore
+        return gain
+
+    def put(self, url: Optional[str], gain: float):
+        if not url:
+            return
+        self.gains[url] = round(gain, 4)
+        self.gains.move_to_end(url)
+        while len(self.gains) > self.max_entries:
+            self.gains.popitem(last=False)
+        if self.path and self.save_handle is None:
+            self.save_handle = asyncio.get_running_loop().call_later(LOUDNESS_SAVE_DELAY, self._save)
+
+    def _save(self):
+        self.save_handle = None
+        data = json.dumps(self.gains).encode("utf-8")
+        asyncio.get_running_loop().run_in_executor(None, _atomic_write, self.path, data)
+
+
+loudness = LoudnessCache(LOUDNESS_CACHE_PATH, LOUDNESS_CACHE_MAX)
+
+
+def fade_point(track: Track) -> Optional[float]:
+    # 播到這個位置就通知播放器準備下一首；長度不明或太短的歌不淡化
+    if CROSSFADE_SECONDS <= 0 or not track.duration or track.duration < 3 * CROSSFADE_SECONDS:
+        return None
+    return max(track.duration - CROSSFADE_SECONDS - CROSSFADE_PREPARE, 0.0)
+
+
+def _cleanup_later(source: Optional[discord.AudioSource]):
+    # cleanup 會等 ffmpeg 結束，不能卡住語音執行緒
+    if source is not None:
+        threading.Thread(target=source.cleanup, daemon=True).start()
+
+
+class MixSource(TrackedSource):
+    # 每個 20 ms frame 轉成 NumPy 陣列處理：音量 × 響度增益，換歌時兩首等功率交叉淡化，最後截回 int16。
+    # 緩衝區在建立時配好，read() 只重複使用，唯一的新物件是交給 opus 編碼器的 bytes。
+    #
+    # 換歌流程：播到 fade_at 時 on_fade 通知播放器；播放器開好下一首後呼叫 prepare()，
+    # 這首播到 start 的位置（或提早結束）就開始淡化並呼叫 on_switch，之後這個音源就代表下一首
+    # （offset / frames / 增益都換成新的），vc 上的音源和 after callback 都不用換。
+    # 播放器要等 on_switch 才把下一首從佇列拿出來，淡化前 /skip、/seek 都還是對目前這首。
+    def __init__(
+        self,
+        original: discord.AudioSource,
+        offset: float,
+        volume: float,
+        url: Optional[str],
+        gain: Optional[float],
+        fade_at: Optional[float],
+        on_fade: Callable[["MixSource"], None],
+        on_switch: Callable[["MixSource"], None],
+        on_measured: Callable[[Optional[str], float], None],
+    ):
+        super().__init__(original, offset)
+        self.volume = volume
+        self.fade_at = fade_at
+        self.on_fade = on_fade          # callback 都在語音執行緒上呼叫
+        self.on_switch = on_switch
+        self.on_measured = on_measured
+        self.outgoing: Optional[discord.AudioSource] = None
+        self.out_gain = 1.0
+        self.fade_frames = self.fade_pos = 0
+        # (音源, 網址, 增益, 開始淡化的位置, 下一首的 fade_at)；和 done 一起由 lock 保護
+        self.pending: Optional[tuple] = None
+        self.done = False
+        self.lock = threading.Lock()
+        self.acc = np.zeros(FRAME_SAMPLES, dtype=np.float32)
+        self.aux = np.zeros(FRAME_SAMPLES, dtype=np.float32)
+        self.pcm = np.zeros(FRAME_SAMPLES, dtype=np.int16)
+        self._reset_gain(url, gain)
+
+    def _reset_gain(self, url: Optional[str], gain: Optional[float]):
+        self.url = url
+        self.gain = self.applied = gain if gain is not None else 1.0
+        self.measure_left = 0 if gain is not None else LOUDNESS_FRAMES
+        self.energy = 0.0
+        self.counted = 0
+
+    def prepare(self, incoming: discord.AudioSource, url: Optional[str], gain: Optional[float],
+                start: float, fade_at: Optional[float]) -> bool:
+        # 在 event loop 上呼叫；這個音源已經播完就回傳 False，由呼叫端自己收掉 incoming
+        with self.lock:
+            if self.done:
+                return False
+            old, self.pending = self.pending, (incoming, url, gain, start, fade_at)
+        if old is not None:
+            _cleanup_later(old[0])
+        return True
+
+    def _take_pending(self, ended: bool) -> Optional[tuple]:
+        with self.lock:
+            pending, self.pending = self.pending, None
+            if pending is None and ended:
+                self.done = True
+            return pending
+
+    def _begin(self, pending: tuple, ended: bool):
+        incoming, url, gain, _, fade_at = pending
+        _cleanup_later(self.outgoing)
+        if ended:
+            # 上一首已經沒聲音了，直接無縫接上
+            _cleanup_later(self.original)
+            self.outgoing = None
+            self.fade_frames = 0
+        else:
+            self.outgoing, self.out_gain = self.original, self.applied
+            self.fade_frames = max(int(CROSSFADE_SECONDS / self.FRAME_SECONDS), 1)
+        self.fade_pos = 0
+        self.original = incoming
+        self.offset, self.frames = 0.0, 0
+        self.fade_at = fade_at
+        self._reset_gain(url, gain)
+        self.on_switch(self)
+
+    def _next_frame(self) -> bytes:
+        pending = self.pending
+        if pending is not None and self.offset + self.frames * self.FRAME_SECONDS >= pending[3]:
+            pending = self._take_pending(ended=False)
+            if pending is not None:
+                self._begin(pending, ended=False)
+        while True:
+            data = self.original.read()
+            if len(data) == FRAME_BYTES:
+                return data
+            pending = self._take_pending(ended=True)
+            if pending is None:
+                return b""
+            self._begin(pending, ended=True)
+
+    def read(self) -> bytes:
+        data = self._next_frame()
+        if not data:
+            _cleanup_later(self.outgoing)
+            self.outgoing = None
+            return b""
+        self.frames += 1
+
+        acc = self.acc
+        np.copyto(acc, np.frombuffer(data, dtype=np.int16))
+        if self.measure_left:
+            self._measure()
+        self.applied += (self.gain - self.applied) * GAIN_SMOOTHING
+        level = self.volume * self.applied
+        if self.fade_pos < self.fade_frames:
+            x = self.fade_pos / self.fade_frames * (math.pi / 2)
+            self.fade_pos += 1
+            acc *= level * math.sin(x)
+            if self.outgoing is not None:
+                self._mix_outgoing(math.cos(x))
+        else:
+            acc *= level
+            if self.outgoing is not None:
+                _cleanup_later(self.outgoing)
+                self.outgoing = None
+        np.clip(acc, -32768, 32767, out=acc)
+        np.copyto(self.pcm, acc, casting="unsafe")
+
+        if self.fade_at is not None and self.offset + self.frames * self.FRAME_SECONDS >= self.fade_at:
+            self.fade_at = None
+            self.on_fade(self)
+        return self.pcm.tobytes()
+
+    def _mix_outgoing(self, weight: float):
+        data = self.outgoing.read()  # type: ignore
+        if len(data) != FRAME_BYTES:
+            _cleanup_later(self.outgoing)
+            self.outgoing = None
+            return
+        aux = self.aux
+        np.copyto(aux, np.frombuffer(data, dtype=np.int16))
+        aux *= self.volume * self.out_gain * weight
+        self.acc += aux
+
+    def _measure(self):
+        # 量前 LOUDNESS_ANALYZE_SECONDS 秒（套增益前）的 gated RMS，量完就換成正規化增益
+        energy = float(np.dot(self.acc, self.acc)) / FRAME_SAMPLES
+        if energy > LOUDNESS_GATE_ENERGY:
+            self.energy += energy
+            self.counted += 1
+        self.measure_left -= 1
+        if self.measure_left == 0 and self.counted >= LOUDNESS_FRAMES // 4:
+            rms = math.sqrt(self.energy / self.counted)
+            self.gain = min(max(LOUDNESS_TARGET_RMS / rms, LOUDNESS_MIN_GAIN), LOUDNESS_MAX_GAIN)
+            self.on_measured(self.url, self.gain)
+
+    def cleanup(self):
+        with self.lock:
+            pending, self.pending = self.pending, None
+            self.done = True
+        if pending is not None:
+            pending[0].cleanup()
+        if self.outgoing is not None:
+            self.outgoing.cleanup()
+            self.outgoing = None
+        self.original.cleanup()
+
+
+# ============================================================
+# 共用解碼：多個 guild 同時播同一首（opus 模式、音量 100%）時共用一個 ffmpeg
+# ============================================================
+BROADCAST_WINDOW = float(os.getenv("BROADCAST_WINDOW", "30"))  # 環狀緩衝區保留幾秒；進度差在這之內才共用
+BROADCAST_FRAMES = max(int(BROADCAST_WINDOW / TrackedSource.FRAME_SECONDS), 1)
+
+
+class Broadcast:
+    # 一個 ffmpeg 解出來的 opus packet 放進環狀緩衝區，frame 編號是絕對的（第 k 個 = offset + k × 20 ms）。
+    # 沒有獨立的 thread：跑最前面的聽眾讀到 head 時才向 ffmpeg 拿下一個 packet，
+    # 其他聽眾直接讀緩衝區，每人拿到的是同一個 bytes 物件，不複製。
+    def __init__(self, hub: "BroadcastHub", key: str, decoder: discord.AudioSource,
+                 url: str, local: bool, offset: float):
+        self.hub = hub
+        self.key = key
+        self.decoder = decoder
+        self.url = url
+        self.local = local
+        self.offset = offset
+        self.ring: List[Optional[bytes]] = [None] * BROADCAST_FRAMES
+        self.head = 0         # 下一個要解的 frame 編號
+        self.ended = False
+        self.listeners = 0
+        self.decode_lock = threading.Lock()
+
+    def index(self, position: float) -> int:
+        return round((position - self.offset) / TrackedSource.FRAME_SECONDS)
+
+    def can_join(self, k: int) -> bool:
+        return max(self.head - BROADCAST_FRAMES, 0) <= k and (k < self.head or (k == self.head and not self.ended))
+
+    def frame(self, k: int) -> Optional[bytes]:
+        # 回傳第 k 個 packet；播完回傳 b""，已經被覆蓋（落後超過 BROADCAST_WINDOW）回傳 None
+        while k >= self.head:
+            if self.ended:
+                return b""
+            with self.decode_lock:
+                if k < self.head:
+                    break
+                data = None if self.ended else self.decoder.read()
+                if not data:
+                    self.ended = True
+                    return b""
+                self.ring[self.head % BROADCAST_FRAMES] = data
+                self.head += 1  # 先放進去再推進 head，其他 thread 看到的一定是完整的
+        data = self.ring[k % BROADCAST_FRAMES]
+        if k < self.head - BROADCAST_FRAMES:
+            return None  # 讀的同時被新的 packet 蓋掉了
+        return data
+
+
+class BroadcastListener(discord.AudioSource):
+    # 每個 guild 自己的讀取位置；落後太多（例如暫停很久）就改開自己的 ffmpeg 從目前位置接著播
+    def __init__(self, broadcast: Broadcast, cursor: int):
+        self.broadcast: Optional[Broadcast] = broadcast
+        self.cursor = cursor
+        self.private: Optional[discord.AudioSource] = None
+
+    def read(self) -> bytes:
+        if self.broadcast is None:
+            return self.private.read() if self.private is not None else b""
+        data = self.broadcast.frame(self.cursor)
+        if data is None:
+            broadcast = self.broadcast
+            position = broadcast.offset + self.cursor * TrackedSource.FRAME_SECONDS
+            self.detach()
+            try:
+                self.private = broadcast.hub.reopen(broadcast.url, broadcast.local, position)
+            except Exception as e:
+                print("共用解碼落後，無法改用獨立音源:", e)
+                return b""  # 交給播放器的斷點接續
+            return self.private.read()
+        if data:
+            self.cursor += 1
+        return data
+
+    def is_opus(self) -> bool:
+        return True
+
+    def detach(self):
+        broadcast, self.broadcast = self.broadcast, None
+        if broadcast is not None:
+            broadcast.hub.detach(broadcast)
+
+    def cleanup(self):
+        self.detach()
+        if self.private is not None:
+            self.private.cleanup()
+            self.private = None
+
+
+class BroadcastHub:
+    # webpage_url → 正在解碼的 Broadcast（同一首可能有好幾個，進度差太多的各自一個）
+    def __init__(self):
+        self.lock = threading.Lock()  # attach 在 event loop，detach 可能在語音執行緒
+        self.broadcasts: Dict[str, List[Broadcast]] = {}
+
+    @staticmethod
+    def eligible(volume: float) -> bool:
+        # 只有 opus 直通、音量 100% 的串流內容完全相同
+        return PLAYBACK_MODE == "opus" and abs(volume - 1.0) < 0.005
+
+    def _attach(self, key: str, position: float) -> Optional[BroadcastListener]:
+        with self.lock:
+            for broadcast in self.broadcasts.get(key, ()):
+                k = broadcast.index(position)
+                if broadcast.can_join(k):
+                    broadcast.listeners += 1
+                    return BroadcastListener(broadcast, k)
+        return None
+
+    async def open(self, key: str, url: str, local: bool, position: float) -> BroadcastListener:
+        listener = self._attach(key, position)
+        if listener is not None:
+            BROADCAST_ATTACH.inc("shared")
+            return listener
+        decoder = await create_source(url, 1.0, local=local, start=position)
+        listener = self._attach(key, position)  # 開 ffmpeg 期間別的 guild 可能先開好了
+        if listener is not None:
+            _cleanup_later(decoder)
+            BROADCAST_ATTACH.inc("shared")
+            return listener
+        broadcast = Broadcast(self, key, decoder, url, local, position)
+        broadcast.listeners = 1
+        with self.lock:
+            self.broadcasts.setdefault(key, []).append(broadcast)
+        BROADCAST_ATTACH.inc("new")
+        return BroadcastListener(broadcast, 0)
+
+    def reopen(self, url: str, local: bool, position: float) -> discord.AudioSource:
+        # 在語音執行緒上同步開自己的 ffmpeg（不 probe，猜不出格式就轉碼）
+        before = "" if local else FFMPEG_OPTS["before_options"]
+        before = f"-ss {position:.2f} {before}".strip()
+        is_opus = guess_opus(url, local)
+        source = discord.FFmpegOpusAudio(
+            url, executable=FFMPEG_PATH, before_options=before, options="-vn",
+            codec="opus" if is_opus else None,
+        )
+        live_sources.add(source)
+        BROADCAST_ATTACH.inc("fallback")
+        return source
+
+    def detach(self, broadcast: Broadcast):
+        with self.lock:
+            broadcast.listeners -= 1
+            if broadcast.listeners > 0:
+                return
+            group = self.broadcasts.get(broadcast.key, [])
+            if broadcast in group:
+                group.remove(broadcast)
+            if not group:
+                self.broadcasts.pop(broadcast.key, None)
+        _cleanup_later(broadcast.decoder)
+
+    def stats(self) -> Dict[tuple, float]:
+        with self.lock:
+            groups = [b for group in self.broadcasts.values() for b in group]
+        return {("decoders",): len(groups), ("listeners",): sum(b.listeners for b in groups)}
+
+
+broadcasts = BroadcastHub()
+
+
+# ============================================================
+# 核心：每個 guild 一個播放器協程
+# ============================================================
+RECOVER_MAX_ATTEMPTS = int(os.getenv("RECOVER_MAX_ATTEMPTS", "2"))  # 同一首最多從斷點接回幾次
+RECOVER_TAIL = 5.0  # 離結尾不到幾秒就當作正常播完（metadata 的長度常有誤差）
+
+# 播放器只靠收件匣（asyncio.Queue）收訊息，依序處理：
+#   ("wake", None)          佇列有新歌；閒置中就開始播
+#   ("finished", (id, err)) 語音執行緒通知某首播完
+#   ("skip", None)          跳過目前這首（單曲循環也會往下一首）
+#   ("stop", None)          清空佇列並停止
+#   ("loop", bool)          開關單曲循環
+#   ("seek", (秒, future))  從指定位置重開 ffmpeg（不重新查歌曲資訊），結果放進 future
+#   ("fade", 音源)          mix 模式：這首快播完了，先開好下一首交給 MixSource 交叉淡化
+# 語音執行緒的 after callback 只負責丟訊息，不會阻塞也不會巢狀呼叫。
+# 串流播到一半斷掉（出錯或比長度早結束）時，會用原本的串流網址（快過期就重新解析）從斷點接著播。
+class GuildPlayer:
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self.inbox: asyncio.Queue = asyncio.Queue()
+        self.current: Optional[int] = None  # 目前音源的編號；None 表示閒置
+        self.seq = 0
+        self.skip_requested = False
+        self.requested_at: Optional[float] = None  # /play 的時間（量到開始出聲）
+        self.finished_at: Optional[float] = None   # 上一首結束的時間（量換歌空檔）
+        self.source: Optional[TrackedSource] = None
+        self.fading: Optional[Tuple[Track, str, bool]] = None  # 已交給 MixSource、還沒開始淡化的下一首
+        self.stream: Optional[Tuple[str, Optional[float], bool]] = None  # (網址, 到期, 是否本機檔)
+        self.recover_attempts = 0
+        self.loop = asyncio.get_running_loop()
+        self.task = self.loop.create_task(self._run())
+
+    def send(self, kind: str, arg: Any = None):
+        self.inbox.put_nowait((kind, arg))
+
+    def mark_requested(self, t0: float):
+        if self.current is None and self.requested_at is None:
+            self.requested_at = t0
+
+    def voice_client(self) -> Optional[discord.VoiceClient]:
+        guild = bot.get_guild(self.guild_id)
+        vc = guild.voice_client if guild else None
+        if vc is None or not vc.is_connected():
+            return None
+        return vc  # type: ignore
+
+    def _after(self, source_id: int, err: Optional[Exception]):
+        # 在 discord.py 的語音執行緒上執行
+        self.loop.call_soon_threadsafe(self.send, "finished", (source_id, err))
+
+    def _fade_due(self, source: "MixSource"):
+        # 語音執行緒
+        self.loop.call_soon_threadsafe(self.send, "fade", source)
+
+    def _switched(self, source: "MixSource"):
+        # 語音執行緒：MixSource 已經開始播 prepare() 給的下一首
+        self.loop.call_soon_threadsafe(self.send, "switched", source)
+
+    def _measured(self, url: Optional[str], gain: float):
+        # 語音執行緒
+        self.loop.call_soon_threadsafe(loudness.put, url, gain)
+
+    async def _run(self):
+        while True:
+            kind, arg = await self.inbox.get()
+            try:
+                await self._handle(kind, arg)
+            except Exception as e:
+                print("播放器錯誤:", e)
+                ERRORS.inc("player")
+
+    async def _handle(self, kind: str, arg: Any):
+        state = get_state(self.guild_id)
+        if kind == "wake":
+            enricher.schedule(self.guild_id)
+            if self.current is None:
+                await self._play_next()
+            else:
+                prefetcher.schedule(self.guild_id)
+        elif kind == "finished":
+            source_id, err = arg
+            if source_id != self.current:
+                return  # 舊音源的通知
+            self.current = None
+            if err:
+                print("播放錯誤:", err)
+                ERRORS.inc("after_play")
+            if not self.skip_requested and await self._recover(err):
+                return
+            self.finished_at = time.perf_counter()
+            await self._play_next()
+        elif kind == "skip":
+            vc = self.voice_client()
+            if vc and (vc.is_playing() or vc.is_paused()):
+                self.skip_requested = True
+                vc.stop()
+        elif kind == "stop":
+            state.reset_playback()
+            state_store.mark(self.guild_id)
+            prefetcher.invalidate(self.guild_id)
+            enricher.cancel(self.guild_id)
+            idle_scheduler.reschedule(self.guild_id)
+            vc = self.voice_client()
+            if vc and (vc.is_playing() or vc.is_paused()):
+                vc.stop()
+        elif kind == "loop":
+            state.loop = arg
+            state_store.mark(self.guild_id)
+            if self.current is not None:
+                prefetcher.schedule(self.guild_id)
+        elif kind == "seek":
+            offset, fut = arg
+            try:
+                await self._seek(offset)
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+            else:
+                if not fut.done():
+                    fut.set_result(None)
+        elif kind == "fade":
+            if arg is self.source and not self.skip_requested:
+                await self._crossfade(arg)
+        elif kind == "switched":
+            if arg is self.source:
+                self._switch()
+
+    async def _open(self, track: Track, audio_url: str, local: bool, offset: float) -> TrackedSource:
+        state = get_state(self.guild_id)
+        if track.webpage_url and broadcasts.eligible(state.volume):
+            return TrackedSource(await broadcasts.open(track.webpage_url, audio_url, local, offset), offset)
+        original = await create_source(audio_url, state.volume, local=local, start=offset)
+        if PLAYBACK_MODE != "mix":
+            return TrackedSource(original, offset)
+        return MixSource(
+            original, offset, state.volume, track.webpage_url, loudness.get(track.webpage_url),
+            fade_point(track), self._fade_due, self._switched, self._measured,
+        )
+
+    async def _start(self, track: Track, audio_url: str, local: bool, offset: float = 0.0) -> bool:
+        state = get_state(self.guild_id)
+        source = await self._open(track, audio_url, local, offset)
+        vc = self.voice_client()
+        if vc is None:
+            source.cleanup()
+            return False
+
+        self.seq += 1
+        source_id = self.current = self.seq
+        self.source = source
+        self.fading = None
+        self.stream = (audio_url, None if local else stream_url_expiry(audio_url), local)
+        state.started_at = datetime.now(timezone.utc) - timedelta(seconds=offset)
+        touch_active(self.guild_id)
+        vc.play(source, after=lambda err, sid=source_id: self._after(sid, err))
+        return True
+
+    async def _stream_url(self, track: Track, force: bool = False) -> Tuple[str, bool]:
+        # 目前這首的串流網址：本機檔 / 還沒過期的就沿用，否則重新解析
+        audio_url, expires, local = self.stream  # type: ignore
+        if local or (not force and stream_url_fresh(expires)):
+            return audio_url, local
+        audio_url = await resolve_audio_url(self.guild_id, track.webpage_url)  # type: ignore
+        return audio_url, False
+
+    async def _recover(self, err: Optional[Exception]) -> bool:
+        state = get_state(self.guild_id)
+        track, source = state.now_playing, self.source
+        if track is None or source is None or self.stream is None or self.voice_client() is None:
+            return False
+        position = source.position
+        ended_early = bool(track.duration) and position < track.duration - RECOVER_TAIL
+        if not (err or ended_early) or self.recover_attempts >= RECOVER_MAX_ATTEMPTS:
+            return False
+
+        self.recover_attempts += 1
+        try:
+            # 第一次先沿用原本的網址（多半只是連線斷了），再失敗就重新解析
+            audio_url, local = await self._stream_url(track, force=self.recover_attempts > 1)
+            print(f"串流中斷，從 {fmt_time(int(position))} 接著播 {track.title}")
+            ERRORS.inc("stream_interrupted")
+            return await self._start(track, audio_url, local, offset=position)
+        except Exception as e:
+            print(f"無法接續播放 {track.title}:", e)
+            ERRORS.inc("recover")
+            return False
+
+    async def _seek(self, offset: float):
+        state = get_state(self.guild_id)
+        vc = self.voice_client()
+        track, old = state.now_playing, self.source
+        if vc is None or track is None or old is None or self.stream is None:
+            raise RuntimeError("目前沒有正在播放的歌曲")
+
+        audio_url, local = await self._stream_url(track)
+        source = await self._open(track, audio_url, local, offset)
+        if self.source is not old or self.voice_client() is None:
+            source.cleanup()  # 建立音源期間換歌了
+            raise RuntimeError("歌曲已經換了")
+
+        # 直接換掉播放中的音源，不會觸發 after；換源時 discord.py 會恢復播放，暫停中要再停住
+        paused = vc.is_paused()
+        vc.source = source
+        if paused:
+            vc.pause()
+        self.source = source
+        self.fading = None
+        self.stream = (audio_url, None if local else stream_url_expiry(audio_url), local)
+        state.started_at = datetime.now(timezone.utc) - timedelta(seconds=offset)
+        self.loop.call_later(1.0, old.cleanup)  # 語音執行緒可能還在讀最後一個 frame
+        touch_active(self.guild_id)
+        panels.touch(self.guild_id)
+
+    async def _crossfade(self, source: "MixSource"):
+        # 先把下一首的 ffmpeg 開好掛到 MixSource 上；任何一步失敗就照一般流程，播完再由 _play_next 換歌
+        state = get_state(self.guild_id)
+        outgoing = state.now_playing
+        if state.loop or not state.queue or outgoing is None:
+            return
+        track = state.queue.peek(1)[0]
+        try:
+            audio_url, local = await self._audio_url(track)
+            incoming = await create_source(audio_url, state.volume, local=local)
+        except Exception as e:
+            print(f"無法預先開啟 {track.title}:", e)
+            return
+        start = max(outgoing.duration - CROSSFADE_SECONDS, 0.0)
+        if (
+            self.source is not source
+            or state.loop
+            or not state.queue
+            or state.queue.peek(1)[0] is not track
+            or not source.prepare(incoming, track.webpage_url, loudness.get(track.webpage_url), start, fade_point(track))
+        ):
+            incoming.cleanup()  # 準備期間換歌、清空或已經播完
+            return
+
+        self.fading = (track, audio_url, local)
+
+    def _switch(self):
+        # 下一首真的開始出聲了才換歌：從佇列拿出來、記進歷史和統計
+        state = get_state(self.guild_id)
+        fading, self.fading = self.fading, None
+        if fading is None:
+            return
+        track, audio_url, local = fading
+        if state.queue and state.queue.peek(1)[0] is track:
+            state.queue.popleft()
+        self._record(state, track)
+        self.stream = (audio_url, None if local else stream_url_expiry(audio_url), local)
+        self.recover_attempts = 0
+        state.started_at = datetime.now(timezone.utc)
+        touch_active(self.guild_id)
+        TRACK_GAP_SECONDS.observe(0.0)
+        prefetcher.schedule(self.guild_id)
+        panels.touch(self.guild_id)
+
+    async def _audio_url(self, track: Track) -> Tuple[str, bool]:
+        # 本機快取命中就直接播檔案，不用解析串流
+        local_path = audio_cache.lookup(track.webpage_url)
+        if local_path:
+            return local_path, True
+        audio_url = prefetcher.take(self.guild_id, track.webpage_url)  # type: ignore
+        if audio_url is None:
+            audio_url = await resolve_audio_url(self.guild_id, track.webpage_url)  # type: ignore
+        return audio_url, False
+
+    def _record(self, state: GuildState, track: Track):
+        state.now_playing = track
+        enricher.schedule(self.guild_id)  # 佇列往前移，補下一段
+
+        # 更新播放歷史（環狀緩衝區只留最近 HISTORY_SIZE 首）
+        state.history.append(track)
+        entry = state.play_stats.record(track)
+        suggestions.note_play(self.guild_id, track)
+        state_store.count_play(self.guild_id, entry)
+        state_store.mark(self.guild_id)
+        audio_cache.maybe_store(self.guild_id, track, entry.count)
+
+    async def _play_next(self):
+        state = get_state(self.guild_id)
+        skip = self.skip_requested
+        self.skip_requested = False
+
+        while True:
+            vc = self.voice_client()
+            if vc is None:
+                return
+
+            if state.loop and state.now_playing and not skip:
+                # 單曲循環：再播一次現在這首
+                track = state.now_playing
+            else:
+                if not state.queue:
+                    state.now_playing = None
+                    state.started_at = None
+                    self.source = self.stream = self.fading = None
+                    self.requested_at = self.finished_at = None
+                    idle_scheduler.reschedule(self.guild_id)
+                    panels.touch(self.guild_id)
+                    return
+                track = state.queue.popleft()
+                self._record(state, track)
+            skip = False
+
+            try:
+                audio_url, local = await self._audio_url(track)
+            except Exception as e:
+                # 這首解析失敗就換下一首（不再循環這首）
+                print(f"無法播放 {track.title}:", e)
+                ERRORS.inc("resolve_stream")
+                state.now_playing = None
                 continue
 
-            idle_seconds = (now - last).total_seconds()
-            # 語音頻道中是否有非機器人的成員
-            channel = vc.channel
-            if not channel:
+            try:
+                started = await self._start(track, audio_url, local)
+            except Exception as e:
+                print(f"無法播放 {track.title}:", e)
+                ERRORS.inc("create_source")
+                state.now_playing = None
                 continue
-            non_bot_members = [m for m in channel.members if not m.bot]
+            if not started:
+                return
+
+            self.recover_attempts = 0
+            now = time.perf_counter()
+            if self.requested_at is not None:
+                FIRST_AUDIO_SECONDS.observe(now - self.requested_at)
+            if self.finished_at is not None:
+                TRACK_GAP_SECONDS.observe(now - self.finished_at)
+            self.requested_at = self.finished_at = None
+            prefetcher.schedule(self.guild_id)
+            panels.touch(self.guild_id)
+            return
+
+
+players: Dict[int, GuildPlayer] = {}
+
 
-            # 條件：沒人聽歌，或沒在播且佇列空 & 閒置 > 300 秒
-            if (not non_bot_members or (not vc.is_playing() and not queues.get(guild_id))) and idle_seconds > 300:
+def get_player(guild_id: int) -> GuildPlayer:
+    player = players.get(guild_id)
+    if player is None:
+        player = players[guild_id] = GuildPlayer(guild_id)
+    return player
+
+
+# ============================================================
+# 自動斷線：依各 guild 的閒置期限排程（timer heap）
+# ============================================================
+IDLE_TIMEOUT = 300  # 閒置幾秒後自動斷線
+
+
+class IdleScheduler:
+    # heap 裡放 (期限, guild_id)，只在最早的期限到了才醒來檢查那個 guild。
+    # 重新排程時不刪舊的項目，deadlines 對不上的就當作過期直接略過（lazy deletion）。
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.heap: List[Tuple[float, int]] = []
+        self.deadlines: Dict[int, float] = {}
+        self.wakeup = asyncio.Event()
+
+    def reschedule(self, guild_id: int):
+        # 期限 = 最後活躍時間 + timeout
+        state = guild_states.get(guild_id)
+        if state is None or state.last_active is None:
+            return
+        idle = (datetime.now(timezone.utc) - state.last_active).total_seconds()
+        deadline = time.monotonic() + max(self.timeout - idle, 0.0)
+        self.deadlines[guild_id] = deadline
+        heapq.heappush(self.heap, (deadline, guild_id))
+        if self.heap[0] == (deadline, guild_id):
+            self.wakeup.set()
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            # 過期項目太多時重建一次
+            self.heap = [(d, g) for g, d in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+    def cancel(self, guild_id: int):
+        self.deadlines.pop(guild_id, None)
+
+    async def run(self):
+        await bot.wait_until_ready()
+        while not bot.is_closed():
+            now = time.monotonic()
+            while self.heap and self.heap[0][0] <= now:
+                deadline, guild_id = heapq.heappop(self.heap)
+                if self.deadlines.get(guild_id) != deadline:
+                    continue  # 已重新排程或取消
+                del self.deadlines[guild_id]
                 try:
-                    await vc.disconnect()
-                    now_playing[guild_id] = None
-                    queues[guild_id] = []
-                    loop_flags[guild_id] = False
-                    start_times[guild_id] = None
-                    print(f"自動斷線：guild {guild_id}")
+                    await self._check(guild_id)
                 except Exception as e:
                     print("自動斷線錯誤:", e)
-        await asyncio.sleep(60)
+                    ERRORS.inc("auto_disconnect")
+
+            timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _check(self, guild_id: int):
+        guild = bot.get_guild(guild_id)
+        vc: discord.VoiceClient = guild.voice_client if guild else None  # type: ignore
+        if not vc or not vc.is_connected() or not vc.channel:
+            return
+
+        state = get_state(guild_id)
+        idle_seconds = (datetime.now(timezone.utc) - state.last_active).total_seconds()  # type: ignore
+        # 語音頻道中是否有非機器人的成員
+        has_listener = any(not m.bot for m in vc.channel.members)
+
+        # 條件：沒人聽歌，或沒在播且佇列空 & 閒置 > IDLE_TIMEOUT 秒
+        if (not has_listener or (not vc.is_playing() and not state.queue)) and idle_seconds >= self.timeout:
+            await vc.disconnect()
+            cancel_ingest(guild_id)
+            state.reset_playback()
+            state_store.mark(guild_id)
+            prefetcher.invalidate(guild_id)
+            enricher.cancel(guild_id)
+            panels.touch(guild_id)
+            print(f"自動斷線：guild {guild_id}")
+        else:
+            # 還在用：保險起見 timeout 後再看一次（狀態改變時也會重新排程）
+            self.deadlines[guild_id] = deadline = time.monotonic() + self.timeout
+            heapq.heappush(self.heap, (deadline, guild_id))
+
+
+idle_scheduler = IdleScheduler(IDLE_TIMEOUT)
+
+
+@bot.event
+async def on_voice_state_update(member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
+    guild = member.guild
+    vc = guild.voice_client
+    if member.id == bot.user.id and after.channel is None:
+        # 機器人自己離開語音頻道
+        idle_scheduler.cancel(guild.id)
+        return
+    if vc is None or vc.channel is None:
+        return
+    if vc.channel in (before.channel, after.channel) and before.channel != after.channel:
+        # 有人進出機器人所在的頻道
+        idle_scheduler.reschedule(guild.id)
 
 
 # ============================================================
 # 工具：確保在語音頻道
 # ============================================================
 async def ensure_voice(interaction: discord.Interaction) -> Optional[discord.VoiceClient]:
+    with span("ensure_voice"):
+        return await _ensure_voice(interaction)
+
+
+async def _ensure_voice(interaction: discord.Interaction) -> Optional[discord.VoiceClient]:
     if not interaction.user.voice or not interaction.user.voice.channel:
         await interaction.response.send_message("❌ 你需要先加入一個語音頻道！", ephemeral=True)
         return None
@@ -253,47 +3218,62 @@ def fmt_time(sec: int) -> str:
     return f"{sec // 60:02d}:{sec % 60:02d}"
 
 
+def fmt_long_time(sec: int) -> str:
+    if sec < 3600:
+        return fmt_time(sec)
+    return f"{sec // 3600}:{sec % 3600 // 60:02d}:{sec % 60:02d}"
+
+
 # ============================================================
 # Slash 指令：/play
 # ============================================================
-@tree.command(name="play", description="播放音樂（支援YouTube/關鍵字/Spotify單曲連結）")
+@tree.command(name="play", description="播放音樂（支援YouTube/關鍵字/Spotify單曲、專輯、歌單連結）")
+@app_commands.autocomplete(query=play_autocomplete)
+@traced()
 async def play_cmd(interaction: discord.Interaction, query: str):
-    await interaction.response.defer()
+    t0 = time.perf_counter()
+    with span("defer"):
+        await interaction.response.defer()
 
     guild_id = interaction.guild_id
     vc = await ensure_voice(interaction)
     if vc is None:
         return
 
+    link = parse_spotify(query)
+    if link is not None and link[0] != "track":
+        # Spotify 專輯 / 歌單：和 /playlist 一樣在背景一段段加入
+        await queue_spotify(interaction, guild_id, link[0], link[1], PLAYLIST_DEFAULT)
+        return
+
     try:
-        track = get_track_info(query)
+        track = await resolve_track(guild_id, query, timeout=interaction_timeout(interaction))
     except Exception as e:
         await interaction.followup.send(f"❌ 取得音樂資訊失敗：{e}")
         return
 
-    if guild_id not in queues:
-        queues[guild_id] = []
-    queues[guild_id].append(track)
+    get_state(guild_id).queue.append(track)
+    state_store.mark(guild_id)
 
     # 建立佇列 Embed
     embed = discord.Embed(
         title="🎶 已加入佇列",
-        description=f"**{track['title']}**",
+        description=f"**{track.title}**",
         color=discord.Color.blurple(),
     )
-    embed.add_field(name="來源", value=track["webpage_url"], inline=False)
-    if track.get("duration"):
-        d = int(track["duration"])  # type: ignore
-        embed.add_field(name="長度", value=f"{fmt_time(d)}", inline=True)
-    if track.get("uploader"):
-        embed.add_field(name="頻道", value=track["uploader"], inline=True)
-    if track.get("thumbnail"):
-        embed.set_thumbnail(url=track["thumbnail"])
-
-    await interaction.followup.send(embed=embed)
+    embed.add_field(name="來源", value=track.webpage_url, inline=False)
+    if track.duration:
+        embed.add_field(name="長度", value=f"{fmt_time(track.duration)}", inline=True)
+    if track.uploader:
+        embed.add_field(name="頻道", value=track.uploader, inline=True)
+    if track.thumbnail:
+        embed.set_thumbnail(url=track.thumbnail)
 
-    if not vc.is_playing():
-        await play_next(guild_id, vc)
+    with span("followup"):
+        await interaction.followup.send(embed=embed)
+    player = get_player(guild_id)
+    player.mark_requested(t0)
+    player.send("wake")
 
 
 # ============================================================
@@ -323,34 +3303,40 @@ class SearchButton(discord.ui.Button):
         self.track = track
         self.parent_view = view
 
+    @traced("search_button")
     async def callback(self, interaction: discord.Interaction):
         guild_id = interaction.guild_id
         vc = await ensure_voice(interaction)
         if vc is None:
             return
 
-        if guild_id not in queues:
-            queues[guild_id] = []
-        queues[guild_id].append(self.track)
+        get_state(guild_id).queue.append(self.track)
+        state_store.mark(guild_id)
 
-        if not vc.is_playing():
-            await play_next(guild_id, vc)
-
-        await interaction.response.edit_message(
-            content=f"✅ 已選擇並加入佇列：**{self.track['title']}**",
-            view=None
-        )
+        with span("respond"):
+            await interaction.response.edit_message(
+                content=f"✅ 已選擇並加入佇列：**{self.track.title}**",
+                view=None
+            )
+        get_player(guild_id).send("wake")
 
 
 @tree.command(name="search", description="搜尋歌曲並從多個結果中選擇播放")
+@app_commands.autocomplete(keyword=search_autocomplete)
+@traced()
 async def search_cmd(interaction: discord.Interaction, keyword: str):
-    await interaction.response.defer(ephemeral=True)
+    with span("defer"):
+        await interaction.response.defer(ephemeral=True)
 
-    q = f"ytsearch5:{keyword}"
-    with yt_dlp.YoutubeDL(YDL_OPTS_BASE) as ydl:
-        info = ydl.extract_info(q, download=False)
+    try:
+        entries = await resolver.run(
+            interaction.guild_id, search_entries, keyword, 5,
+            timeout=interaction_timeout(interaction),
+        )
+    except Exception as e:
+        await interaction.followup.send(f"❌ 搜尋失敗：{e}", ephemeral=True)
+        return
 
-    entries = info.get("entries", [])[:5]
     if not entries:
         await interaction.followup.send("❌ 找不到相關歌曲。", ephemeral=True)
         return
@@ -358,16 +3344,11 @@ async def search_cmd(interaction: discord.Interaction, keyword: str):
     results: List[Track] = []
     desc_lines = []
     for i, e in enumerate(entries, start=1):
-        t = {
-            "webpage_url": e.get("webpage_url") or e.get("url"),
-            "title": e.get("title", "未知標題"),
-            "duration": str(e.get("duration") or 0),
-            "thumbnail": e.get("thumbnail"),
-            "uploader": e.get("uploader"),
-        }
+        t = Track.from_info(e)
         results.append(t)
-        d = int(t["duration"]) if t["duration"] else 0
-        desc_lines.append(f"`{i}.` {t['title']} （{fmt_time(d)}）")
+        track_cache.put(t)
+        suggestions.note_resolved(t)
+        desc_lines.append(f"`{i}.` {t.title} （{fmt_time(t.duration)}）")
 
     embed = discord.Embed(
         title=f"🔍 搜尋結果：{keyword}",
@@ -376,64 +3357,206 @@ async def search_cmd(interaction: discord.Interaction, keyword: str):
     )
 
     view = SearchView(interaction.user.id, results, interaction.guild_id)
-    await interaction.followup.send(embed=embed, view=view, ephemeral=True)
+    with span("followup"):
+        await interaction.followup.send(embed=embed, view=view, ephemeral=True)
 
 
 # ============================================================
 # Slash 指令：/queue & /clearqueue
 # ============================================================
+QUEUE_PAGE_SIZE = 10
+QUEUE_TITLE_MAX = 80  # 每行標題截斷，一頁再長也不會超過 embed 的 4096 字上限
+
+
+class QueueView(discord.ui.View):
+    # 只算目前這一頁；翻頁時重新讀佇列，所以佇列變動後翻頁看到的就是最新內容
+    def __init__(self, guild_id: int, timeout: int = 120):
+        super().__init__(timeout=timeout)
+        self.guild_id = guild_id
+        self.page = 0
+        self.message: Optional[discord.InteractionMessage] = None
+
+    def pages(self) -> int:
+        n = len(get_state(self.guild_id).queue)
+        return max((n + QUEUE_PAGE_SIZE - 1) // QUEUE_PAGE_SIZE, 1)
+
+    def render(self) -> discord.Embed:
+        state = get_state(self.guild_id)
+        q = state.queue
+        pages = self.pages()
+        self.page = min(max(self.page, 0), pages - 1)
+        start = self.page * QUEUE_PAGE_SIZE
+
+        lines = []
+        for i, t in enumerate(q.page(start, QUEUE_PAGE_SIZE), start=start + 1):
+            title = t.title if len(t.title) <= QUEUE_TITLE_MAX else t.title[:QUEUE_TITLE_MAX - 1] + "…"
+            length = fmt_time(t.duration) if t.duration else "--:--"
+            lines.append(f"`{i}.` {title} （{length}）")
+
+        # 剩餘總長 = 佇列總長 + 目前這首還沒播的部分
+        remaining = q.duration
+        np_track = state.now_playing
+        elapsed = playback_position(self.guild_id)
+        if np_track and np_track.duration and elapsed is not None:
+            remaining += max(np_track.duration - int(elapsed), 0)
+        header = f"共 {len(q)} 首，剩餘約 {fmt_long_time(remaining)}"
+        if q.unknown:
+            header += f"（{q.unknown} 首長度未知）"
+
+        embed = discord.Embed(
+            title="📜 播放佇列",
+            description=header + "\n\n" + ("\n".join(lines) or "📭 目前佇列是空的。"),
+            color=discord.Color.teal(),
+        )
+        embed.set_footer(text=f"第 {self.page + 1} / {pages} 頁")
+        self.first.disabled = self.prev.disabled = self.page == 0
+        self.next.disabled = self.last.disabled = self.page >= pages - 1
+        return embed
+
+    async def turn(self, interaction: discord.Interaction, page: int):
+        self.page = page
+        await interaction.response.edit_message(embed=self.render(), view=self)
+
+    @discord.ui.button(emoji="⏮", style=discord.ButtonStyle.secondary)
+    @traced("queue_first")
+    async def first(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.turn(interaction, 0)
+
+    @discord.ui.button(emoji="◀", style=discord.ButtonStyle.primary)
+    @traced("queue_prev")
+    async def prev(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.turn(interaction, self.page - 1)
+
+    @discord.ui.button(emoji="▶", style=discord.ButtonStyle.primary)
+    @traced("queue_next")
+    async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.turn(interaction, self.page + 1)
+
+    @discord.ui.button(emoji="⏭", style=discord.ButtonStyle.secondary)
+    @traced("queue_last")
+    async def last(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.turn(interaction, self.pages() - 1)
+
+    async def on_timeout(self):
+        if self.message is not None:
+            try:
+                await self.message.edit(view=None)
+            except discord.HTTPException:
+                pass
+
+
 @tree.command(name="queue", description="查看目前播放佇列")
+@traced()
 async def queue_cmd(interaction: discord.Interaction):
     guild_id = interaction.guild_id
-    q = queues.get(guild_id, [])
+    q = get_state(guild_id).queue
 
     if not q:
         await interaction.response.send_message("📭 目前佇列是空的。")
         return
 
-    lines = []
-    for i, t in enumerate(q, start=1):
-        d = int(t["duration"]) if t.get("duration") else 0
-        lines.append(f"`{i}.` {t['title']} （{fmt_time(d)}）")
-
-    embed = discord.Embed(
-        title="📜 播放佇列",
-        description="\n".join(lines),
-        color=discord.Color.teal(),
-    )
-    await interaction.response.send_message(embed=embed)
+    view = QueueView(guild_id)
+    embed = view.render()
+    if len(q) <= QUEUE_PAGE_SIZE:
+        await interaction.response.send_message(embed=embed)
+        return
+    await interaction.response.send_message(embed=embed, view=view)
+    view.message = await interaction.original_response()
 
 
 @tree.command(name="clearqueue", description="清空佇列（不影響目前播放）")
+@traced()
 async def clearqueue_cmd(interaction: discord.Interaction):
     guild_id = interaction.guild_id
-    queues[guild_id] = []
+    cancel_ingest(guild_id)
+    get_state(guild_id).queue.clear()
+    state_store.mark(guild_id)
+    prefetcher.invalidate(guild_id)
+    enricher.cancel(guild_id)
     await interaction.response.send_message("🧹 已清空佇列（目前播放中的歌曲不受影響）。")
 
 
+# ============================================================
+# Slash 指令：/shuffle /move /remove（調整佇列順序）
+# ============================================================
+def requeue_prefetch(guild_id: int):
+    # 佇列順序變了，預解析的結果作廢後重新來過
+    state_store.mark(guild_id)
+    prefetcher.invalidate(guild_id)
+    enricher.schedule(guild_id)
+    guild = bot.get_guild(guild_id)
+    vc = guild.voice_client if guild else None
+    if vc and vc.is_playing():
+        prefetcher.schedule(guild_id)
+
+
+@tree.command(name="shuffle", description="隨機打亂佇列順序")
+@traced()
+async def shuffle_cmd(interaction: discord.Interaction):
+    guild_id = interaction.guild_id
+    state = get_state(guild_id)
+    if not state.queue:
+        await interaction.response.send_message("📭 目前佇列是空的。")
+        return
+    state.queue.shuffle()
+    requeue_prefetch(guild_id)
+    await interaction.response.send_message(f"🔀 已打亂佇列（共 {len(state.queue)} 首）。")
+
+
+@tree.command(name="move", description="移動佇列中的歌曲（編號從 1 開始）")
+@traced()
+async def move_cmd(interaction: discord.Interaction, src: int, dst: int):
+    guild_id = interaction.guild_id
+    state = get_state(guild_id)
+    n = len(state.queue)
+    if not (1 <= src <= n and 1 <= dst <= n):
+        await interaction.response.send_message(f"❌ 編號需在 1 ~ {n} 之間。", ephemeral=True)
+        return
+    state.queue.move(src - 1, dst - 1)
+    requeue_prefetch(guild_id)
+    await interaction.response.send_message(f"↕ 已將第 {src} 首移到第 {dst} 首。")
+
+
+@tree.command(name="remove", description="從佇列移除一首歌（編號從 1 開始）")
+@traced()
+async def remove_cmd(interaction: discord.Interaction, index: int):
+    guild_id = interaction.guild_id
+    state = get_state(guild_id)
+    n = len(state.queue)
+    if not 1 <= index <= n:
+        await interaction.response.send_message(f"❌ 編號需在 1 ~ {n} 之間。", ephemeral=True)
+        return
+    track = state.queue.remove(index - 1)
+    requeue_prefetch(guild_id)
+    await interaction.response.send_message(f"🗑 已移除：**{track.title}**")
+
+
 # ============================================================
 # Slash 指令：/skip /loop /pause /resume /stop /leave
 # ============================================================
 @tree.command(name="skip", description="跳過目前這首歌")
+@traced()
 async def skip_cmd(interaction: discord.Interaction):
     vc: discord.VoiceClient = interaction.guild.voice_client  # type: ignore
     if not vc or not vc.is_playing():
         await interaction.response.send_message("❌ 目前沒有正在播放的歌曲。")
         return
-    vc.stop()
+    get_player(interaction.guild_id).send("skip")
     touch_active(interaction.guild_id)
     await interaction.response.send_message("⏭ 已跳過目前歌曲。")
 
 
 @tree.command(name="loop", description="設定是否開啟單曲循環（true=開 / false=關）")
+@traced()
 async def loop_cmd(interaction: discord.Interaction, enabled: bool):
     guild_id = interaction.guild_id
-    loop_flags[guild_id] = enabled
+    get_player(guild_id).send("loop", enabled)
     msg = "🔁 已開啟單曲循環。" if enabled else "⏹ 已關閉單曲循環。"
     await interaction.response.send_message(msg)
 
 
 @tree.command(name="pause", description="暫停播放")
+@traced()
 async def pause_cmd(interaction: discord.Interaction):
     vc: discord.VoiceClient = interaction.guild.voice_client  # type: ignore
     if not vc or not vc.is_playing():
@@ -441,10 +3564,12 @@ async def pause_cmd(interaction: discord.Interaction):
         return
     vc.pause()
     touch_active(interaction.guild_id)
+    panels.touch(interaction.guild_id)
     await interaction.response.send_message("⏸ 已暫停播放。")
 
 
 @tree.command(name="resume", description="繼續播放")
+@traced()
 async def resume_cmd(interaction: discord.Interaction):
     vc: discord.VoiceClient = interaction.guild.voice_client  # type: ignore
     if not vc or not vc.is_paused():
@@ -452,59 +3577,52 @@ async def resume_cmd(interaction: discord.Interaction):
         return
     vc.resume()
     touch_active(interaction.guild_id)
+    panels.touch(interaction.guild_id)
     await interaction.response.send_message("▶ 已繼續播放。")
 
 
 @tree.command(name="stop", description="停止播放並清空佇列")
+@traced()
 async def stop_cmd(interaction: discord.Interaction):
-    guild_id = interaction.guild_id
-    queues[guild_id] = []
-    loop_flags[guild_id] = False
-    now_playing[guild_id] = None
-    start_times[guild_id] = None
-
-    vc: discord.VoiceClient = interaction.guild.voice_client  # type: ignore
-    if vc and (vc.is_playing() or vc.is_paused()):
-        vc.stop()
-
+    cancel_ingest(interaction.guild_id)
+    get_player(interaction.guild_id).send("stop")
     await interaction.response.send_message("⏹ 已停止播放並清空佇列。")
 
 
 @tree.command(name="leave", description="讓機器人離開語音頻道")
+@traced()
 async def leave_cmd(interaction: discord.Interaction):
     vc: discord.VoiceClient = interaction.guild.voice_client  # type: ignore
     if not vc:
         await interaction.response.send_message("❌ 我目前不在任何語音頻道裡。")
         return
     await vc.disconnect()
+    panels.touch(interaction.guild_id)
     await interaction.response.send_message("👋 已離開語音頻道。")
 
 
 # ============================================================
 # Slash 指令：/nowplaying（進度條 + 封面）
 # ============================================================
-@tree.command(name="nowplaying", description="顯示目前正在播放的歌曲")
-async def nowplaying_cmd(interaction: discord.Interaction):
-    guild_id = interaction.guild_id
-    track = now_playing.get(guild_id)
-    if not track:
-        await interaction.response.send_message("🎧 目前沒有正在播放的歌曲。")
-        return
+def build_nowplaying_embed(guild_id: int) -> Optional[discord.Embed]:
+    state = guild_states.get(guild_id)
+    track = state.now_playing if state else None
+    guild = bot.get_guild(guild_id)
+    vc = guild.voice_client if guild else None
+    if not track or vc is None:
+        return None
 
-    duration = int(track.get("duration") or 0)
-    started = start_times.get(guild_id)
-    if started:
-        elapsed = int((datetime.now(timezone.utc) - started).total_seconds())
-    else:
-        elapsed = 0
+    duration = track.duration
+    elapsed = int(playback_position(guild_id) or 0)
 
     if duration > 0:
         elapsed = max(0, min(elapsed, duration))
 
     bar = build_progress_bar(elapsed, duration)
+    paused = vc.is_paused()  # type: ignore
     embed = discord.Embed(
-        title="🎧 正在播放",
-        description=f"**[{track['title']}]({track['webpage_url']})**",
+        title="⏸ 已暫停" if paused else "🎧 正在播放",
+        description=f"**[{track.title}]({track.webpage_url})**",
         color=discord.Color.orange(),
     )
     if duration > 0:
@@ -513,29 +3631,231 @@ async def nowplaying_cmd(interaction: discord.Interaction):
             value=f"`{fmt_time(elapsed)} / {fmt_time(duration)}`\n{bar}",
             inline=False,
         )
-    if track.get("uploader"):
-        embed.add_field(name="頻道", value=track["uploader"], inline=True)
-    if track.get("thumbnail"):
-        embed.set_thumbnail(url=track["thumbnail"])
+    if track.uploader:
+        embed.add_field(name="頻道", value=track.uploader, inline=True)
+    if track.thumbnail:
+        embed.set_thumbnail(url=track.thumbnail)
+    return embed
+
+
+# ============================================================
+# 正在播放面板：每個 guild 一則訊息，用編輯更新進度
+# ============================================================
+PANEL_INTERVAL = float(os.getenv("PANEL_INTERVAL", "15"))    # 單一面板的進度更新間隔（秒）
+PANEL_EDIT_RATE = float(os.getenv("PANEL_EDIT_RATE", "4"))   # 全 bot 每秒最多幾次編輯
+PANEL_CHANNEL_GAP = 2.0  # 同一頻道兩次編輯至少隔幾秒（Discord 大約每頻道 5 次 / 5 秒）
+
+
+class Panel:
+    __slots__ = ("guild_id", "message", "due", "last_edit", "failures")
+
+    def __init__(self, guild_id: int, message: discord.PartialMessage):
+        self.guild_id = guild_id
+        self.message = message
+        self.due: Optional[float] = None
+        self.last_edit = time.monotonic()
+        self.failures = 0
+
+
+class PanelScheduler:
+    # 所有 guild 的面板編輯都由這一個協程送出：
+    #   - 同一面板在送出前的多次變動（換歌、暫停…）合併成一次編輯
+    #   - 同一頻道的編輯至少隔 PANEL_CHANNEL_GAP 秒
+    #   - 全 bot 每秒最多 PANEL_EDIT_RATE 次；面板多時拉長每個面板的進度更新間隔
+    # heap 和 IdleScheduler 一樣用 lazy deletion：due 對不上的項目直接略過
+    def __init__(self, interval: float, rate: float):
+        self.base_interval = interval
+        self.rate = rate
+        self.panels: Dict[int, Panel] = {}
+        self.heap: List[Tuple[float, int]] = []
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def interval(self) -> float:
+        return max(self.base_interval, len(self.panels) / self.rate)
+
+    def attach(self, guild_id: int, message: discord.PartialMessage):
+        old = self.panels.get(guild_id)
+        if old is not None and old.message.id != message.id:
+            # 一個 guild 只留一則面板：舊的刪掉
+            asyncio.get_running_loop().create_task(self._delete(old.message))
+        panel = self.panels[guild_id] = Panel(guild_id, message)
+        self._push(panel, time.monotonic() + self.interval())
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def detach(self, guild_id: int):
+        self.panels.pop(guild_id, None)
+
+    def touch(self, guild_id: int):
+        # 狀態變了：盡快更新（同頻道間隔內的變動會合併）
+        panel = self.panels.get(guild_id)
+        if panel is not None:
+            self._push(panel, max(time.monotonic(), panel.last_edit + PANEL_CHANNEL_GAP))
+
+    def _push(self, panel: Panel, due: float):
+        if panel.due is not None and panel.due <= due:
+            return  # 已經排了更早的
+        panel.due = due
+        heapq.heappush(self.heap, (due, panel.guild_id))
+        if self.wakeup is not None and self.heap[0] == (due, panel.guild_id):
+            self.wakeup.set()
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        while self.panels:
+            now = time.monotonic()
+            if self.heap and self.heap[0][0] <= now:
+                due, guild_id = heapq.heappop(self.heap)
+                panel = self.panels.get(guild_id)
+                if panel is None or panel.due != due:
+                    continue  # 已重新排程或已移除
+                panel.due = None
+                await self._edit(panel)
+                await asyncio.sleep(1 / self.rate)  # 全 bot 的編輯速率上限
+                continue
+
+            timeout = self.heap[0][0] - now if self.heap else None
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _edit(self, panel: Panel):
+        guild_id = panel.guild_id
+        embed = build_nowplaying_embed(guild_id)
+        try:
+            if embed is None:
+                # 播完 / 停止 / 離開：最後改一次就不再更新
+                self.detach(guild_id)
+                await panel.message.edit(content="⏹ 目前沒有正在播放的歌曲。", embed=None)
+                return
+            await panel.message.edit(embed=embed)
+        except discord.NotFound:
+            self.detach(guild_id)  # 訊息被刪了
+            return
+        except discord.HTTPException as e:
+            panel.failures += 1
+            print(f"更新正在播放面板失敗（guild {guild_id}）:", e)
+            ERRORS.inc("panel")
+            if panel.failures >= 3:
+                self.detach(guild_id)
+                return
+        else:
+            panel.failures = 0
+        panel.last_edit = time.monotonic()
+
+        # 有在走的進度條才需要定期更新；暫停中等 touch 再更新
+        state = guild_states.get(guild_id)
+        guild = bot.get_guild(guild_id)
+        vc = guild.voice_client if guild else None
+        if state and state.now_playing and state.now_playing.duration and vc and vc.is_playing():
+            backoff = 2 ** panel.failures
+            self._push(panel, panel.last_edit + self.interval() * backoff)
+
+    async def _delete(self, message: discord.PartialMessage):
+        try:
+            await message.delete()
+        except discord.HTTPException:
+            pass
+
+
+panels = PanelScheduler(PANEL_INTERVAL, PANEL_EDIT_RATE)
+
+
+# ============================================================
+# Slash 指令：/nowplaying（進度條 + 封面，之後自動更新）
+# ============================================================
+@tree.command(name="nowplaying", description="顯示目前正在播放的歌曲")
+@traced()
+async def nowplaying_cmd(interaction: discord.Interaction):
+    guild_id = interaction.guild_id
+    embed = build_nowplaying_embed(guild_id)
+    if embed is None:
+        await interaction.response.send_message("🎧 目前沒有正在播放的歌曲。")
+        return
 
     await interaction.response.send_message(embed=embed)
+    # interaction 的 token 15 分鐘就過期，之後改用頻道訊息編輯
+    msg = await interaction.original_response()
+    panels.attach(guild_id, msg.channel.get_partial_message(msg.id))  # type: ignore
+
+
+# ============================================================
+# Slash 指令：/seek（跳到指定位置）
+# ============================================================
+def parse_time(text: str) -> Optional[int]:
+    # 接受 "90"、"1:30"、"1:02:03"
+    parts = text.strip().split(":")
+    if not 1 <= len(parts) <= 3 or not all(p.isdigit() for p in parts):
+        return None
+    sec = 0
+    for p in parts:
+        sec = sec * 60 + int(p)
+    return sec
+
+
+@tree.command(name="seek", description="跳到目前歌曲的指定位置（例如 90 或 1:30）")
+@traced()
+async def seek_cmd(interaction: discord.Interaction, position: str):
+    guild_id = interaction.guild_id
+    state = guild_states.get(guild_id)
+    track = state.now_playing if state else None
+    player = players.get(guild_id)
+    if not track or player is None or player.source is None:
+        await interaction.response.send_message("❌ 目前沒有正在播放的歌曲。", ephemeral=True)
+        return
+
+    offset = parse_time(position)
+    if offset is None:
+        await interaction.response.send_message("❌ 時間格式不對，請輸入秒數或 分:秒。", ephemeral=True)
+        return
+    if track.duration and offset >= track.duration:
+        await interaction.response.send_message(
+            f"❌ 超過歌曲長度（{fmt_time(track.duration)}）。", ephemeral=True
+        )
+        return
+
+    with span("defer"):
+        await interaction.response.defer()
+    fut = asyncio.get_running_loop().create_future()
+    player.send("seek", (float(offset), fut))
+    try:
+        with span("seek"):
+            await asyncio.wait_for(fut, timeout=interaction_timeout(interaction))
+    except Exception as e:
+        await interaction.followup.send(f"❌ 跳轉失敗：{e}")
+        return
+    with span("followup"):
+        await interaction.followup.send(f"⏩ 已跳到 `{fmt_time(offset)}`：**{track.title}**")
 
 
 # ============================================================
 # Slash 指令：/volume（0~200%）
 # ============================================================
 @tree.command(name="volume", description="調整音量（0~200）")
+@traced()
 async def volume_cmd(interaction: discord.Interaction, volume: int):
     if volume < 0 or volume > 200:
         await interaction.response.send_message("❌ 音量範圍為 0 ~ 200。", ephemeral=True)
         return
 
     guild_id = interaction.guild_id
-    volume_settings[guild_id] = volume / 100.0
+    state = get_state(guild_id)
+    state.volume = volume / 100.0
+    state_store.mark(guild_id)
 
     vc: discord.VoiceClient = interaction.guild.voice_client  # type: ignore
-    if vc and vc.source and isinstance(vc.source, discord.PCMVolumeTransformer):
-        vc.source.volume = volume_settings[guild_id]
+    source = vc.source if vc else None
+    if isinstance(source, TrackedSource) and not isinstance(source, MixSource):
+        source = source.original
+    if isinstance(source, (discord.PCMVolumeTransformer, MixSource)):
+        source.volume = state.volume
+    elif source:
+        # Opus 直通模式沒辦法即時調整
+        await interaction.response.send_message(f"🔊 已將音量設定為 {volume}%（下一首開始生效）。")
+        return
 
     await interaction.response.send_message(f"🔊 已將音量設定為 {volume}%。")
 
@@ -543,62 +3863,153 @@ async def volume_cmd(interaction: discord.Interaction, volume: int):
 # ============================================================
 # Slash 指令：/playlist（加入 YouTube 播放清單）
 # ============================================================
-@tree.command(name="playlist", description="加入整個 YouTube 播放清單（預設最多50首）")
-async def playlist_cmd(interaction: discord.Interaction, url: str, limit: int = 50):
-    await interaction.response.defer()
+PLAYLIST_MAX = int(os.getenv("PLAYLIST_MAX", "5000"))       # /playlist 一次最多加入幾首
+PLAYLIST_DEFAULT = 50                                        # 沒指定 limit 時（/play 貼 Spotify 專輯 / 歌單也是）
+PLAYLIST_CHUNK = int(os.getenv("PLAYLIST_CHUNK", "50"))      # 每次從 yt-dlp 讀幾首
+PLAYLIST_STATUS_INTERVAL = 2.0                               # 狀態訊息最快幾秒更新一次
+
+# guild_id -> 背景加入歌曲的工作，依開始順序（只有 /stop、/clearqueue、自動斷線會取消）
+ingest_tasks: Dict[int, List[asyncio.Task]] = {}
+
+
+def start_ingest(guild_id: int, make: Callable[[Optional[asyncio.Task]], Any]):
+    # 同一個 guild 的清單依序讀：新的排在還在讀的那個後面，不會打斷別人加的清單
+    tasks = ingest_tasks.setdefault(guild_id, [])
+    after = tasks[-1] if tasks else None
+    tasks.append(asyncio.get_running_loop().create_task(make(after)))
+
+
+def cancel_ingest(guild_id: int):
+    for task in ingest_tasks.pop(guild_id, []):
+        if not task.done():
+            task.cancel()
+
+
+async def ingest_tracks(
+    guild_id: int,
+    status: discord.WebhookMessage,
+    label: str,
+    read: Callable[[int], Any],
+    limit: int,
+    after: Optional[asyncio.Task] = None,
+):
+    # 逐段把歌曲加進佇列：第一段只讀 1 首，讓第一首盡快開始播，後面再一段段補上
+    queue = get_state(guild_id).queue
+    added = 0
+    last_edit = time.monotonic()
+    done_msg = None
+    try:
+        if after is not None and not after.done():
+            await status.edit(content=f"📑 {label}：等前一個清單讀完…")
+            await asyncio.wait([after])
+        while added < limit:
+            n = 1 if added == 0 else min(PLAYLIST_CHUNK, limit - added)
+            tracks = await read(n)
+            if not tracks:
+                break
+            queue.extend(tracks)
+            added += len(tracks)
+            state_store.mark(guild_id)
+            get_player(guild_id).send("wake")
+
+            if time.monotonic() - last_edit >= PLAYLIST_STATUS_INTERVAL:
+                last_edit = time.monotonic()
+                await status.edit(content=f"📑 {label}：已加入 {added} 首，繼續讀取中…")
+        done_msg = f"📑 {label}：已加入 {added} 首歌曲到佇列。" if added else f"❌ {label}中沒有可用的音樂。"
+    except asyncio.CancelledError:
+        done_msg = f"⏹ {label}：已停止讀取（已加入 {added} 首）。"
+        raise
+    except Exception as e:
+        done_msg = f"❌ {label}讀取中斷（已加入 {added} 首）：{e}"
+    finally:
+        tasks = ingest_tasks.get(guild_id)
+        if tasks and asyncio.current_task() in tasks:
+            tasks.remove(asyncio.current_task())  # type: ignore
+            if not tasks:
+                del ingest_tasks[guild_id]
+        if done_msg:
+            try:
+                await status.edit(content=done_msg)
+            except discord.HTTPException:
+                pass
+
+
+SPOTIFY_KIND_NAMES = {"album": "專輯", "playlist": "歌單"}
+
+
+async def queue_spotify(interaction: discord.Interaction, guild_id: int, kind: str, sid: str, limit: int):
+    name = SPOTIFY_KIND_NAMES[kind]
+    reader = SpotifyReader(guild_id, kind, sid)
+    try:
+        await reader.open(timeout=interaction_timeout(interaction))
+    except Exception as e:
+        await interaction.followup.send(f"❌ 讀取 Spotify {name}失敗：{e}")
+        return
+
+    label = f"Spotify {name}「{reader.title}」" if reader.title else f"Spotify {name}"
+    with span("followup"):
+        status = await interaction.followup.send(f"📑 {label}：轉換中…", wait=True)
+
+    start_ingest(guild_id, lambda after: ingest_tracks(
+        guild_id, status, label, reader.read, max(1, min(limit, PLAYLIST_MAX)), after,
+    ))
+
+
+@tree.command(name="playlist", description="加入整個 YouTube 播放清單或 Spotify 專輯 / 歌單（預設最多50首）")
+@traced()
+async def playlist_cmd(interaction: discord.Interaction, url: str, limit: int = PLAYLIST_DEFAULT):
+    with span("defer"):
+        await interaction.response.defer()
 
     guild_id = interaction.guild_id
     vc = await ensure_voice(interaction)
     if vc is None:
         return
 
+    link = parse_spotify(url)
+    if link is not None and link[0] != "track":
+        await queue_spotify(interaction, guild_id, link[0], link[1], limit)
+        return
+
+    reader = PlaylistReader(url)
     try:
-        ydl_opts = dict(YDL_OPTS_BASE)
-        ydl_opts["extract_flat"] = "in_playlist"
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
+        await resolver.run(guild_id, reader.open, timeout=interaction_timeout(interaction))
     except Exception as e:
+        resolver.executor.submit(reader.close)
         await interaction.followup.send(f"❌ 讀取播放清單失敗：{e}")
         return
 
-    entries = info.get("entries", [])[:max(1, min(limit, 100))]
-    if not entries:
-        await interaction.followup.send("❌ 播放清單中沒有可用的音樂。")
-        return
+    label = f"播放清單「{reader.title}」" if reader.title else "播放清單"
+    with span("followup"):
+        status = await interaction.followup.send(f"📑 {label}：讀取中…", wait=True)
 
-    if guild_id not in queues:
-        queues[guild_id] = []
-
-    count = 0
-    for e in entries:
-        t = {
-            "webpage_url": e.get("url") or e.get("webpage_url"),
-            "title": e.get("title", "未知標題"),
-            "duration": str(e.get("duration") or 0),
-            "thumbnail": e.get("thumbnail"),
-            "uploader": e.get("uploader"),
-        }
-        queues[guild_id].append(t)
-        count += 1
+    async def read(n: int) -> List[Track]:
+        return await resolver.run(guild_id, reader.read, n)
 
-    await interaction.followup.send(f"📑 已從播放清單加入 {count} 首歌曲到佇列。")
+    async def run(after: Optional[asyncio.Task]):
+        try:
+            await ingest_tracks(guild_id, status, label, read, max(1, min(limit, PLAYLIST_MAX)), after)
+        finally:
+            # 正在讀的那段還沒結束時，close 會等它做完再歸還實例
+            resolver.executor.submit(reader.close)
 
-    if not vc.is_playing():
-        await play_next(guild_id, vc)
+    start_ingest(guild_id, run)
 
 
 # ============================================================
 # Slash 指令：/lyrics（給目前歌曲的歌詞搜尋連結）
 # ============================================================
 @tree.command(name="lyrics", description="顯示目前歌曲的歌詞搜尋連結")
+@traced()
 async def lyrics_cmd(interaction: discord.Interaction):
     guild_id = interaction.guild_id
-    track = now_playing.get(guild_id)
+    state = guild_states.get(guild_id)
+    track = state.now_playing if state else None
     if not track:
         await interaction.response.send_message("🎧 目前沒有正在播放的歌曲。")
         return
 
-    title = track.get("title") or ""
+    title = track.title or ""
     if not title:
         await interaction.response.send_message("❌ 找不到歌曲標題，無法搜尋歌詞。")
         return
@@ -617,16 +4028,17 @@ async def lyrics_cmd(interaction: discord.Interaction):
 # Slash 指令：/history /top /recommend
 # ============================================================
 @tree.command(name="history", description="顯示最近播放紀錄（最多20首）")
+@traced()
 async def history_cmd(interaction: discord.Interaction):
     guild_id = interaction.guild_id
-    h = history.get(guild_id, [])
-    if not h:
+    state = get_state(guild_id)
+    if not state.history:
         await interaction.response.send_message("📭 尚無播放紀錄。")
         return
 
     lines = []
-    for i, t in enumerate(h[-20:], start=1):
-        lines.append(f"`{i}.` {t.get('title', '未知標題')}")
+    for i, t in enumerate(state.history.recent(20), start=1):
+        lines.append(f"`{i}.` {t.title}")
     embed = discord.Embed(
         title="📚 最近播放紀錄",
         description="\n".join(lines),
@@ -636,58 +4048,579 @@ async def history_cmd(interaction: discord.Interaction):
 
 
 @tree.command(name="top", description="顯示本伺服器最常播放的前10首歌")
+@traced()
 async def top_cmd(interaction: discord.Interaction):
     guild_id = interaction.guild_id
-    pc = play_counts.get(guild_id, {})
-    if not pc:
+    stats = get_state(guild_id).play_stats
+    if not stats:
         await interaction.response.send_message("📭 尚無統計資料。")
         return
 
-    sorted_items = sorted(pc.items(), key=lambda x: x[1], reverse=True)[:10]
     lines = []
-    for i, (title, cnt) in enumerate(sorted_items, start=1):
-        lines.append(f"`{i}.` {title}（播放 {cnt} 次）")
+    for i, entry in enumerate(stats.top, start=1):
+        lines.append(f"`{i}.` [{entry.title}]({entry.url})（播放 {entry.count} 次）")
 
     embed = discord.Embed(
-        title="🏆 最常播放 TOP 10",
+        title=f"🏆 最常播放 TOP {TOP_K}",
         description="\n".join(lines),
         color=discord.Color.gold(),
     )
+    embed.set_footer(text=f"依近期播放排名（每 {PLAY_DECAY_HALF_LIFE / 86400:.0f} 天權重減半）")
     await interaction.response.send_message(embed=embed)
 
 
 @tree.command(name="recommend", description="根據歷史播放推薦一首常播放的歌曲")
+@traced()
 async def recommend_cmd(interaction: discord.Interaction):
-    import random
-
     guild_id = interaction.guild_id
-    pc = play_counts.get(guild_id, {})
-    if not pc:
+    # 加權隨機（近期播放越多次，被選到的機率越高）
+    entry = get_state(guild_id).play_stats.sample()
+    if entry is None:
         await interaction.response.send_message("📭 尚無播放紀錄可以推薦。")
         return
 
-    # 加權隨機（播放越多次，被選到的機率越高）
-    titles = list(pc.keys())
-    weights = [pc[t] for t in titles]
-    chosen_title = random.choices(titles, weights=weights, k=1)[0]
+    await interaction.response.send_message(
+        f"🤖 推薦你再聽一次：**{entry.title}**（依照近期播放次數推薦）\n<{entry.url}>"
+    )
+
 
-    await interaction.response.send_message(f"🤖 推薦你再聽一次：**{chosen_title}**（依照播放次數推薦）")
+# ============================================================
+# Slash 指令：/cachestats（歌曲資訊快取命中率）
+# ============================================================
+@tree.command(name="cachestats", description="顯示歌曲資訊快取的命中統計")
+@traced()
+async def cachestats_cmd(interaction: discord.Interaction):
+    st = track_cache.stats()
+    total = st["hits"] + st["disk_hits"] + st["misses"]
+    rate = (st["hits"] + st["disk_hits"]) / total * 100 if total else 0.0
+    embed = discord.Embed(
+        title="🗃 歌曲資訊快取",
+        description=(
+            f"記憶體命中：{st['hits']}\n"
+            f"磁碟命中：{st['disk_hits']}\n"
+            f"未命中：{st['misses']}\n"
+            f"合併查詢：{st['joined']}\n"
+            f"命中率：{rate:.1f}%（目前 {st['size']} 筆）"
+        ),
+        color=discord.Color.dark_grey(),
+    )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
 
 
 # ============================================================
-# Bot 啟動事件
+# 監控指標：即時數值 + HTTP 端點 + event loop 延遲
 # ============================================================
+def _ffmpeg_processes() -> Dict[tuple, float]:
+    alive = 0
+    for src in list(live_sources):
+        proc = getattr(src, "_process", None)
+        if proc is not None and getattr(proc, "poll", None) and proc.poll() is None:
+            alive += 1
+    return {("playback",): alive, ("audio_cache",): len(audio_cache.pending)}
+
+
+def _queue_depths() -> Dict[tuple, float]:
+    return {(gid,): len(st.queue) for gid, st in list(guild_states.items()) if st.queue}
+
+
+def _track_cache_stats() -> Dict[tuple, float]:
+    return {(k,): v for k, v in track_cache.stats().items()}
+
+
+register(Gauge("musicbot_ffmpeg_processes", "存活的 ffmpeg 程序數", _ffmpeg_processes, ("kind",)))
+register(Gauge("musicbot_queue_depth", "各 guild 佇列長度", _queue_depths, ("guild",)))
+register(Gauge("musicbot_voice_clients", "已連線的語音數", lambda: {(): len(bot.voice_clients)}))
+register(Gauge("musicbot_track_cache", "歌曲資訊快取統計", _track_cache_stats, ("stat",)))
+register(Gauge("musicbot_resolver_pending", "排隊中的查詢數", lambda: {
+    (): sum(len(q) for q in resolver.pending.values())
+}))
+register(Gauge("musicbot_broadcasts", "共用解碼的 ffmpeg 數 / 聽眾數", broadcasts.stats, ("stat",)))
+register(Gauge("musicbot_startup_seconds", "啟動各階段耗時", lambda: {
+    (name,): sec for name, sec in startup.phases
+}, ("phase",)))
+
+
+def render_metrics() -> bytes:
+    lines: List[str] = []
+    for m in metrics:
+        lines.extend(m.render())
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+async def _metrics_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await asyncio.wait_for(reader.readline(), timeout=5)
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass  # 略過 header
+        if request.split(b" ")[1:2] == [b"/metrics"]:
+            body, status = render_metrics(), "200 OK"
+        else:
+            body, status = b"not found\n", "404 Not Found"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception:
+        pass
+    finally:
+        writer.close()
+
+
+async def monitor_loop_lag(interval: float = 0.5):
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(max(time.perf_counter() - t0 - interval, 0.0))
+
+
+async def start_metrics():
+    if not METRICS_PORT:
+        return
+    # 叢集裡每個 worker 用不同的 port
+    port = METRICS_PORT + max(CLUSTER_WORKER, 0)
+    await asyncio.start_server(_metrics_handler, METRICS_HOST, port)
+    bot.loop.create_task(monitor_loop_lag())
+    print(f"📈 監控指標：http://{METRICS_HOST}:{port}/metrics")
+
+
+# ============================================================
+# Slash 指令：/profile（擁有者限定，對 event loop 做一段時間的效能剖析）
+# ============================================================
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))  # 取樣間隔（秒）
+PROFILE_MAX_SECONDS = 300
+profile_lock = asyncio.Lock()
+
+
+def _frame_stack(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def _sample_thread(ident: int, seconds: float, stop: threading.Event) -> Dict[str, int]:
+    # 另開執行緒定時抓 event loop 執行緒的呼叫堆疊，輸出 collapsed stack（可直接餵給 flamegraph.pl / speedscope）
+    stacks: Dict[str, int] = {}
+    deadline = time.monotonic() + seconds
+    while not stop.is_set() and time.monotonic() < deadline:
+        frame = sys._current_frames().get(ident)
+        if frame is not None:
+            key = _frame_stack(frame)
+            stacks[key] = stacks.get(key, 0) + 1
+        del frame
+        stop.wait(PROFILE_INTERVAL)
+    return stacks
+
+
+def _write_collapsed(path: str, stacks: Dict[str, int]):
+    lines = [f"{k} {v}" for k, v in sorted(stacks.items(), key=lambda kv: -kv[1])]
+    _atomic_write(path, ("\n".join(lines) + "\n").encode("utf-8"))
+
+
+@tree.command(name="profile", description="（擁有者）剖析 event loop 一段時間並上傳結果")
+@traced()
+async def profile_cmd(interaction: discord.Interaction, seconds: int = 30, mode: str = "sample"):
+    if not await bot.is_owner(interaction.user):
+        await interaction.response.send_message("⛔ 只有 Bot 擁有者可以使用這個指令。", ephemeral=True)
+        return
+    if mode not in ("sample", "pstats"):
+        await interaction.response.send_message("❌ mode 只能是 sample 或 pstats。", ephemeral=True)
+        return
+    if profile_lock.locked():
+        await interaction.response.send_message("⏳ 已經有一個剖析在進行中。", ephemeral=True)
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+
+    async with profile_lock:
+        await interaction.response.defer(ephemeral=True)
+        loop = asyncio.get_running_loop()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+
+        if mode == "sample":
+            path = os.path.join(PROFILE_DIR, f"loop-{stamp}.collapsed")
+            stop = threading.Event()
+            fut = loop.run_in_executor(None, _sample_thread, threading.get_ident(), seconds, stop)
+            try:
+                stacks = await fut
+            finally:
+                stop.set()
+            await loop.run_in_executor(None, _write_collapsed, path, stacks)
+            summary = f"{sum(stacks.values())} 個樣本、{len(stacks)} 種堆疊"
+        else:
+            # cProfile 只掛在 event loop 執行緒上，resolver / 寫入執行緒不會算進去
+            path = os.path.join(PROFILE_DIR, f"loop-{stamp}.pstats")
+            prof = cProfile.Profile()
+            prof.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                prof.disable()
+            await loop.run_in_executor(None, prof.dump_stats, path)
+            summary = "用 `python -m pstats` 或 snakeviz 開啟"
+
+        await interaction.followup.send(
+            f"📊 剖析完成（{mode}，{seconds} 秒）：{summary}",
+            file=discord.File(path),
+            ephemeral=True,
+        )
+
+
+# ============================================================
+# 叢集：launcher 啟動 / 監督 worker，worker 之間用 JSON lines 的 TCP 連線溝通
+# ============================================================
+# worker → launcher：
+#   {"op": "hello", "worker": n, "shards": [...]}
+#   {"op": "stats", "worker": n, "data": {...}}      每 CLUSTER_STATS_INTERVAL 秒回報一次
+#   {"op": "cluster_stats", "id": k}                 要所有 worker 的最新統計
+# launcher → worker：
+#   {"op": "cluster_stats", "id": k, "workers": {...}}
+#   {"op": "shutdown"}                               存好狀態後結束
+CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", "0"))  # > 1 時這個程序當 launcher
+CLUSTER_IPC_HOST = "127.0.0.1"
+CLUSTER_IPC_PORT = int(os.getenv("CLUSTER_IPC_PORT", "8765"))
+CLUSTER_STATS_INTERVAL = 15
+CLUSTER_RESTART_DELAY = 5
+
+
+def ipc_send(writer: asyncio.StreamWriter, msg: dict):
+    writer.write((json.dumps(msg, ensure_ascii=False) + "\n").encode("utf-8"))
+
+
+def recommended_shards() -> int:
+    req = urllib.request.Request(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={"Authorization": f"Bot {TOKEN}", "User-Agent": "DiscordBot (musicbot, 1.0)"},
+    )
+    with urllib.request.urlopen(req, timeout=10) as resp:
+        return int(json.load(resp)["shards"])
+
+
+def shard_ranges(shards: int, workers: int) -> List[List[int]]:
+    # 連續切段：worker i 負責 [i*S/W, (i+1)*S/W)
+    return [list(range(i * shards // workers, (i + 1) * shards // workers)) for i in range(workers)]
+
+
+class ClusterLauncher:
+    def __init__(self, workers: int, shards: int):
+        self.shards = shards
+        self.ranges = shard_ranges(shards, min(workers, shards))
+        self.writers: Dict[int, asyncio.StreamWriter] = {}
+        self.stats: Dict[int, dict] = {}
+        self.procs: Dict[int, asyncio.subprocess.Process] = {}
+        self.stopping = False
+
+    def worker_env(self, worker: int) -> Dict[str, str]:
+        env = dict(os.environ)
+        env["SHARD_COUNT"] = str(self.shards)
+        env["SHARD_IDS"] = ",".join(map(str, self.ranges[worker]))
+        env["CLUSTER_WORKER"] = str(worker)
+        if AUDIO_CACHE_DIR:
+            # 快取索引是單一程序在管，每個 worker 各用一個子目錄
+            env["AUDIO_CACHE_DIR"] = os.path.join(AUDIO_CACHE_DIR, f"worker{worker}")
+        if LOUDNESS_CACHE_PATH:
+            # 響度表每次整個檔案覆寫，共用的話 worker 會互相蓋掉對方量到的結果
+            env["LOUDNESS_CACHE_PATH"] = f"{LOUDNESS_CACHE_PATH}.worker{worker}"
+        # STATE_DB_PATH / SPOTIFY_INDEX_PATH 是 SQLite（WAL），多程序同時寫由 SQLite 的鎖處理；
+        # 每個 worker 的 guild 不重疊，Spotify 對照表同一首不管誰寫內容都一樣，所以共用同一個檔
+        return env
+
+    async def supervise(self, worker: int):
+        while not self.stopping:
+            proc = self.procs[worker] = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.abspath(__file__), env=self.worker_env(worker),
+            )
+            shards = self.ranges[worker]
+            print(f"🧩 worker {worker}（shard {shards[0]}-{shards[-1]}）pid {proc.pid}")
+            code = await proc.wait()
+            self.writers.pop(worker, None)
+            self.stats.pop(worker, None)
+            if self.stopping:
+                return
+            print(f"⚠ worker {worker} 結束（{code}），{CLUSTER_RESTART_DELAY} 秒後重啟")
+            await asyncio.sleep(CLUSTER_RESTART_DELAY)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        worker = None
+        try:
+            while line := await reader.readline():
+                msg = json.loads(line)
+                op = msg.get("op")
+                if op == "hello":
+                    worker = msg["worker"]
+                    self.writers[worker] = writer
+                elif op == "stats":
+                    self.stats[msg["worker"]] = dict(msg["data"], at=time.time())
+                elif op == "cluster_stats":
+                    ipc_send(writer, {"op": "cluster_stats", "id": msg["id"], "workers": self.stats})
+                    await writer.drain()
+        except (ConnectionError, ValueError, KeyError) as e:
+            print(f"叢集連線錯誤（worker {worker}）:", e)
+        finally:
+            if worker is not None and self.writers.get(worker) is writer:
+                del self.writers[worker]
+            writer.close()
+
+    def stop(self):
+        # 先請 worker 自己存檔結束，太久沒結束才強制終止
+        if self.stopping:
+            return
+        self.stopping = True
+        for w in list(self.writers.values()):
+            ipc_send(w, {"op": "shutdown"})
+        asyncio.get_running_loop().call_later(30, self.kill)
+
+    def kill(self):
+        for proc in self.procs.values():
+            if proc.returncode is None:
+                proc.kill()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+        server = await asyncio.start_server(self.handle, CLUSTER_IPC_HOST, CLUSTER_IPC_PORT)
+        print(f"🧩 叢集：{len(self.ranges)} 個 worker、{self.shards} 個 shard")
+        async with server:
+            await asyncio.gather(*(self.supervise(i) for i in range(len(self.ranges))))
+
+
+def cluster_snapshot() -> dict:
+    latency = bot.latency
+    return {
+        "shards": SHARD_IDS,
+        "pid": os.getpid(),
+        "guilds": len(bot.guilds),
+        "voice": len(bot.voice_clients),
+        "playing": sum(1 for vc in bot.voice_clients if vc.is_playing()),  # type: ignore
+        "queued": sum(len(st.queue) for st in guild_states.values()),
+        "latency_ms": round(latency * 1000) if latency == latency else None,  # 還沒 heartbeat 時是 nan
+    }
+
+
+class ClusterClient:
+    def __init__(self, worker: int):
+        self.worker = worker
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.waiters: Dict[int, asyncio.Future] = {}
+        self.seq = 0
+
+    async def run(self):
+        while not bot.is_closed():
+            try:
+                reader, writer = await asyncio.open_connection(CLUSTER_IPC_HOST, CLUSTER_IPC_PORT)
+            except OSError:
+                await asyncio.sleep(CLUSTER_RESTART_DELAY)
+                continue
+            self.writer = writer
+            ipc_send(writer, {"op": "hello", "worker": self.worker, "shards": SHARD_IDS})
+            reporter = asyncio.get_running_loop().create_task(self._report())
+            try:
+                while line := await reader.readline():
+                    await self._handle(json.loads(line))
+            except (ConnectionError, ValueError) as e:
+                print("叢集連線錯誤:", e)
+            finally:
+                reporter.cancel()
+                self.writer = None
+                writer.close()
+                for fut in self.waiters.values():
+                    if not fut.done():
+                        fut.set_exception(ConnectionError("與 launcher 的連線中斷"))
+                self.waiters.clear()
+            await asyncio.sleep(CLUSTER_RESTART_DELAY)
+
+    async def _report(self):
+        while self.writer is not None:
+            ipc_send(self.writer, {"op": "stats", "worker": self.worker, "data": cluster_snapshot()})
+            await self.writer.drain()
+            await asyncio.sleep(CLUSTER_STATS_INTERVAL)
+
+    async def _handle(self, msg: dict):
+        op = msg.get("op")
+        if op == "cluster_stats":
+            fut = self.waiters.pop(msg["id"], None)
+            if fut is not None and not fut.done():
+                fut.set_result(msg["workers"])
+        elif op == "shutdown":
+            print("🧩 launcher 要求結束")
+            await bot.close()
+
+    async def cluster_stats(self, timeout: float = 3) -> Dict[str, dict]:
+        if self.writer is None:
+            raise ConnectionError("還沒連上 launcher")
+        self.seq += 1
+        fut = self.waiters[self.seq] = asyncio.get_running_loop().create_future()
+        ipc_send(self.writer, {"op": "cluster_stats", "id": self.seq})
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        finally:
+            self.waiters.pop(self.seq, None)
+
+
+cluster_client = ClusterClient(CLUSTER_WORKER) if CLUSTER_WORKER >= 0 else None
+
+
+@tree.command(name="cluster", description="顯示各 worker 的連線與播放統計")
+@traced()
+async def cluster_cmd(interaction: discord.Interaction):
+    if cluster_client is None:
+        workers = {"0": cluster_snapshot()}
+    else:
+        try:
+            workers = await cluster_client.cluster_stats()
+        except (ConnectionError, asyncio.TimeoutError) as e:
+            await interaction.response.send_message(f"❌ 無法取得叢集統計：{e}", ephemeral=True)
+            return
+        workers[str(cluster_client.worker)] = cluster_snapshot()  # 自己的用最新的
+
+    lines = []
+    for wid, st in sorted(workers.items(), key=lambda kv: int(kv[0])):
+        shards = st["shards"]
+        shard_text = f"shard {shards[0]}-{shards[-1]}" if shards else "單一 shard"
+        latency = f"{st['latency_ms']} ms" if st.get("latency_ms") is not None else "—"
+        lines.append(
+            f"**worker {wid}**（{shard_text}）：{st['guilds']} 個伺服器、"
+            f"{st['playing']}/{st['voice']} 播放中、佇列 {st['queued']} 首、延遲 {latency}"
+        )
+    total = {k: sum(st[k] for st in workers.values()) for k in ("guilds", "voice", "playing", "queued")}
+    embed = discord.Embed(
+        title="🧩 叢集狀態",
+        description="\n".join(lines),
+        color=discord.Color.dark_teal(),
+    )
+    embed.set_footer(
+        text=f"合計 {total['guilds']} 個伺服器、{total['playing']}/{total['voice']} 播放中、佇列 {total['queued']} 首"
+    )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+
+# ============================================================
+# 指令同步：指令樹的 hash 和上次同步的一樣就不打 tree.sync()
+# ============================================================
+# 預設放在狀態資料庫旁邊（同一個 volume 才留得住）；FORCE_COMMAND_SYNC=1 強制同步
+COMMAND_HASH_PATH = os.getenv("COMMAND_HASH_PATH", f"{STATE_DB_PATH}.commands" if STATE_DB_PATH else "")
+FORCE_COMMAND_SYNC = os.getenv("FORCE_COMMAND_SYNC", "") == "1"
+
+
+def command_tree_hash() -> str:
+    # 和 tree.sync() 送出去的 payload 一樣；discord.py 2.4 起 to_dict 要傳 tree
+    cmds = tree.get_commands()
+    try:
+        payload = [cmd.to_dict(tree) for cmd in cmds]  # type: ignore
+    except TypeError:
+        payload = [cmd.to_dict() for cmd in cmds]  # type: ignore
+    data = json.dumps([bot.application_id, payload], sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+async def sync_commands():
+    digest = command_tree_hash()
+    if COMMAND_HASH_PATH and not FORCE_COMMAND_SYNC:
+        try:
+            with open(COMMAND_HASH_PATH, "r", encoding="utf-8") as f:
+                if f.read().strip() == digest:
+                    print("指令沒有變動，略過同步")
+                    return
+        except OSError:
+            pass
+    try:
+        await tree.sync()
+    except discord.HTTPException as e:
+        print("指令同步失敗:", e)
+        ERRORS.inc("command_sync")
+        return
+    if COMMAND_HASH_PATH:
+        await asyncio.get_running_loop().run_in_executor(
+            None, _atomic_write, COMMAND_HASH_PATH, digest.encode("utf-8")
+        )
+
+
+# ============================================================
+# Bot 啟動 / 結束
+# ============================================================
+async def open_stores():
+    # 資料庫和寫入執行緒在這裡才開：import 模組（bench、測試、叢集的主程序）不會建檔
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, state_store.open)
+    await loop.run_in_executor(None, spotify_index.open)
+
+
+async def stop_background():
+    # 先停掉會排查詢的工作（播放器、讀清單、預解析、補資訊）並等它們收尾，再關 resolver
+    tasks = [p.task for p in players.values()]
+    tasks += [t for ts in ingest_tasks.values() for t in ts]
+    tasks += [*prefetcher.tasks.values(), *enricher.tasks.values()]
+    tasks = [t for t in tasks if not t.done()]
+    for player in players.values():
+        player.task.cancel()
+    for guild_id in list(ingest_tasks):
+        cancel_ingest(guild_id)
+    for guild_id in list(prefetcher.tasks):
+        prefetcher.invalidate(guild_id)
+    for guild_id in list(enricher.tasks):
+        enricher.cancel(guild_id)
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await resolver.close()
+
+
+async def run_bot():
+    async with bot:
+        try:
+            await bot.start(TOKEN)  # type: ignore
+        finally:
+            await stop_background()
+
+
+@bot.event
+async def setup_hook():
+    # 登入後、連 gateway 前只跑一次；重連不會再同步
+    startup.mark("login")
+    await open_stores()
+    startup.mark("stores")
+    # 全域指令只要一個 worker 同步就好
+    if CLUSTER_WORKER <= 0:
+        await sync_commands()
+        startup.mark("sync")
+
+
 @bot.event
 async def on_ready():
-    await tree.sync()
-    print(f"🤖 已登入：{bot.user} (ID: {bot.user.id})")
+    shards = f"，shard {SHARD_IDS}" if SHARD_IDS else ""
+    print(f"🤖 已登入：{bot.user} (ID: {bot.user.id}{shards})")
 
     # 啟動自動斷線背景任務
     if not hasattr(bot, "auto_dc_task"):
-        bot.auto_dc_task = bot.loop.create_task(auto_disconnect_loop())
+        startup.mark("gateway")
+        print(startup.summary())
+        bot.auto_dc_task = bot.loop.create_task(idle_scheduler.run())
+        # 背景檢查本機音訊快取的完整性
+        bot.loop.create_task(audio_cache.verify_all())
+        if cluster_client is not None:
+            bot.loop.create_task(cluster_client.run())
+        await start_metrics()
 
 
 if __name__ == "__main__":
     if not TOKEN:
         raise RuntimeError("沒有在環境變數或 .env 中找到 DISCORD_TOKEN")
-    bot.run(TOKEN)
+    try:
+        if CLUSTER_WORKERS > 1 and CLUSTER_WORKER < 0:
+            asyncio.run(ClusterLauncher(CLUSTER_WORKERS, SHARD_COUNT or recommended_shards()).run())
+        else:
+            startup.mark("init")
+            # yt-dlp 在登入、連 gateway 的同時於背景載入
+            threading.Thread(target=ydl_pool.warm, name="ydl-warm", daemon=True).start()
+            # 不用 bot.run：結束時要在 event loop 還在的時候關掉 resolver
+            discord.utils.setup_logging()
+            try:
+                asyncio.run(run_bot())
+            except KeyboardInterrupt:
+                pass
+    finally:
+        state_store.close()
+        track_cache.close()
@@ -0,0 +1,84 @@
+import math
+import os
+import random
+import sys
+
+import pytest
+
+pytest.importorskip("discord")
+pytest.importorskip("dotenv")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["METRICS_PORT"] = "0"
+
+import musicbot  # noqa: E402
+
+DAY = 86400
+
+
+def track(i):
+    return musicbot.Track(f"https://www.youtube.com/watch?v={i}", f"Song {i}")
+
+
+def weights(stats):
+    return [math.exp(e.log_score - stats.base) for e in stats]
+
+
+def test_prefix_sums_match_weights():
+    stats = musicbot.PlayStats()
+    rng = random.Random(1)
+    for n in range(200):
+        stats.record(track(rng.randrange(40)), t=1e9 + n * 3600)
+    w = weights(stats)
+    for i in range(len(w) + 1):
+        assert stats._prefix(i) == pytest.approx(sum(w[:i]))
+
+
+def test_rebase_keeps_prefix_sums(monkeypatch):
+    # 基準很小：幾天後的播放就會超過上限、重建整棵樹
+    monkeypatch.setattr(musicbot, "FENWICK_MAX_EXP", 5 * musicbot.PLAY_DECAY_RATE * DAY)
+    stats = musicbot.PlayStats()
+    bases = set()
+    for day in range(30):
+        stats.record(track(day % 7), t=1e9 + day * DAY)
+        bases.add(stats.base)
+    assert len(bases) > 1
+    w = weights(stats)
+    assert stats._prefix(len(stats)) == pytest.approx(sum(w))
+    assert max(w) <= math.exp(musicbot.FENWICK_MAX_EXP)
+
+
+def test_top_follows_decay():
+    stats = musicbot.PlayStats()
+    # 很久以前播很多次的，比不上最近播幾次的
+    for _ in range(5):
+        stats.record(track("old"), t=1e9)
+    for i in range(20):
+        stats.record(track(i), t=1e9 + 365 * DAY)
+    stats.record(track(3), t=1e9 + 365 * DAY)
+    expected = sorted(stats, key=lambda e: -e.log_score)[:musicbot.TOP_K]
+    assert [e.url for e in stats.top] == [e.url for e in expected]
+    assert stats.top[0].url.endswith("=3")
+    assert track("old").webpage_url not in {e.url for e in stats.top}
+    assert stats.get(track("old").webpage_url).count == 5
+
+
+def test_sample_is_weighted():
+    random.seed(0)
+    stats = musicbot.PlayStats()
+    stats.record(track("a"), t=1e9)
+    for _ in range(3):
+        stats.record(track("b"), t=1e9)
+    n = 20000
+    b = sum(stats.sample().url.endswith("=b") for _ in range(n))
+    assert b / n == pytest.approx(0.75, abs=0.02)
+
+
+def test_empty_and_load():
+    stats = musicbot.PlayStats()
+    assert not stats and stats.sample() is None and stats.top == []
+    stats.load("u1", "One", 2, 10.0, 1e9)
+    stats.load("u2", "Two", 1, 11.0, 1e9)
+    assert len(stats) == 2
+    assert [e.url for e in stats.top] == ["u2", "u1"]
+    assert stats.get("u1").count == 2
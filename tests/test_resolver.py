@@ -0,0 +1,78 @@
+import asyncio
+import os
+import sys
+import threading
+
+import pytest
+
+pytest.importorskip("discord")
+pytest.importorskip("dotenv")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["METRICS_PORT"] = "0"
+
+import musicbot  # noqa: E402
+
+
+def test_round_robin_between_guilds():
+    async def run():
+        resolver = musicbot.Resolver(1)
+        gate = threading.Event()
+        order = []
+
+        def job(name):
+            if name == "block":
+                gate.wait(5)
+            order.append(name)
+            return name
+
+        blocker = asyncio.ensure_future(resolver.run(0, job, "block"))
+        await asyncio.sleep(0.05)  # 唯一的 worker 被占住，後面的都在排隊
+        jobs = [asyncio.ensure_future(resolver.run(1, job, f"a{i}")) for i in range(3)]
+        jobs.append(asyncio.ensure_future(resolver.run(2, job, "b0")))
+        jobs.append(asyncio.ensure_future(resolver.run(3, job, "c0")))
+        gate.set()
+        results = await asyncio.gather(blocker, *jobs)
+        await resolver.close()
+        return order, results
+
+    order, results = asyncio.run(run())
+    # guild 1 先排了三個，也只能輪一次就讓 guild 2、3
+    assert order == ["block", "a0", "b0", "c0", "a1", "a2"]
+    assert results == ["block", "a0", "a1", "a2", "b0", "c0"]
+
+
+def test_timeout_drops_queued_job():
+    async def run():
+        resolver = musicbot.Resolver(1)
+        gate = threading.Event()
+        ran = []
+
+        def job(name):
+            if name == "block":
+                gate.wait(5)
+            ran.append(name)
+
+        blocker = asyncio.ensure_future(resolver.run(0, job, "block"))
+        await asyncio.sleep(0.05)
+        with pytest.raises(musicbot.ResolveTimeout):
+            await resolver.run(1, job, "late", timeout=0.05)
+        gate.set()
+        await blocker
+        await resolver.run(1, job, "after")
+        await resolver.close()
+        return ran, resolver.running
+
+    ran, running = asyncio.run(run())
+    assert ran == ["block", "after"]
+    assert running == 0
+
+
+def test_closed_resolver_rejects_work():
+    async def run():
+        resolver = musicbot.Resolver(1)
+        await resolver.close()
+        with pytest.raises(RuntimeError):
+            await resolver.run(1, lambda: None)
+
+    asyncio.run(run())
@@ -0,0 +1,79 @@
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("discord")
+pytest.importorskip("dotenv")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["METRICS_PORT"] = "0"
+
+import musicbot  # noqa: E402
+
+FIXTURE = {
+    "tracks": {
+        "t1": {"name": "Song One", "artists": ["Artist A"], "duration": 200},
+        "t2": {"name": "Song Two", "artists": ["Artist B", "Artist C"], "duration": 180},
+        "t3": {"name": "Song Three", "artists": [], "duration": 240},
+    },
+    "albums": {"a1": {"name": "Album", "tracks": ["t1", "t2", "t3"]}},
+    "playlists": {"p1": {"name": "Mix", "tracks": ["t3", "missing", "t1"]}},
+}
+
+
+@pytest.fixture
+def spotify(tmp_path, monkeypatch):
+    path = tmp_path / "fixture.json"
+    path.write_text(json.dumps(FIXTURE), encoding="utf-8")
+    index = musicbot.SpotifyIndex(str(tmp_path / "index.db"))
+    index.open()
+    searches = []
+
+    def get_track_info(query):
+        searches.append(query)
+        return musicbot.Track(f"https://www.youtube.com/watch?v={len(searches)}", query, 100)
+
+    monkeypatch.setattr(musicbot, "spotify_source", musicbot.SpotifyFixture(str(path)))
+    monkeypatch.setattr(musicbot, "spotify_index", index)
+    monkeypatch.setattr(musicbot, "resolver", musicbot.Resolver(2))
+    monkeypatch.setattr(musicbot, "track_cache", musicbot.TrackCache(100, 3600, None, 0))
+    monkeypatch.setattr(musicbot, "get_track_info", get_track_info)
+    yield index, searches
+    musicbot.resolver.executor.shutdown()
+
+
+def convert(kind, sid, n=10):
+    async def run():
+        reader = await musicbot.SpotifyReader(1, kind, sid).open()
+        return reader.title, await reader.read(n)
+
+    return asyncio.run(run())
+
+
+def test_album_is_matched_and_indexed(spotify):
+    index, searches = spotify
+    title, tracks = convert("album", "a1")
+    assert title == "Album"
+    assert searches == ["Artist A - Song One", "Artist B Artist C - Song Two", "Song Three"]
+    mapped = index.get_many(["t1", "t2", "t3"])
+    assert {sid: t.title for sid, t in mapped.items()} == {
+        "t1": "Artist A - Song One",
+        "t2": "Artist B Artist C - Song Two",
+        "t3": "Song Three",
+    }
+    assert [t.webpage_url for t in tracks] == [mapped[sid].webpage_url for sid in ("t1", "t2", "t3")]
+
+
+def test_playlist_reuses_the_index(spotify):
+    index, searches = spotify
+    convert("album", "a1")
+    searches.clear()
+    # 換一個新的記憶體快取，確定是從對照表拿到的，不是 track_cache
+    musicbot.track_cache = musicbot.TrackCache(100, 3600, None, 0)
+    title, tracks = convert("playlist", "p1")
+    assert title == "Mix"
+    assert searches == []
+    assert [t.title for t in tracks] == ["Song Three", "Artist A - Song One"]
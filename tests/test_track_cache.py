@@ -0,0 +1,79 @@
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+pytest.importorskip("discord")
+pytest.importorskip("dotenv")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["METRICS_PORT"] = "0"
+
+import musicbot  # noqa: E402
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    calls = []
+
+    def get_track_info(query):
+        calls.append(query)
+        time.sleep(0.1)
+        return musicbot.Track(f"https://www.youtube.com/watch?v={len(calls)}", query, 100)
+
+    monkeypatch.setattr(musicbot, "resolver", musicbot.Resolver(2))
+    monkeypatch.setattr(musicbot, "get_track_info", get_track_info)
+    yield calls
+    musicbot.resolver.executor.shutdown()
+
+
+def new_cache():
+    return musicbot.TrackCache(100, 3600, None, 0)
+
+
+def test_concurrent_lookups_share_one_query(lookups):
+    cache = new_cache()
+
+    async def run():
+        return await asyncio.gather(*(cache.get(1, q) for q in ("Some Song", "some  song", " SOME SONG ")))
+
+    tracks = asyncio.run(run())
+    assert lookups == ["Some Song"]
+    assert tracks[0] is tracks[1] is tracks[2]
+    assert (cache.misses, cache.joined) == (1, 2)
+    assert cache.inflight == {}
+
+
+def test_cancelling_one_waiter_keeps_the_others(lookups):
+    cache = new_cache()
+
+    async def run():
+        first = asyncio.ensure_future(cache.get(1, "song"))
+        second = asyncio.ensure_future(cache.get(2, "song"))
+        await asyncio.sleep(0.02)
+        first.cancel()
+        track = await second
+        return first, track
+
+    first, track = asyncio.run(run())
+    assert first.cancelled()
+    assert track.title == "song"
+    assert lookups == ["song"]
+    assert cache.get_mem(musicbot.normalize_query("song")) is track
+
+
+def test_all_waiters_gone_cancels_the_query(lookups):
+    cache = new_cache()
+
+    async def run():
+        with pytest.raises(musicbot.ResolveTimeout):
+            await cache.get(1, "slow", timeout=0.02)
+        # 已取消的查詢馬上從 inflight 拿掉，下一個呼叫端重新查
+        assert cache.inflight == {}
+        return await cache.get(1, "slow")
+
+    track = asyncio.run(run())
+    assert track.title == "slow"
+    assert lookups == ["slow", "slow"]
@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("discord")
+pytest.importorskip("dotenv")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["METRICS_PORT"] = "0"
+
+import musicbot  # noqa: E402
+
+
+def make_queue(*durations):
+    return musicbot.TrackQueue(
+        musicbot.Track(f"https://www.youtube.com/watch?v={i}", f"Song {i}", d) for i, d in enumerate(durations)
+    )
+
+
+def test_move_keeps_totals():
+    q = make_queue(100, 0, 200)
+    q.move(0, 2)
+    assert [t.title for t in q] == ["Song 1", "Song 2", "Song 0"]
+    assert q.duration == 300
+    assert q.unknown == 1
+
+    q.move(0, 1)
+    assert q.duration == 300
+    assert q.unknown == 1
+
+
+def test_totals_follow_remove_and_insert():
+    q = make_queue(100, 0, 200)
+    track = q.remove(1)
+    assert (q.duration, q.unknown) == (300, 0)
+    q.insert(0, track)
+    assert (q.duration, q.unknown) == (300, 1)
+    q.popleft()
+    assert (q.duration, q.unknown) == (300, 0)